@@ -38,17 +38,70 @@
             sequence number         : 2 bytes   ==  при инициализации == 0
                                                     при обмене начиается с нуля
                                                     и увеличивается на 1
-                                                    на каждом шаге
+                                                    на каждом шаге;
+                                                    клиент может посылать
+                                                    куски окном, сервер
+                                                    принимает куски не по
+                                                    порядку, если номер
+                                                    отстоит от ожидаемого
+                                                    не более чем на 32768
         Description         : <= 65507 bytes
         инициализирующее сообщение:
             ascii string            : 15 bytes  ==  "magic-ping-sini"
             flags                   : 1 byte    ==  0x1 чтобы использовать шифрование
+                                                    0x2 чтобы получать ответы
+                                                        "magic-ping-sack"
+                                                        вместо "magic-ping-recv"
+                                                    0x4 если передаётся размер куска
+                                                    0x8 если соединение передаёт
+                                                        участок файла (полосу)
+                                                    0x10 если куски передаются
+                                                        со смещением в файле
+                                                    0x20 если клиент может
+                                                        продолжить прерванную
+                                                        передачу
+                                                    0x40 если куски сжимаются
+                                                    0x80 если перед данными
+                                                        посылается список блоков
+                                                        для дедупликации
+                                                        (только вместе с 0x10,
+                                                        без 0x20)
             size of message         : 8 bytes
+            chunk size              : 2 bytes   ==  только при флаге 0x4,
+                                                    иначе 65492
+            range offset            : 8 bytes   ==  только при флаге 0x8,
+                                                    смещение участка в файле
+            range size              : 8 bytes   ==  только при флаге 0x8,
+                                                    размер участка
+            stripe count            : 1 byte    ==  только при флаге 0x8,
+                                                    кол-во полос файла (2..255);
+                                                    сервер пишет полосы с одинаковыми
+                                                    ip, размером и именем файла
+                                                    в один файл
+            fingerprint             : 16 bytes  ==  только при флаге 0x20,
+                                                    отпечаток содержимого файла
+            codec                   : 1 byte    ==  только при флаге 0x40,
+                                                    алгоритм сжатия: 1 - zlib
+                                                    (deflate), 2 - lzma (raw lzma2),
+                                                    3 - bz2
             filename                : <= 65483  ==  Нуль-терминированная utf-8 строка
         ответ на инициализирующее сообщение:
             ascii string            : 15 bytes  == "magic-ping-rini"
             error code              : 1 byte    ==  0x1 если превышен максимальный размер
                                                         сообщения
+            accepted flags          : 1 byte    ==  только при флагах 0x10, 0x20, 0x40 или 0x80,
+                                                    запрошенные флаги (0x10, 0x20, 0x40, 0x80),
+                                                    которые поддерживает сервер;
+                                                    без этого байта клиент
+                                                    посылает куски без смещения
+                                                    и сжатия, а передачу с начала
+            resume offset           : 8 bytes   ==  только при принятом флаге 0x20,
+                                                    смещение (на границе куска),
+                                                    с которого продолжается
+                                                    передача; куски до него
+                                                    уже записаны сервером
+            range offset            : 8 bytes   ==  только при флаге 0x8, смещение участка
+                                                    из инициализирующего сообщения
             filename                : <= 65483  ==  Нуль-терминированная utf-8 строка
         обмен ключами шифрования на клиентской стороне:
             ascii string            : 15 bytes  == "magic-ping-skey"
@@ -56,14 +109,125 @@
         обмене ключами шифрования на серверной стороне:
             ascii string            : 15 bytes  == "magic-ping-rkey"
             random value            : 8 bytes   >= 0
+        проба MTU пути (до инициализации, identifier == 0, флаг DF):
+            ascii string            : 15 bytes  == "magic-ping-smtu"
+            padding                 : до размера пробы
+        ответ на пробу MTU:
+            ascii string            : 15 bytes  == "magic-ping-rmtu"
+            size                    : 2 bytes   ==  размер принятой пробы
+                                                    (без ip и ICMP заголовков)
+        список блоков (при принятом флаге 0x80, после обмена ключами):
+            ascii string            : 15 bytes  == "magic-ping-sman"
+            first block             : 8 bytes   ==  номер первого блока части;
+                                                    блок i - 65536 байт файла
+                                                    по смещению i * 65536
+                                                    (последний блок файла короче),
+                                                    в список входят блоки,
+                                                    целиком лежащие в участке
+            hashes                  : 16 bytes  ==  первые 16 байт sha256
+                                      на блок       блоков first block, first block + 1, ...;
+                                                    шифруются так же, как данные;
+                                                    пустой список завершает
+                                                    список блоков
+        ответ на список блоков:
+            ascii string            : 15 bytes  == "magic-ping-rman"
+            first block             : 8 bytes   ==  номер первого блока части
+            bitmap                  : <= 4096   ==  бит i установлен, если блок
+                                                    first block + i найден
+                                                    на сервере и скопирован
+                                                    в принимаемый файл;
+                                                    после ответа на конец списка
+                                                    посылаются только куски,
+                                                    не покрытые найденными блоками,
+                                                    и нумеруются они подряд
+                                                    (offset - смещение куска в файле)
+        запрос проверки целостности (после обмена ключами, до списка блоков и данных;
+        сервер, который не отвечает, проверку не поддерживает):
+            ascii string            : 15 bytes  == "magic-ping-sver"
+            options                 : 1 byte    ==  младшие 4 бита - алгоритм хеша
+                                                    участка: 0 - без хеша,
+                                                    1 - sha256, 2 - blake2b
+                                                    (32 байта);
+                                                    0x80 - CRC32 каждого куска
+        ответ на запрос проверки целостности:
+            ascii string            : 15 bytes  == "magic-ping-rver"
+            options                 : 1 byte    ==  принятые сервером алгоритм
+                                                    (0, если не поддерживается)
+                                                    и 0x80
         посылка данных:
             ascii string            : 15 bytes  == "magic-ping-send"
-            data                    : <= 65492 bytes
+            crc32                   : 4 bytes   ==  только при принятом 0x80
+                                                    в "magic-ping-rver": CRC32
+                                                    всего, что идёт после него;
+                                                    кусок с неверной CRC32
+                                                    не подтверждается
+            offset                  : 8 bytes   ==  только при флаге 0x10,
+                                                    подтверждённом сервером:
+                                                    смещение куска в файле;
+                                                    номер куска определяется
+                                                    по смещению, а не по
+                                                    sequence number, который
+                                                    повторяется через 65536 кусков
+            mode                    : 1 byte    ==  только при флаге 0x40,
+                                                    подтверждённом сервером:
+                                                    0 - кусок не сжат,
+                                                    1 - кусок сжат (в файле
+                                                    занимает chunk size, последний
+                                                    кусок - до конца участка),
+                                                    2 - кусок из нулей, data пусто
+            data                    : <= chunk size bytes, кусок i
+                                      лежит в файле по смещению
+                                      range offset + i * chunk size
+                                      (при флаге 0x10 chunk size <= 65484,
+                                      при флаге 0x40 - ещё на 1 меньше,
+                                      при CRC32 - ещё на 4 меньше);
+                                      при шифровании шифруются сжатые данные
         ответ на посылку данных:
             ascii string            : 15 bytes  == "magic-ping-recv"
             last_byte               : последний байт переданных данных
+        накопительное и выборочное подтверждение (при флаге 0x2):
+            sequence number заголовка   ==  cumulative seq_num
+            ascii string            : 15 bytes  == "magic-ping-sack"
+            cumulative seq_num      : 2 bytes   ==  номер первого не принятого куска,
+                                                    все предыдущие куски приняты
+            bitmap                  : <= 4096   ==  бит i (младший бит первого
+                                                    байта == 0) установлен,
+                                                    если принят кусок с номером
+                                                    cumulative seq_num + 1 + i
+            сервер может подтверждать несколько кусков одним ответом
+            (каждые ack_every кусков или не позже, чем через ack_delay секунд),
+            при приёме куска не по порядку или повторного куска ответ
+            посылается сразу
+        хеш участка (после подтверждения всех кусков, если хеш принят сервером;
+        до этого сообщения сервер не закрывает соединение):
+            ascii string            : 15 bytes  == "magic-ping-sfin"
+            digest                  : 32 bytes  ==  хеш участка файла (range offset,
+                                                    range size), посчитанный
+                                                    клиентом при чтении;
+                                                    шифруется так же, как данные
+        ответ на хеш участка:
+            ascii string            : 15 bytes  == "magic-ping-rfin"
+            status                  : 1 byte    ==  0 - хеш совпал с хешем,
+                                                    посчитанным сервером при записи,
+                                                    1 - не совпал,
+                                                    2 - сервер не посчитал хеш
 """
+import magicPing.batch
+import magicPing.bpf
+import magicPing.checkpoint
 import magicPing.client
+import magicPing.compression
+import magicPing.congestion
+import magicPing.cypher
+import magicPing.dedup
+import magicPing.demux
 import magicPing.server
+import magicPing.sessions
 import magicPing.icmp
+import magicPing.integrity
+import magicPing.mmsg
+import magicPing.pmtu
+import magicPing.protocol
+import magicPing.rtt
 import magicPing.utils
+import magicPing.writer
@@ -6,7 +6,10 @@ import pathlib
 import sys
 from enum import Enum
 
+from magicPing import batch
 from magicPing import client
+from magicPing import compression
+from magicPing import integrity
 from magicPing import server
 from magicPing import icmp
 
@@ -20,6 +23,22 @@ class TypeOfApp(Enum):
     CLIENT = 2
 
 
+def positive_float(value):
+    """
+    тип аргумента командной строки: положительное число
+    :type value: str
+    :param value: значение аргумента
+    :return: число
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if number is None or not 0 < number < float("inf"):
+        raise argparse.ArgumentTypeError("ожидается положительное число: {}".format(value))
+    return number
+
+
 def get_parser() -> argparse.ArgumentParser:
     """
     генерация парсера аргументов командной строки
@@ -57,6 +76,28 @@ def get_parser() -> argparse.ArgumentParser:
                               const=True, default=False, help="Завершить демона")
     daemon_group.add_argument("--restart_daemon", "-r", action="store_const",
                               const=True, default=False, help="Перезапустить демона")
+    server_parser.add_argument("--ack_every", "-k", type=int, default=2,
+                               help="Кол-во кусков, подтверждаемых одним ответом")
+    server_parser.add_argument("--ack_delay", "-a", type=float, default=0.02,
+                               help="Максимальная задержка подтверждения в секундах")
+    server_parser.add_argument("--batch_size", "-b", type=int, default=32,
+                               help="Кол-во пакетов, принимаемых и посылаемых одним системным вызовом " +
+                                    "(recvmmsg/sendmmsg, 1 == по одному пакету)")
+    server_parser.add_argument("--engine", "-n", choices=["threads", "asyncio"], default="threads",
+                               help="threads: слушатель и потоки-обработчики; " +
+                                    "asyncio: сопрограмма на соединение, " +
+                                    "запись в файлы в пуле из thread_number потоков")
+    server_parser.add_argument("--writer_number", "-W", type=int, default=2,
+                               help="Кол-во потоков записи в файлы (0 == запись в обработчике пакетов)")
+    server_parser.add_argument("--processes", "-P", type=int, default=1,
+                               help="Кол-во процессов, между которыми делятся соединения " +
+                                    "(только для --engine threads)")
+    server_parser.add_argument("--no_filter", "-F", dest="use_filter", action="store_const",
+                               const=False, default=True,
+                               help="Не устанавливать фильтр ICMP пакетов в ядре (SO_ATTACH_FILTER)")
+    server_parser.add_argument("--no_dedup", "-D", dest="dedup", action="store_const",
+                               const=False, default=True,
+                               help="Не вести индекс блоков принятых файлов для дедупликации")
     server_parser.add_argument("--target_path", "-p",
                                type=lambda x: pathlib.Path(os.path.realpath(x)),
                                default=pathlib.Path(os.getcwd()),
@@ -75,11 +116,47 @@ def get_parser() -> argparse.ArgumentParser:
     client_parser.add_argument("--destination", "-d", default=None, help="адрес получателя")
     client_parser.add_argument("--cypher", "-c", action="store_const",
                                const=True, default=False, help="Использовать шифрование")
+    client_parser.add_argument("--window_size", "-w", type=int, default=8,
+                               help="Кол-во кусков файла, одновременно находящихся в пути")
+    client_parser.add_argument("--chunk_size", "-s", type=int, default=None,
+                               help="Размер куска данных в байтах " +
+                                    "(по умолчанию подбирается по MTU пути до адресата)")
+    client_parser.add_argument("--stripes", "-p", type=int, default=1,
+                               help="Кол-во участков большого файла, посылаемых параллельно")
+    client_parser.add_argument("--batch", "-B", nargs="+", default=None,
+                               help="Файлы, директории или шаблоны glob для посылки одним процессом")
+    client_parser.add_argument("--manifest", "-M", default=None,
+                               help="Файл со списком файлов для посылки, по одному на строку")
+    client_parser.add_argument("--sessions", "-S", type=int, default=batch.MAX_SESSIONS,
+                               help="Максимальное кол-во одновременно посылаемых файлов " +
+                                    "(для --batch и --manifest)")
+    client_parser.add_argument("--rate", "-r", type=positive_float, default=None,
+                               help="Ограничение скорости посылки в байтах в секунду")
+    client_parser.add_argument("--no_filter", "-F", dest="use_filter", action="store_const",
+                               const=False, default=True,
+                               help="Не устанавливать фильтр ICMP пакетов в ядре (SO_ATTACH_FILTER)")
+    client_parser.add_argument("--no_resume", "-n", dest="resume", action="store_const",
+                               const=False, default=True,
+                               help="Не продолжать прерванную передачу, а посылать файл заново")
+    client_parser.add_argument("--compress", "-z", choices=sorted(compression.CODECS), default=None,
+                               help="Сжимать куски выбранным алгоритмом " +
+                                    "(куски из одних нулей не передаются)")
+    client_parser.add_argument("--dedup", "-D", action="store_const", const=True, default=False,
+                               help="Посылать только блоки файла, которых нет на сервере " +
+                                    "(без продолжения прерванной передачи)")
+    client_parser.add_argument("--verify", "-V", choices=sorted(integrity.ALGORITHMS), default=None,
+                               help="Проверить целостность принятого файла хешем, " +
+                                    "который клиент и сервер считают при чтении и записи")
+    client_parser.add_argument("--crc", "-C", action="store_const", const=True, default=False,
+                               help="Посылать CRC32 каждого куска (повреждённые куски посылаются повторно)")
 
     monitor_parser = subparsers.add_parser("monitor", aliases=["m"],
                                            help="запуск мониторинга " +
                                                 "ping echo request/reply")
     monitor_parser.set_defaults(type=TypeOfApp.MONITOR)
+    monitor_parser.add_argument("--magic_only", "-g", action="store_const",
+                                const=True, default=False,
+                                help="Показывать только сообщения magic-ping")
 
     return parser
 
@@ -91,15 +168,24 @@ if __name__ == "__main__":
                         level=args.log_level, stream=args.log_file)
 
     if args.type == TypeOfApp.SERVER:
+        server_classes = {"threads": server.Server, "asyncio": server.AsyncServer}
+        server_options = dict(ack_every=args.ack_every, ack_delay=args.ack_delay,
+                              batch_size=args.batch_size, use_filter=args.use_filter,
+                              writer_num=args.writer_number, dedup=args.dedup, server_class=server_classes[args.engine])
+        if args.processes > 1:
+            if args.engine != "threads":
+                parser.error("--processes поддерживается только для --engine threads")
+            server_options.update(server_class=server.ProcessServer, process_num=args.processes)
         if args.start_daemon:
-            server.DaemonServer(args.max_size, args.thread_number, args.target_path).start()
+            server.DaemonServer(args.max_size, args.thread_number, args.target_path, **server_options).start()
         elif args.stop_daemon:
             server.DaemonServer(None, None, None).stop()
         elif args.restart_daemon:
             server.DaemonServer(None, None, None).restart()
         else:
             daemon_server = server.DaemonServer(args.max_size, args.thread_number, args.target_path,
-                                                stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+                                                stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr,
+                                                **server_options)
             daemon_server.start()
             while input("введите \"q\", чтобы завершить работу сервера\n") != "q":
                 pass
@@ -108,12 +194,23 @@ if __name__ == "__main__":
                 sys.exit(0)
 
     elif args.type == TypeOfApp.CLIENT:
-        client = client.Client(max_size=args.max_size, timeout=args.timeout, enable_cypher=args.cypher)
+        client_options = dict(max_size=args.max_size, timeout=args.timeout, enable_cypher=args.cypher,
+                              window_size=args.window_size, use_filter=args.use_filter,
+                              chunk_size=args.chunk_size, rate=args.rate, stripes=args.stripes,
+                              resume=args.resume, compress=args.compress,
+                              dedup=args.dedup, verify=args.verify, crc=args.crc)
+        if args.batch is not None or args.manifest is not None:
+            files = batch.collect_files(args.batch or [], args.manifest)
+            report = batch.BatchSender(args.sessions, **client_options).send(
+                files, args.destination if args.destination is not None else input("Адресат: "))
+            print(report)
+            sys.exit(1 if report.failed else 0)
+        client = client.Client(**client_options)
         client.send(args.filename if args.filename is not None else input("Имя файла для отправки: "),
                     args.destination if args.destination is not None else input("Адресат: "))
 
     elif args.type == TypeOfApp.MONITOR:
-        icmp.monitor()
+        icmp.monitor(args.magic_only)
 
     else:
         parser.print_help()
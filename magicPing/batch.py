@@ -0,0 +1,208 @@
+"""
+Посылка многих файлов (директории, шаблоны, списки файлов) одним процессом
+
+все передачи идут через один сырой сокет и один раздатчик пакетов,
+небольшие файлы посылаются одновременно несколькими сеансами
+(не больше max_sessions), а в конце выводится общий отчёт
+"""
+import concurrent.futures
+import glob
+import logging
+import os
+import socket
+import threading
+import time
+
+from magicPing import bpf
+from magicPing import client
+from magicPing import congestion
+from magicPing import demux
+from magicPing import icmp
+from magicPing import pmtu
+from magicPing import protocol
+
+log = logging.getLogger(__name__)
+
+# кол-во одновременных сеансов по умолчанию
+MAX_SESSIONS = 8
+
+
+def collect_files(sources, manifest=None):
+    """
+    Список файлов для посылки
+    :type sources: collections.Iterable
+    :type manifest: str или None
+    :param sources: файлы, директории (обходятся рекурсивно) и шаблоны glob
+    :param manifest: файл со списком источников, по одному на строку
+                     (пустые строки и строки с "#" пропускаются,
+                     относительные пути отсчитываются от директории списка)
+    :return: список путей без повторов в порядке перечисления
+    """
+    sources = list(sources)
+    if manifest is not None:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding="UTF-8") as lines:
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    sources.append(os.path.join(base, line))
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        elif glob.has_magic(source):
+            files.extend(path for path in sorted(glob.glob(source, recursive=True)) if os.path.isfile(path))
+        elif os.path.isfile(source):
+            files.append(source)
+        else:
+            log.warning("Файл не найден: %s", source)
+    seen = set()
+    return [path for path in files if not (path in seen or seen.add(path))]
+
+
+class BatchReport:
+    """
+    Итоги посылки набора файлов
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+        self.bytes = 0
+        self.start = time.time()
+        self.elapsed = 0.
+        self.lock = threading.Lock()
+
+    def add(self, filename, size, ok):
+        """
+        Учёт посланного файла
+        :type filename: str
+        :type size: int
+        :type ok: bool
+        :param filename: путь до файла
+        :param size: размер файла
+        :param ok: файл доставлен
+        """
+        with self.lock:
+            if ok:
+                self.sent.append(filename)
+                self.bytes += size
+            else:
+                self.failed.append(filename)
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def __str__(self):
+        throughput = self.bytes / self.elapsed / 1e6 if self.elapsed > 0 else 0.
+        return "файлов послано: {}; с ошибкой: {}; байт: {}; время: {:.2f} с; скорость: {:.2f} МБ/с".format(
+            len(self.sent), len(self.failed), self.bytes, self.elapsed, throughput)
+
+
+def reply_groups(names):
+    """
+    Группы файлов, ответы на инициализацию которых не различить:
+    ожидающий ответа узнаёт его по концу сообщения (имени файла),
+    поэтому ответ на "ba.log" подходит и ожидающему ответа на "a.log";
+    группа имени - самое короткое имя набора, которым оно кончается
+    (имена, одно из которых кончается другим, попадают в одну группу)
+    :type names: collections.Iterable
+    :param names: имена файлов
+    :return: dict имя -> группа
+    """
+    names = set(names)
+    groups = dict()
+    for name in names:
+        for start in range(len(name), -1, -1):
+            if name[start:] in names:
+                groups[name] = name[start:]
+                break
+    return groups
+
+
+class BatchSender:
+    """
+    Посылка набора файлов одному адресату через общий сокет
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, **client_options):
+        """
+        :type max_sessions: int
+        :param max_sessions: максимальное кол-во одновременных сеансов
+        :param client_options: параметры client.Client для каждого сеанса
+        """
+        self.max_sessions = max(1, max_sessions)
+        self.client_options = dict(client_options)
+        self.client_options["show_progress"] = False
+        rate = self.client_options.get("rate")
+        if rate is not None and not isinstance(rate, congestion.TokenBucket):
+            # ограничение скорости общее для всех сеансов
+            self.client_options["rate"] = congestion.TokenBucket(rate)
+        self.use_filter = self.client_options.pop("use_filter", True)
+        # сервер узнаёт повторную инициализацию по имени файла,
+        # поэтому файлы с одинаковыми именами посылаются по очереди
+        self.name_locks = dict()
+        self.name_locks_lock = threading.Lock()
+        # группа из reply_groups -> блокировка обмена инициализирующими сообщениями
+        self.init_locks = dict()
+
+    def send(self, files, dest):
+        """
+        Посылка файлов
+        :type files: list
+        :type dest: str
+        :param files: пути до файлов
+        :param dest: адресат
+        :return: BatchReport
+        """
+        report = BatchReport()
+        window_size = self.client_options.get("window_size", 8)
+        with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as sock:
+            icmp.set_receive_buffer(sock, min(4 * window_size * protocol.CHUNK_SIZE * self.max_sessions,
+                                              protocol.RECEIVE_BUFFER_SIZE))
+            if self.use_filter:
+                # общий сокет: фильтр пропускает ответы всех сеансов
+                bpf.attach_filter(sock, bpf.echo_filter([0], bpf.REPLY_TAGS))
+            with demux.Demultiplexer(sock) as demultiplexer:
+                if not self.client_options.get("chunk_size"):
+                    # проба MTU один раз до запуска сеансов, дальше размер берётся из кэша
+                    pmtu.probe_chunk_size(demultiplexer, socket.inet_ntoa(icmp.resolve_address(dest)))
+                groups = reply_groups(os.path.basename(filename) for filename in files)
+                with concurrent.futures.ThreadPoolExecutor(self.max_sessions) as executor:
+                    futures = [executor.submit(self.send_one, demultiplexer, filename, dest, report,
+                                               groups[os.path.basename(filename)])
+                               for filename in files]
+                    concurrent.futures.wait(futures)
+        report.finish()
+        log.info("Посылка набора файлов завершена: %s", report)
+        return report
+
+    def send_one(self, demultiplexer, filename, dest, report, group=None):
+        """
+        Посылка одного файла отдельным сеансом
+        :type demultiplexer: demux.Demultiplexer
+        :type filename: str
+        :type dest: str
+        :type report: BatchReport
+        :type group: str или None
+        :param demultiplexer: общий раздатчик пакетов
+        :param filename: путь до файла
+        :param dest: адресат
+        :param report: отчёт
+        :param group: группа имени файла из reply_groups (None == имя файла)
+        """
+        name = os.path.basename(filename)
+        with self.name_locks_lock:
+            name_lock = self.name_locks.setdefault(name, threading.Lock())
+            init_lock = self.init_locks.setdefault(group if group is not None else name, threading.Lock())
+        try:
+            size = os.stat(filename).st_size
+            with name_lock:
+                ok = client.Client(demultiplexer=demultiplexer, init_lock=init_lock,
+                                   **self.client_options).send(filename, dest)
+        except Exception as _:
+            log.exception("Ошибка посылки файла %s", filename)
+            size, ok = 0, False
+        report.add(filename, size, ok)
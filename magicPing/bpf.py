@@ -0,0 +1,153 @@
+"""
+Фильтр сырого ICMP сокета на стороне ядра (classic BPF, SO_ATTACH_FILTER, Linux)
+
+сырой ICMP сокет получает копию каждого ICMP пакета на машине;
+с фильтром ядро отбрасывает чужие пакеты само, не будя читающий поток
+и не копируя их в пространство пользователя
+
+программа видит пакет вместе с ip заголовком, поэтому смещения
+в ICMP сообщении считаются от длины ip заголовка (регистр X)
+"""
+import ctypes
+import logging
+import socket
+import struct
+
+log = logging.getLogger(__name__)
+
+SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
+SO_DETACH_FILTER = getattr(socket, "SO_DETACH_FILTER", 27)
+
+# коды инструкций classic BPF (linux/filter.h)
+_LD_W_IND = 0x40
+_LD_H_IND = 0x48
+_LD_B_IND = 0x50
+_LDX_B_MSH = 0xb1
+_JEQ_K = 0x15
+_JGT_K = 0x25
+_JGE_K = 0x35
+_RET_K = 0x06
+
+# смещение данных ECHO сообщения от начала ICMP заголовка
+_ECHO_DATA_OFFSET = 8
+
+# метки, которыми начинаются сообщения magic-ping
+REQUEST_TAGS = (b"magic-ping-s",)
+REPLY_TAGS = (b"magic-ping-r", b"magic-ping-sack")
+ANY_TAGS = (b"magic-ping-",)
+
+
+def echo_filter(icmp_types, tags, icmp_id=None, id_range=None):
+    """
+    Программа, пропускающая только ICMP ECHO сообщения magic-ping
+    :type icmp_types: collections.Iterable
+    :type tags: collections.Iterable
+    :type icmp_id: int или None
+    :type id_range: tuple или None
+    :param icmp_types: допустимые типы сообщений (8 == REQUEST, 0 == REPLY)
+    :param tags: допустимые начала данных сообщения
+    :param icmp_id: допустимый идентификатор (None == любой)
+    :param id_range: допустимые границы идентификатора включительно (None == любой)
+    :return: список инструкций (code, jt, jf, k)
+    """
+    # инструкции с метками: переходы задаются именами меток, а не смещениями
+    program = [(_LDX_B_MSH, None, None, 0)]
+    icmp_types = list(icmp_types)
+    program.append((_LD_B_IND, None, None, 0))
+    for i, icmp_type in enumerate(icmp_types):
+        last = i == len(icmp_types) - 1
+        program.append((_JEQ_K, "code", "reject" if last else None, icmp_type))
+    program.append(("label", "code"))
+    program.append((_LD_B_IND, None, None, 1))
+    program.append((_JEQ_K, None, "reject", 0))
+    if icmp_id is not None:
+        program.append((_LD_H_IND, None, None, 4))
+        program.append((_JEQ_K, None, "reject", icmp_id))
+    if id_range is not None:
+        program.append((_LD_H_IND, None, None, 4))
+        program.append((_JGE_K, None, "reject", id_range[0]))
+        program.append((_JGT_K, "reject", None, id_range[1]))
+    tags = list(tags)
+    for i, tag in enumerate(tags):
+        mismatch = "tag{}".format(i + 1) if i < len(tags) - 1 else "reject"
+        offset = 0
+        while offset < len(tag):
+            size = 4 if len(tag) - offset >= 4 else 2 if len(tag) - offset >= 2 else 1
+            load = {4: _LD_W_IND, 2: _LD_H_IND, 1: _LD_B_IND}[size]
+            program.append((load, None, None, _ECHO_DATA_OFFSET + offset))
+            program.append((_JEQ_K, None, mismatch, int.from_bytes(tag[offset:offset + size], "big")))
+            offset += size
+        program.append((_RET_K, None, None, 0xFFFF))
+        program.append(("label", mismatch))
+    program.append(("label", "reject"))
+    program.append((_RET_K, None, None, 0))
+    return _resolve_labels(program)
+
+
+def reject_all():
+    """
+    :return: программа, отбрасывающая все пакеты (для сокетов, которые только посылают)
+    """
+    return [(_RET_K, 0, 0, 0)]
+
+
+def _resolve_labels(program):
+    """
+    Замена меток на относительные смещения переходов
+    :type program: list
+    :param program: инструкции и метки ("label", имя)
+    :return: список инструкций (code, jt, jf, k)
+    """
+    labels = dict()
+    position = 0
+    for instruction in program:
+        if instruction[0] == "label":
+            labels[instruction[1]] = position
+        else:
+            position += 1
+    result = []
+    for instruction in program:
+        if instruction[0] == "label":
+            continue
+        code, jt, jf, k = instruction
+        position = len(result) + 1
+        jt = labels[jt] - position if jt is not None else 0
+        jf = labels[jf] - position if jf is not None else 0
+        if not (0 <= jt <= 255 and 0 <= jf <= 255):
+            raise ValueError("Слишком длинный переход в программе фильтра")
+        result.append((code, jt, jf, k))
+    return result
+
+
+def attach_filter(sock, program):
+    """
+    Установка фильтра на сокет (заменяет установленный ранее)
+    :type sock: socket.socket
+    :type program: list
+    :param sock: сырой сокет
+    :param program: список инструкций (code, jt, jf, k)
+    :return: True, если фильтр установлен
+    """
+    instructions = b"".join(struct.pack("HBBI", *instruction) for instruction in program)
+    # буфер должен жить до конца вызова setsockopt, ядро копирует программу
+    buffer = ctypes.create_string_buffer(instructions, len(instructions))
+    fprog = struct.pack("HP", len(program), ctypes.addressof(buffer))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    except OSError as e:
+        log.debug("Фильтр сокета не установлен: %s", e)
+        return False
+    log.debug("Установлен фильтр сокета из %d инструкций", len(program))
+    return True
+
+
+def detach_filter(sock):
+    """
+    Снятие фильтра с сокета
+    :type sock: socket.socket
+    :param sock: сырой сокет
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except OSError as e:
+        log.debug("Фильтр сокета не снят: %s", e)
@@ -0,0 +1,118 @@
+"""
+Контрольные точки частично принятых файлов для продолжения прерванной передачи
+
+рядом с частично принятым файлом ("*.part") в директории для входящих файлов
+хранится "*.part.checkpoint" (json) с размером файла, отпечатком содержимого
+и участками, которые уже сброшены на диск; участки записываются
+не чаще раза в CHECKPOINT_INTERVAL секунд
+"""
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# минимальный интервал между контрольными точками соединения в секундах
+CHECKPOINT_INTERVAL = 1.
+# суффикс файла контрольной точки
+SUFFIX = ".checkpoint"
+
+
+class Checkpoint:
+    """
+    Записанные участки файла: начало участка -> конец записанной части
+    """
+
+    def __init__(self, path, size, fingerprint):
+        """
+        :type path: pathlib.Path или str
+        :type size: int
+        :type fingerprint: bytes
+        :param path: путь до частично принятого файла
+        :param size: размер файла
+        :param fingerprint: отпечаток содержимого из инициализирующего сообщения
+        """
+        self.path = str(path) + SUFFIX
+        self.size = size
+        self.fingerprint = fingerprint
+        self.ranges = dict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, size, fingerprint):
+        """
+        Чтение контрольной точки частично принятого файла
+        (параметры описаны в Checkpoint)
+        :return: Checkpoint; без записанных участков, если файла или контрольной
+                 точки нет или они относятся к другому содержимому
+        """
+        checkpoint = cls(path, size, fingerprint)
+        if not os.path.isfile(str(path)):
+            return checkpoint
+        try:
+            with open(checkpoint.path, encoding="UTF-8") as file:
+                state = json.load(file)
+            if state["size"] == size and state["fingerprint"] == fingerprint.hex():
+                checkpoint.ranges = dict((int(start), int(end)) for start, end in state["ranges"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Контрольная точка %s не прочитана: %s", checkpoint.path, e)
+        return checkpoint
+
+    def resume_offset(self, offset, end):
+        """
+        Смещение, с которого продолжается приём участка
+        :type offset: int
+        :type end: int
+        :param offset: начало участка
+        :param end: конец участка
+        :return: конец записанной части, непрерывно идущей от offset (не больше end)
+        """
+        with self.lock:
+            for start, written in sorted(self.ranges.items()):
+                if start <= offset < written:
+                    offset = written
+        return min(offset, end)
+
+    def update(self, start, written):
+        """
+        Учёт записанной части участка
+        :type start: int
+        :type written: int
+        :param start: начало участка
+        :param written: конец непрерывно записанной и сброшенной на диск части
+        """
+        with self.lock:
+            if written > self.ranges.get(start, start):
+                self.ranges[start] = written
+
+    def save(self):
+        """
+        Запись контрольной точки (через временный файл, чтобы не оставить её
+        недописанной)
+        :return: True, если контрольная точка записана
+        """
+        temporary = self.path + ".tmp"
+        # полосы одного файла сохраняют контрольную точку из разных потоков
+        with self.lock:
+            state = dict(size=self.size, fingerprint=self.fingerprint.hex(),
+                         ranges=sorted(self.ranges.items()))
+            try:
+                with open(temporary, "w", encoding="UTF-8") as file:
+                    json.dump(state, file)
+                os.replace(temporary, self.path)
+                return True
+            except OSError as e:
+                log.error("Контрольная точка %s не записана: %s", self.path, e)
+                return False
+
+    def remove(self):
+        """
+        Удаление контрольной точки после приёма всего файла
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,3 +1,5 @@
+import concurrent.futures
+import hashlib
 import logging
 import socket
 import struct
@@ -12,75 +14,253 @@ from diffiehellman import diffiehellman
 import pathlib
 
 import itertools
+import collections
 
+from magicPing import bpf
+from magicPing import compression
+from magicPing import congestion
+from magicPing import cypher
+from magicPing import dedup
+from magicPing import demux
 from magicPing import icmp
+from magicPing import pmtu
+from magicPing import protocol
+from magicPing import rtt
 from magicPing import utils
+from magicPing import integrity
 
 log = logging.getLogger(__name__)
 
+# минимальное кол-во кусков в полосе: файл меньше не делится на полосы
+MIN_STRIPE_CHUNKS = 256
+# отпечаток содержимого строится по FINGERPRINT_SAMPLES участкам по FINGERPRINT_BLOCK байт
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_BLOCK = 4096
+# кол-во посылок "magic-ping-sver" без ответа, после которых
+# сервер считается не поддерживающим проверку целостности
+VERIFY_ATTEMPTS = 3
+
+
+def read_chunk(file, buffer, size):
+    """
+    Чтение куска файла в буфер, используемый повторно
+    :type file: io.BufferedReader
+    :type buffer: bytearray
+    :type size: int
+    :param file: файл, установленный на начало куска
+    :param buffer: буфер не меньше size
+    :param size: размер куска
+    :return: memoryview прочитанного куска в буфере
+    """
+    data = memoryview(buffer)[:size]
+    read = 0
+    while read < size:
+        count = file.readinto(data[read:])
+        if not count:
+            raise OSError("Файл стал короче во время передачи: {}".format(file.name))
+        read += count
+    return data
+
+
+def file_fingerprint(file, file_size):
+    """
+    Отпечаток содержимого файла, по которому сервер находит прерванную
+    передачу того же файла: sha256 от размера, времени изменения, полного пути
+    и участков, равномерно взятых по файлу (небольшой файл читается целиком,
+    большой - выборочно); изменение файла между выборочными участками
+    замечается только по времени изменения, поэтому файл, перезаписанный
+    с сохранением размера и времени изменения, не отличается от прежнего
+    :type file: io.BufferedReader
+    :type file_size: int
+    :param file: открытый файл
+    :param file_size: размер файла
+    :return: protocol.FINGERPRINT_SIZE байт
+    """
+    digest = hashlib.sha256(struct.pack("!Qq", file_size, os.fstat(file.fileno()).st_mtime_ns))
+    digest.update(os.path.abspath(file.name).encode("UTF-8", "surrogateescape"))
+    if file_size <= FINGERPRINT_SAMPLES * FINGERPRINT_BLOCK:
+        digest.update(file.read())
+    else:
+        for index in range(FINGERPRINT_SAMPLES):
+            file.seek((file_size - FINGERPRINT_BLOCK) * index // (FINGERPRINT_SAMPLES - 1))
+            digest.update(file.read(FINGERPRINT_BLOCK))
+    file.seek(0)
+    return digest.digest()[:protocol.FINGERPRINT_SIZE]
+
+
+def stripe_ranges(file_size, chunk_size, stripes):
+    """
+    Разбиение файла на участки для параллельной посылки
+    :type file_size: int
+    :type chunk_size: int
+    :type stripes: int
+    :param file_size: размер файла
+    :param chunk_size: размер куска
+    :param stripes: наибольшее кол-во участков
+    :return: список кортежей (смещение, размер); участки начинаются
+             с границы куска и не короче MIN_STRIPE_CHUNKS кусков
+    """
+    chunks = protocol.chunk_count(file_size, chunk_size)
+    stripes = max(1, min(stripes, chunks // MIN_STRIPE_CHUNKS, protocol.MAX_STRIPES))
+    stripe_chunks = max(1, chunks // stripes + (1 if chunks % stripes else 0))
+    ranges = []
+    for offset in range(0, file_size, stripe_chunks * chunk_size):
+        ranges.append((offset, min(stripe_chunks * chunk_size, file_size - offset)))
+    return ranges or [(0, file_size)]
+
 
 class Client:
     """
     Клиент, отправляющий файлы с помощью ICMP ECHO REQUEST/REPLY
     """
-    def __init__(self, max_size=1024**3 * 10, timeout=10., enable_cypher=False):
+    def __init__(self, max_size=1024**3 * 10, timeout=10., enable_cypher=False, window_size=8,
+                 demultiplexer=None, use_filter=True, chunk_size=None, rate=None, show_progress=True,
+                 stripes=1, resume=True, compress=None, dedup=False, verify=None, crc=False, init_lock=None):
         """
         Инициализация клиента
         :type max_size: int
         :type timeout: float
         :type enable_cypher: bool
+        :type window_size: int
         :param max_size: максимальный размер файла
         :param timeout: максимальное время ожидаиния ответа в секундах
         :param enable_cypher: Использование шифрования
+        :param window_size: кол-во кусков, одновременно находящихся в пути
+        :param demultiplexer: общий раздатчик пакетов (None == свой сокет на каждую посылку)
+        :param use_filter: отсеивать чужие ICMP пакеты фильтром в ядре (magicPing.bpf);
+                           используется только на собственном сокете
+        :param chunk_size: размер куска (None == подбирается по MTU пути до адресата)
+        :param rate: ограничение скорости посылки в байтах в секунду
+                     или общая с другими клиентами congestion.TokenBucket (None == без ограничения)
+        :param show_progress: выводить строку состояния передачи
+        :param stripes: кол-во участков большого файла, посылаемых параллельно
+                        отдельными сеансами (1 == одним сеансом)
+        :param resume: продолжать прерванную передачу того же файла с места обрыва
+        :param compress: алгоритм сжатия кусков из magicPing.compression.CODECS
+                         (None == без сжатия)
+        :param dedup: посылать только блоки, которых нет на сервере
+                      (прерванная передача при этом не продолжается)
+        :param verify: алгоритм хеша из magicPing.integrity.ALGORITHMS для проверки
+                       целостности принятого файла (None == без проверки)
+        :param crc: посылать CRC32 каждого куска (повреждённые куски посылаются повторно)
+        :param init_lock: блокировка, под которой идёт обмен инициализирующими сообщениями;
+                          общая для передач через один раздатчик, ответы которым
+                          не различить по концу сообщения (magicPing.batch)
         """
         log.debug("Инициализация клиента")
-        log.debug("Максимальный размер файла: %s; таймаут: %s",
-                  max_size, timeout)
+        log.debug("Максимальный размер файла: %s; таймаут: %s; размер окна: %s",
+                  max_size, timeout, window_size)
         self.max_size = max_size
         self.timeout = timeout
         self.enable_cypher = enable_cypher
+        self.window_size = max(1, min(window_size, protocol.MAX_WINDOW_SIZE))
         self.iteration = threading.Semaphore(0)
         self.runnable = threading.Event()
         self.runnable.set()
         self.sock = None
+        self.demultiplexer = demultiplexer
+        self.use_filter = use_filter
+        self.show_progress = show_progress
+        self.stripes = max(1, min(stripes, protocol.MAX_STRIPES))
+        self.resume = resume
+        if compress is not None and compress not in compression.CODECS:
+            raise ValueError("Неизвестный алгоритм сжатия: {}".format(compress))
+        self.compress = compress
+        self.dedup = dedup
+        if verify is not None and verify not in integrity.ALGORITHMS:
+            raise ValueError("Неизвестный алгоритм хеша: {}".format(verify))
+        self.verify = verify
+        self.crc = crc
+        self.init_lock = init_lock
+        # в куске должен остаться хотя бы один байт данных после смещения,
+        # байта способа кодирования и CRC32
+        min_chunk_size = (protocol.OFFSET_SIZE + (protocol.MODE_SIZE if compress is not None else 0) +
+                          (protocol.CRC_SIZE if crc else 0) + 1)
+        self.chunk_size = max(min_chunk_size, min(chunk_size, protocol.CHUNK_SIZE)) if chunk_size else None
+        # сервер принял CRC32 кусков текущего сеанса
+        self.use_crc = False
+        # итоги сжатия текущего файла (общие для его полос)
+        self.compression_stats = None
+        if rate is None or isinstance(rate, congestion.TokenBucket):
+            self.rate_limiter = rate
+        else:
+            self.rate_limiter = congestion.TokenBucket(rate)
+        # фильтр установлен на собственный сокет и его можно сузить до id сеанса
+        self.session_filter = False
         self.key = None
+        self.cypher = None
         log.debug("Инициализация клиента завершена")
 
-    def send_magic_init(self, ip, filename, file_size):
+    def send_magic_init(self, ip, filename, file_size, chunk_size=protocol.CHUNK_SIZE, stripe=None, flags=0,
+                        fingerprint=None, codec=None):
         """
         посылка инициализирующего сообщения
         :type ip: str
         :type filename: str
         :type file_size: int
+        :type chunk_size: int
+        :type stripe: tuple или None
         :param ip: ip адресата
         :param filename: имя файла
         :param file_size: размер файла
-        :return: кортеж: (id сеанса передачи файла, код ошибки)
+        :param chunk_size: размер куска
+        :param stripe: кортеж (смещение участка, размер участка, кол-во полос)
+                       или None, если файл посылается одним сеансом
+        :param flags: запрашиваемые флаги из protocol.NEGOTIATED_FLAGS
+        :param fingerprint: отпечаток содержимого для продолжения прерванной передачи
+        :param codec: номер алгоритма сжатия кусков или None
+        :return: кортеж: (id сеанса передачи файла, код ошибки,
+                          запрошенные флаги, подтверждённые сервером,
+                          смещение для продолжения передачи или None)
         """
         log.debug("Посылка инициализирующего сообщения")
+        requested_flags = flags | (protocol.FLAG_RESUME if fingerprint is not None else 0)
+        requested_flags |= protocol.FLAG_COMPRESS if codec is not None else 0
+        bytes_filename = bytes(filename, "UTF-8")
+        estimator = rtt.estimator(ip)
+        attempts = 0
+        # ответы полосам одного файла различаются смещением участка
+        reply_suffix = bytes_filename if stripe is None else struct.pack("!Q", stripe[0]) + bytes_filename
+        if self.init_lock is not None:
+            self.init_lock.acquire()
+        waiter = self.demultiplexer.subscribe(ip, None, 0, b'magic-ping-rini', reply_suffix)
         try:
-            bytes_filename = bytes(filename, "UTF-8")
             if self.timeout is not None:
                 start = time.time()
             sock_timeout = self.timeout
             while self.timeout is None or sock_timeout > 0:
                 try:
-                    flags = 1 if self.enable_cypher else 0
+                    flags = requested_flags
+                    if self.window_size > 1:
+                        # при посылке с ожиданием каждого подтверждения
+                        # отложенные подтверждения только замедляют передачу
+                        flags |= protocol.FLAG_SACK
+                    if self.enable_cypher:
+                        flags |= protocol.FLAG_CYPHER
                     icmp.send_echo_request(self.sock, ip, 0, 0,
-                                           b'magic-ping-sini' + struct.pack("!B", flags) +
-                                           struct.pack("!Q", file_size) +
-                                           bytes_filename)
-                    _, icmp_id, _, data =\
-                        icmp.receive_echo_reply(self.sock, ip, None, 0,
-                                                sock_timeout / 2 if sock_timeout is not None else 1,
-                                                b'magic-ping-rini', bytes_filename)
-                    return icmp_id, data[15]
+                                           b'magic-ping-sini' +
+                                           protocol.pack_init(flags, file_size, bytes_filename,
+                                                              chunk_size, stripe, fingerprint, codec))
+                    sent_time = time.time()
+                    attempts += 1
+                    _, icmp_id, _, data = waiter.receive(self.retry_timeout(estimator, sock_timeout))
+                    if attempts == 1:
+                        # правило Карна: ответ на повторную посылку не замеряется
+                        estimator.sample(time.time() - sent_time)
+                    err, accepted_flags, resume_offset = protocol.unpack_init_reply(
+                        data[15:], requested_flags, len(reply_suffix))
+                    return icmp_id, err, accepted_flags, resume_offset
                 except socket.timeout:
-                    pass
+                    estimator.backoff()
+                except ValueError as e:
+                    log.warning("%s: ip: %s", e, ip)
                 if self.timeout is not None:
                     sock_timeout = start - time.time() + self.timeout
             raise socket.timeout
         finally:
+            waiter.close()
+            if self.init_lock is not None:
+                self.init_lock.release()
             log.debug("Посылка инициализирующего сообщения завершена")
 
     def create_cypher_key(self, ip, icmp_id):
@@ -95,62 +275,305 @@ class Client:
         log.debug("Начат обмен ключами")
         generator = diffiehellman.DiffieHellman(key_length=2048)
         generator.generate_public_key()
-        if self.timeout is not None:
-            start = time.time()
-        sock_timeout = self.timeout
-        while self.timeout is None or sock_timeout > 0:
-            try:
-                icmp.send_echo_request(self.sock, ip, icmp_id, 0,
-                                       b'magic-ping-skey' +
-                                       generator.public_key.to_bytes(int(math.log2(generator.public_key)) + 1,
-                                                                     byteorder="big"))
-                _, _, _, data = icmp.receive_echo_reply(self.sock, ip, icmp_id, 0,
-                                                        sock_timeout / 2 if sock_timeout is not None else 1,
-                                                        b'magic-ping-rkey')
-                generator.generate_shared_secret(int.from_bytes(data[15:], "big"))
-                return bytearray.fromhex(generator.shared_key)
-            except socket.timeout:
-                pass
+        # ответ задерживается генерацией ключа на сервере, поэтому не замеряется
+        estimator = rtt.estimator(ip)
+        with self.demultiplexer.subscribe(ip, icmp_id, 0, b'magic-ping-rkey') as waiter:
             if self.timeout is not None:
-                sock_timeout = start - time.time() + self.timeout
-        log.debug("Обмен ключами завершён")
+                start = time.time()
+            sock_timeout = self.timeout
+            while self.timeout is None or sock_timeout > 0:
+                try:
+                    icmp.send_echo_request(self.sock, ip, icmp_id, 0,
+                                           b'magic-ping-skey' +
+                                           generator.public_key.to_bytes(int(math.log2(generator.public_key)) + 1,
+                                                                         byteorder="big"))
+                    _, _, _, data = waiter.receive(self.retry_timeout(estimator, sock_timeout))
+                    generator.generate_shared_secret(int.from_bytes(data[15:], "big"))
+                    log.debug("Обмен ключами завершён")
+                    return bytearray.fromhex(generator.shared_key)
+                except socket.timeout:
+                    estimator.backoff()
+                if self.timeout is not None:
+                    sock_timeout = start - time.time() + self.timeout
         raise socket.timeout
 
-    def send_magic_data(self, ip, icmp_id, sequence_num, data):
+    @staticmethod
+    def retry_timeout(estimator, remaining=None):
+        """
+        Время ожидания ответа перед повторной посылкой
+        :type estimator: magicPing.rtt.RttEstimator
+        :type remaining: float или None
+        :param estimator: оценка RTT адресата
+        :param remaining: оставшееся время ожидания сеанса (None == не ограничено)
+        :return: таймаут в секундах
+        """
+        timeout = estimator.timeout()
+        return min(timeout, remaining) if remaining is not None else timeout
+
+    def send_magic_data(self, ip, icmp_id, sequence_num, data, offset=None, mode=None):
         """
-        Посылка куска сообщения
+        Посылка куска сообщения без ожидания подтверждения
         :type ip: str
         :type icmp_id: int
         :type sequence_num: int
         :type data: bytes или memoryview
+        :type offset: int или None
+        :type mode: int или None
         :param ip: адресат
         :param icmp_id: id сеанса передачи файла
         :param sequence_num: номер куска сообщения
-        :param data: данные для передачи
+        :param data: данные для передачи (уже сжатые и зашифрованные)
+        :param offset: смещение куска в файле (только при protocol.FLAG_OFFSET)
+        :param mode: способ кодирования куска (только при protocol.FLAG_COMPRESS)
         :return: None
         """
-        log.debug("Посылка куска данных")
-        try:
-            if self.timeout is not None:
-                start = time.time()
-            sock_timeout = self.timeout
-            if self.enable_cypher:
-                data = bytes([a ^ b for a, b in zip(data, itertools.cycle(self.key))])
-            while self.timeout is None or sock_timeout > 0:
+        log.debug("Посылка куска данных: seq_num: %d", sequence_num)
+        header = b''
+        if offset is not None:
+            header += struct.pack("!Q", offset)
+        if mode is not None:
+            header += struct.pack("!B", mode)
+        if self.use_crc:
+            # CRC32 покрывает смещение, способ кодирования и данные
+            header = struct.pack("!I", integrity.chunk_crc(header, data)) + header
+        parts = (b'magic-ping-send', header, data) if header else (b'magic-ping-send', data)
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(pmtu.PACKET_OVERHEAD + sum(len(part) for part in parts[1:]))
+        # метка и кусок не склеиваются, кусок может быть участком отображённого файла
+        icmp.send_echo(self.sock, ip, 8, icmp_id, sequence_num, *parts)
+
+    def send_magic_window(self, ip, icmp_id, file, file_size, chunk_size=protocol.CHUNK_SIZE,
+                          range_offset=0, range_size=None, use_offset=False, first_chunk=0, codec=None,
+                          chunk_map=None, verifier=None):
+        """
+        Посылка файла скользящим окном:
+        в пути одновременно находится до self.window_size кусков,
+        повторно посылаются только куски, подтверждение которых не пришло
+        :type ip: str
+        :type icmp_id: int
+        :type file: io.BufferedReader
+        :type file_size: int
+        :type range_offset: int
+        :type range_size: int или None
+        :param ip: адресат
+        :param icmp_id: id сеанса передачи файла
+        :param file: файл для передачи
+        :param file_size: размер файла
+        :param chunk_size: размер куска
+        :param range_offset: смещение посылаемого участка файла
+        :param range_size: размер участка (None == до конца файла)
+        :param use_offset: посылать смещение каждого куска (protocol.FLAG_OFFSET)
+        :param first_chunk: номер первого посылаемого куска участка
+                            (предыдущие приняты сервером до обрыва передачи)
+        :param codec: алгоритм сжатия кусков, подтверждённый сервером, или None
+        :param chunk_map: dedup.ChunkMap с кусками, которых нет на сервере
+                          (None == посылаются все куски участка)
+        :param verifier: integrity.StreamHash участка, в который добавляются
+                         прочитанные куски
+        :return: None
+        """
+        log.debug("Посылка данных окном: размер окна: %d", self.window_size)
+        if range_size is None:
+            range_size = file_size - range_offset
+        range_end = range_offset + range_size
+        file.seek(range_offset + first_chunk * chunk_size)
+        total_iterations = protocol.chunk_count(range_size, chunk_size) if chunk_map is None else chunk_map.count
+        estimator = rtt.estimator(ip)
+        # кол-во кусков в пути ограничено и размером окна, и окном перегрузки
+        congestion_window = congestion.CongestionWindow(self.window_size, estimator)
+        # seq_num -> [данные, время последней посылки, посылался повторно, смещение или None,
+        #            способ кодирования или None, буфер куска]
+        outstanding = collections.OrderedDict()
+        # буферы подтверждённых кусков: кусков в пути не больше окна,
+        # поэтому память под куски не выделяется при каждом чтении
+        free_buffers = []
+        next_chunk = first_chunk
+        acked = first_chunk
+        last_progress = time.time()
+        # последнее накопительное подтверждение и кол-во его повторов
+        last_cumulative = None
+        duplicate_acks = 0
+        with self.demultiplexer.subscribe(ip, icmp_id, None, b'magic-ping-') as waiter:
+            while acked < total_iterations:
+                while len(outstanding) < congestion_window.size() and next_chunk < total_iterations:
+                    if chunk_map is None:
+                        offset = range_offset + next_chunk * chunk_size
+                    else:
+                        # куски нумеруются подряд, но идут в файле с пропусками
+                        offset = range_offset + chunk_map.chunk(next_chunk) * chunk_size
+                        file.seek(offset)
+                    buffer = free_buffers.pop() if free_buffers else bytearray(chunk_size)
+                    data = read_chunk(file, buffer, min(chunk_size, range_end - offset))
+                    if verifier is not None:
+                        verifier.update(offset, data)
+                    mode = None
+                    if codec is not None:
+                        size = len(data)
+                        mode, data = compression.encode_chunk(codec, data)
+                        if self.compression_stats is not None:
+                            self.compression_stats.add(size, mode, len(data))
+                    if self.cypher is not None and data:
+                        data = self.cypher.xor(data)
+                    seq_num = next_chunk % protocol.SEQ_SPACE
+                    if not use_offset:
+                        offset = None
+                    self.send_magic_data(ip, icmp_id, seq_num, data, offset, mode)
+                    outstanding[seq_num] = [data, time.time(), False, offset, mode, buffer]
+                    next_chunk += 1
+                now = time.time()
+                retry_timeout = estimator.timeout()
+                # куски упорядочены по времени последней посылки
+                wait = next(iter(outstanding.values()))[1] + retry_timeout - now
                 try:
-                    icmp.send_echo_request(self.sock, ip, icmp_id, sequence_num, b'magic-ping-send' + data)
-                    _, _, _, data = \
-                        icmp.receive_echo_reply(self.sock, ip, icmp_id, sequence_num,
-                                                sock_timeout / 2 if sock_timeout is not None else 1,
-                                                b'magic-ping-recv' + data[-1:])
-                    return
+                    _, _, seq_num, reply = waiter.receive(max(wait, 0.001))
+                    if reply[:15] == b'magic-ping-recv':
+                        entry = outstanding.get(seq_num)
+                        # у нулевого куска нет данных, последний байт пакета - способ кодирования
+                        confirmed = [seq_num] if entry is not None and reply[15:] == (
+                            entry[0][-1:] or struct.pack("!B", entry[4])) else []
+                    elif reply[:15] == b'magic-ping-sack' and len(reply) >= 17:
+                        cumulative, confirmed = protocol.unpack_sack(reply[15:])
+                        confirmed.extend(seq for seq in outstanding
+                                         if 0 < protocol.seq_delta(cumulative, seq) <= protocol.MAX_WINDOW_SIZE)
+                        if cumulative == last_cumulative and cumulative in outstanding:
+                            duplicate_acks += 1
+                            if duplicate_acks == 3:
+                                # быстрая повторная посылка потерянного куска: один раз,
+                                # остальные повторы - подтверждения кусков, посланных до неё;
+                                # потерю повторной посылки обнаружит таймаут
+                                congestion_window.on_loss(False)
+                                log.debug("Повторная посылка куска данных: seq_num: %d", cumulative)
+                                entry = outstanding[cumulative]
+                                self.send_magic_data(ip, icmp_id, cumulative, entry[0], entry[3], entry[4])
+                                entry[1] = time.time()
+                                entry[2] = True
+                                outstanding.move_to_end(cumulative)
+                        else:
+                            last_cumulative = cumulative
+                            duplicate_acks = 0
+                    else:
+                        confirmed = []
+                    now = time.time()
+                    newly_acked = 0
+                    for seq in confirmed:
+                        entry = outstanding.pop(seq, None)
+                        if entry is not None:
+                            free_buffers.append(entry[5])
+                            newly_acked += 1
+                            last_progress = now
+                            if not entry[2]:
+                                estimator.sample(now - entry[1])
+                    if newly_acked:
+                        acked += newly_acked
+                        congestion_window.on_ack(newly_acked)
+                    if confirmed and self.show_progress:
+                        utils.print_progress_bar(acked, total_iterations)
                 except socket.timeout:
                     pass
-                if self.timeout is not None:
-                    sock_timeout = start - time.time() + self.timeout
-            raise socket.timeout
-        finally:
-            log.debug("Посылка куска данных завершена")
+                now = time.time()
+                if self.timeout is not None and now - last_progress > self.timeout:
+                    raise socket.timeout
+                expired = list(itertools.takewhile(lambda item: now - item[1][1] >= retry_timeout,
+                                                   outstanding.items()))
+                if expired:
+                    estimator.backoff()
+                    congestion_window.on_loss(True)
+                for seq_num, entry in expired:
+                    log.debug("Повторная посылка куска данных: seq_num: %d", seq_num)
+                    self.send_magic_data(ip, icmp_id, seq_num, entry[0], entry[3], entry[4])
+                    entry[1] = now
+                    entry[2] = True
+                    outstanding.move_to_end(seq_num)
+        log.info("Управление перегрузкой: %s", congestion_window)
+        log.debug("Посылка данных окном завершена")
+
+    def send_manifest(self, ip, icmp_id, file, file_size, chunk_size, range_offset, range_size, verifier=None):
+        """
+        Посылка хешей блоков участка; сервер отвечает, какие блоки у него уже есть
+        (параметры описаны в send_magic_window; прочитанные блоки добавляются в verifier,
+        так что не посылаемые блоки не приходится читать ещё раз)
+        :return: dedup.ChunkMap с кусками, которые нужно послать
+        """
+        log.debug("Посылка списка блоков")
+        blocks = dedup.manifest_blocks(range_offset, range_size, file_size)
+        # блок хешируется сразу после чтения, поэтому буфер один
+        buffer = bytearray(protocol.DEDUP_BLOCK_SIZE)
+        # часть списка не больше куска
+        part_size = max(1, chunk_size // protocol.HASH_SIZE)
+        parts = collections.OrderedDict()
+        for first_block in range(blocks.start, blocks.stop, part_size):
+            hashes = b''
+            for block in range(first_block, min(first_block + part_size, blocks.stop)):
+                offset, size = dedup.block_span(block, file_size)
+                file.seek(offset)
+                data = read_chunk(file, buffer, size)
+                hashes += dedup.block_hash(data)
+                if verifier is not None:
+                    verifier.update(offset, data)
+            if self.cypher is not None:
+                hashes = self.cypher.xor(hashes)
+            parts[first_block] = protocol.pack_manifest(first_block, hashes)
+        present = self.exchange_manifest(ip, icmp_id, parts)
+        # пустая часть завершает список; до её подтверждения данные не посылаются
+        self.exchange_manifest(ip, icmp_id, {blocks.stop: protocol.pack_manifest(blocks.stop, b'')})
+        present.intersection_update(blocks)
+        chunk_map = dedup.ChunkMap(range_offset, range_size, chunk_size, present, file_size)
+        log.info("Дедупликация: блоков: %d; есть на сервере: %d; не посылается: %d байт",
+                 len(blocks), len(present), chunk_map.skipped_size())
+        return chunk_map
+
+    def exchange_manifest(self, ip, icmp_id, parts):
+        """
+        Посылка частей списка блоков окном до получения ответа на каждую
+        :type ip: str
+        :type icmp_id: int
+        :type parts: dict
+        :param ip: адресат
+        :param icmp_id: id сеанса передачи файла
+        :param parts: номер первого блока части -> тело "magic-ping-sman"
+        :return: множество номеров блоков, найденных на сервере
+        """
+        estimator = rtt.estimator(ip)
+        present = set()
+        queue = collections.deque(parts.items())
+        # номер первого блока -> [тело, время последней посылки, посылалась повторно]
+        outstanding = collections.OrderedDict()
+        last_progress = time.time()
+        with self.demultiplexer.subscribe(ip, icmp_id, None, b'magic-ping-rman') as waiter:
+            while queue or outstanding:
+                while queue and len(outstanding) < self.window_size:
+                    first_block, body = queue.popleft()
+                    icmp.send_echo_request(self.sock, ip, icmp_id, 0, b'magic-ping-sman' + body)
+                    outstanding[first_block] = [body, time.time(), False]
+                retry_timeout = estimator.timeout()
+                wait = next(iter(outstanding.values()))[1] + retry_timeout - time.time()
+                try:
+                    _, _, _, reply = waiter.receive(max(wait, 0.001))
+                    first_block, found = protocol.unpack_manifest_reply(reply[15:])
+                    entry = outstanding.pop(first_block, None)
+                    if entry is not None:
+                        last_progress = time.time()
+                        if not entry[2]:
+                            estimator.sample(last_progress - entry[1])
+                        present.update(found)
+                except socket.timeout:
+                    pass
+                except ValueError as e:
+                    log.warning("%s: ip: %s", e, ip)
+                now = time.time()
+                if self.timeout is not None and now - last_progress > self.timeout:
+                    raise socket.timeout
+                expired = list(itertools.takewhile(lambda item: now - item[1][1] >= retry_timeout,
+                                                   outstanding.items()))
+                if expired:
+                    estimator.backoff()
+                for first_block, entry in expired:
+                    log.debug("Повторная посылка части списка блоков: блок: %d", first_block)
+                    icmp.send_echo_request(self.sock, ip, icmp_id, 0, b'magic-ping-sman' + entry[0])
+                    entry[1] = now
+                    entry[2] = True
+                    outstanding.move_to_end(first_block)
+        return present
 
     def send(self, filename, dest, enable_cypher=None):
         """
@@ -161,33 +584,291 @@ class Client:
         :param filename: имя файла
         :param dest: адресат
         :param enable_cypher: использование шифрования (None == self.enable_cypher)
-        :return: None
+        :return: True, если файл доставлен
         """
+        if self.demultiplexer is not None:
+            # сокет и раздатчик пакетов общие с другими передачами
+            self.sock = self.demultiplexer.sock
+            try:
+                return self.send_file(filename, dest, enable_cypher)
+            finally:
+                self.sock = None
         with socket.socket(socket.AF_INET, socket.SOCK_RAW,
                            socket.IPPROTO_ICMP) as sock:
             self.sock = sock
-            log.info("Посылка файла \"%s\"; назначение: %s", filename, dest)
-            file = open(filename, "rb")
-            file_size = os.stat(filename).st_size
+            # в буфер попадают и собственные запросы, и ответы на них;
+            # у полос окна свои, но буфер не больше серверного
+            icmp.set_receive_buffer(sock, max(4 * self.window_size * protocol.CHUNK_SIZE,
+                                              min(4 * self.window_size * self.stripes * protocol.CHUNK_SIZE,
+                                                  protocol.RECEIVE_BUFFER_SIZE)))
+            if self.use_filter:
+                # ответы сервера без эха собственных запросов от ядра
+                self.session_filter = bpf.attach_filter(sock, bpf.echo_filter([0], bpf.REPLY_TAGS))
+            self.demultiplexer = demux.Demultiplexer(sock)
             try:
-                icmp_id, err = self.send_magic_init(dest, pathlib.PurePath(filename).name, file_size)
-                enable_cypher = enable_cypher if enable_cypher is not None else self.enable_cypher
-                if err != 0:
-                    log.error("Сервер вернул ошибку: %d", err)
-                    return
-                if enable_cypher:
-                    self.key = self.create_cypher_key(dest, icmp_id)
-                seq_num = 0
-                total_iterations = file_size // 65492 + (1 if file_size % 65492 else 0)
-                for i in range(total_iterations):
-                    utils.print_progress_bar(i, total_iterations)
-                    data = file.read(65492)
-                    self.send_magic_data(dest, icmp_id, seq_num, data)
-                    seq_num = (seq_num + 1) % 65536
-                else:
-                    utils.print_progress_bar(total_iterations, total_iterations)
-            except socket.timeout:
-                log.error("Превышено время ожидания ответа от сервера: ip: %s", dest)
+                with self.demultiplexer:
+                    return self.send_file(filename, dest, enable_cypher)
             finally:
-                log.info("Посылка файла завершена")
+                self.demultiplexer = None
                 self.sock = None
+                self.session_filter = False
+
+    def send_file(self, filename, dest, enable_cypher=None):
+        """
+        Посылка файла через уже открытый сокет self.sock
+        и запущенный раздатчик пакетов self.demultiplexer
+        (параметры описаны в send)
+        :return: True, если файл доставлен
+        """
+        log.info("Посылка файла \"%s\"; назначение: %s", filename, dest)
+        file_size = os.stat(filename).st_size
+        enable_cypher = enable_cypher if enable_cypher is not None else self.enable_cypher
+        try:
+            # адресат разрешается один раз за сеанс
+            ip = socket.inet_ntoa(icmp.resolve_address(dest))
+            chunk_size = self.chunk_size or pmtu.probe_chunk_size(self.demultiplexer, ip)
+            if self.compress is not None:
+                # байт способа кодирования занимает часть куска, чтобы пакет не стал больше
+                chunk_size = max(1, chunk_size - protocol.MODE_SIZE)
+                self.compression_stats = compression.CompressionStats(compression.CODECS[self.compress])
+            if self.crc:
+                # CRC32 тоже занимает часть куска
+                chunk_size = max(1, chunk_size - protocol.CRC_SIZE)
+            ranges = stripe_ranges(file_size, chunk_size, self.stripes)
+            fingerprint = None
+            if self.resume and not self.dedup:
+                with open(filename, "rb") as file:
+                    fingerprint = file_fingerprint(file, file_size)
+            if len(ranges) > 1:
+                delivered = self.send_stripes(ip, filename, file_size, chunk_size, enable_cypher, ranges,
+                                              fingerprint)
+            else:
+                with open(filename, "rb") as file:
+                    delivered = self.send_range(ip, filename, file, file_size, chunk_size, enable_cypher,
+                                                fingerprint=fingerprint)
+            if delivered:
+                log.info("RTT до %s: %s", ip, rtt.estimator(ip))
+                if self.compression_stats is not None and self.compression_stats.raw_bytes:
+                    self.compression_stats.finish()
+                    log.info("Сжатие: %s", self.compression_stats)
+            return delivered
+        except socket.timeout:
+            log.error("Превышено время ожидания ответа от сервера: ip: %s", dest)
+            return False
+        finally:
+            self.compression_stats = None
+            log.info("Посылка файла завершена")
+
+    def send_range(self, ip, filename, file, file_size, chunk_size, enable_cypher, stripe=None, fingerprint=None):
+        """
+        Посылка файла или его участка одним сеансом
+        :type ip: str
+        :type filename: str
+        :type file: io.BufferedReader
+        :type file_size: int
+        :type chunk_size: int
+        :type enable_cypher: bool
+        :type stripe: tuple или None
+        :param ip: адресат
+        :param filename: путь до файла
+        :param file: открытый файл
+        :param file_size: размер файла
+        :param chunk_size: размер куска
+        :param enable_cypher: использование шифрования
+        :param stripe: кортеж (смещение участка, размер участка, кол-во полос)
+                       или None, если посылается весь файл
+        :param fingerprint: отпечаток содержимого из file_fingerprint
+                            (None == прерванная передача не продолжается)
+        :return: True, если данные доставлены
+        """
+        range_offset, range_size = stripe[:2] if stripe is not None else (0, file_size)
+        flags = protocol.FLAG_DEDUP if self.dedup else 0
+        if protocol.chunk_count(range_size, chunk_size) > protocol.SEQ_SPACE or self.dedup:
+            # номера кусков повторяются (или куски идут с пропусками):
+            # куски посылаются со смещением, которое занимает часть куска,
+            # чтобы пакет не стал больше
+            flags |= protocol.FLAG_OFFSET
+            chunk_size = min(chunk_size, protocol.CHUNK_SIZE) - protocol.OFFSET_SIZE
+        codec = compression.CODECS[self.compress] if self.compress is not None else None
+        icmp_id, err, flags, resume_offset = self.send_magic_init(ip, pathlib.PurePath(filename).name, file_size,
+                                                                  chunk_size, stripe, flags, fingerprint, codec)
+        if err != 0:
+            log.error("Сервер вернул ошибку: %d", err)
+            return False
+        if codec is not None and not flags & protocol.FLAG_COMPRESS:
+            log.warning("Сервер не поддерживает сжатие %s, куски посылаются без сжатия: ip: %s",
+                        self.compress, ip)
+            codec = None
+        if self.dedup and not flags & protocol.FLAG_DEDUP:
+            log.warning("Сервер не поддерживает дедупликацию, посылается весь файл: ip: %s", ip)
+        first_chunk = 0
+        if resume_offset is not None and resume_offset > range_offset:
+            # сервер уже принял начало участка до обрыва передачи
+            first_chunk = protocol.chunk_count(min(resume_offset, range_offset + range_size) - range_offset,
+                                               chunk_size)
+            log.info("Передача продолжена: ip: %s; принято ранее: %d байт", ip, resume_offset - range_offset)
+            if first_chunk >= protocol.chunk_count(range_size, chunk_size):
+                return True
+        if self.session_filter:
+            bpf.attach_filter(self.sock, bpf.echo_filter([0], bpf.REPLY_TAGS, icmp_id))
+        try:
+            if enable_cypher:
+                self.key = self.create_cypher_key(ip, icmp_id)
+                self.cypher = cypher.Cypher(self.key)
+            verifier = None
+            if (self.verify is not None or self.crc) and range_size > 0:
+                verifier = self.request_verify(ip, icmp_id, filename, range_offset, range_size)
+                if verifier is not None:
+                    # принятое сервером до обрыва передачи дочитывается из файла
+                    verifier.skip(range_offset, first_chunk * chunk_size)
+            chunk_map = None
+            if flags & protocol.FLAG_DEDUP and range_size > 0:
+                chunk_map = self.send_manifest(ip, icmp_id, file, file_size, chunk_size, range_offset, range_size,
+                                               verifier)
+            if chunk_map is None or chunk_map.count > 0:
+                self.send_magic_window(ip, icmp_id, file, file_size, chunk_size, range_offset, range_size,
+                                       bool(flags & protocol.FLAG_OFFSET), first_chunk, codec, chunk_map,
+                                       verifier)
+            if verifier is not None:
+                return self.send_final(ip, icmp_id, verifier, range_offset, range_size)
+        finally:
+            self.cypher = None
+            self.use_crc = False
+        return True
+
+    def request_verify(self, ip, icmp_id, filename, range_offset, range_size):
+        """
+        Запрос проверки целостности до посылки данных; если сервер не отвечает
+        VERIFY_ATTEMPTS раз, участок посылается без проверки
+        :type ip: str
+        :type icmp_id: int
+        :type filename: str
+        :type range_offset: int
+        :type range_size: int
+        :param ip: адресат
+        :param icmp_id: id сеанса передачи файла
+        :param filename: путь до файла
+        :param range_offset: смещение участка
+        :param range_size: размер участка
+        :return: integrity.StreamHash участка или None, если хеш сервером не принят;
+                 self.use_crc выставляется, если сервер принял CRC32 кусков
+        """
+        options = integrity.ALGORITHMS[self.verify] if self.verify is not None else 0
+        if self.crc:
+            options |= protocol.VERIFY_CRC
+        estimator = rtt.estimator(ip)
+        accepted = None
+        with self.demultiplexer.subscribe(ip, icmp_id, 0, b'magic-ping-rver') as waiter:
+            for attempt in range(VERIFY_ATTEMPTS):
+                icmp.send_echo_request(self.sock, ip, icmp_id, 0, b'magic-ping-sver' + struct.pack("!B", options))
+                sent_time = time.time()
+                try:
+                    _, _, _, data = waiter.receive(self.retry_timeout(estimator))
+                except socket.timeout:
+                    estimator.backoff()
+                    continue
+                if attempt == 0:
+                    estimator.sample(time.time() - sent_time)
+                accepted = data[15] if len(data) > 15 else 0
+                break
+        if accepted is None:
+            log.warning("Сервер не поддерживает проверку целостности, файл посылается без неё: ip: %s", ip)
+            return None
+        self.use_crc = bool(accepted & options & protocol.VERIFY_CRC)
+        if self.crc and not self.use_crc:
+            log.warning("Сервер не принял CRC32 кусков: ip: %s", ip)
+        if self.verify is None:
+            return None
+        if accepted & protocol.VERIFY_ALGORITHM_MASK != options & protocol.VERIFY_ALGORITHM_MASK:
+            log.warning("Сервер не поддерживает хеш %s, файл посылается без проверки: ip: %s", self.verify, ip)
+            return None
+        return integrity.StreamHash(options & protocol.VERIFY_ALGORITHM_MASK, filename, range_offset, range_size)
+
+    def send_final(self, ip, icmp_id, verifier, range_offset, range_size):
+        """
+        Посылка хеша участка после подтверждения всех кусков
+        и получение результата сравнения с хешем, посчитанным сервером при записи
+        :type ip: str
+        :type icmp_id: int
+        :type verifier: integrity.StreamHash
+        :type range_offset: int
+        :type range_size: int
+        :param ip: адресат
+        :param icmp_id: id сеанса передачи файла
+        :param verifier: хеш участка
+        :param range_offset: смещение участка
+        :param range_size: размер участка
+        :return: True, если хеши совпали
+        """
+        digest = verifier.digest()
+        if digest is None:
+            log.error("Хеш файла не посчитан: ip: %s; участок: %d+%d", ip, range_offset, range_size)
+            return False
+        body = self.cypher.xor(digest) if self.cypher is not None else digest
+        # ответ задерживается ожиданием записи на сервере, поэтому не замеряется
+        estimator = rtt.estimator(ip)
+        with self.demultiplexer.subscribe(ip, icmp_id, 0, b'magic-ping-rfin') as waiter:
+            if self.timeout is not None:
+                start = time.time()
+            sock_timeout = self.timeout
+            while self.timeout is None or sock_timeout > 0:
+                icmp.send_echo_request(self.sock, ip, icmp_id, 0, b'magic-ping-sfin' + body)
+                try:
+                    _, _, _, data = waiter.receive(self.retry_timeout(estimator, sock_timeout))
+                    break
+                except socket.timeout:
+                    estimator.backoff()
+                if self.timeout is not None:
+                    sock_timeout = start - time.time() + self.timeout
+            else:
+                raise socket.timeout
+        status = data[15] if len(data) > 15 else protocol.VERIFY_ERROR
+        if status == protocol.VERIFY_OK:
+            log.info("Целостность подтверждена сервером: ip: %s; участок: %d+%d; %s: %s; дочитано: %d байт",
+                     ip, range_offset, range_size, integrity.algorithm_name(verifier.algorithm), digest.hex(),
+                     verifier.reread)
+            return True
+        if status == protocol.VERIFY_MISMATCH:
+            log.error("Хеш принятого сервером участка не совпал: ip: %s; участок: %d+%d",
+                      ip, range_offset, range_size)
+        else:
+            log.error("Сервер не посчитал хеш участка: ip: %s; участок: %d+%d", ip, range_offset, range_size)
+        return False
+
+    def send_stripes(self, ip, filename, file_size, chunk_size, enable_cypher, ranges, fingerprint=None):
+        """
+        Параллельная посылка участков файла отдельными сеансами;
+        сервер собирает их в один файл
+        (параметры описаны в send_range)
+        :type ranges: list
+        :param ranges: участки файла из stripe_ranges
+        :return: True, если доставлены все участки
+        """
+        log.info("Посылка файла полосами: кол-во полос: %d", len(ranges))
+        with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+            futures = [executor.submit(self.send_stripe, ip, filename, file_size, chunk_size, enable_cypher,
+                                       (offset, size, len(ranges)), fingerprint)
+                       for offset, size in ranges]
+            return all(future.result() for future in futures)
+
+    def send_stripe(self, ip, filename, file_size, chunk_size, enable_cypher, stripe, fingerprint=None):
+        """
+        Посылка одного участка файла отдельным клиентом
+        на общем сокете и раздатчике пакетов
+        (параметры описаны в send_range)
+        :return: True, если участок доставлен
+        """
+        stripe_client = Client(self.max_size, self.timeout, enable_cypher, self.window_size,
+                               self.demultiplexer, self.use_filter, self.chunk_size, self.rate_limiter,
+                               show_progress=False, compress=self.compress, dedup=self.dedup,
+                               verify=self.verify, crc=self.crc)
+        stripe_client.sock = self.sock
+        stripe_client.compression_stats = self.compression_stats
+        try:
+            with open(filename, "rb") as file:
+                return stripe_client.send_range(ip, filename, file, file_size, chunk_size, enable_cypher, stripe,
+                                                fingerprint)
+        except socket.timeout:
+            log.error("Превышено время ожидания ответа от сервера: ip: %s; участок: %d+%d",
+                      ip, stripe[0], stripe[1])
+            return False
@@ -0,0 +1,180 @@
+"""
+Сжатие кусков данных при посылке
+
+каждый кусок сжимается независимо, поэтому куски по-прежнему
+принимаются в любом порядке и посылаются повторно без пересжатия;
+перед данными куска идёт байт способа кодирования:
+кусок из одних нулей (участок разреженного файла) не передаётся вовсе,
+а кусок, который не сжимается, передаётся как есть
+"""
+import threading
+import time
+import zlib
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from magicPing import protocol
+
+# алгоритмы сжатия (номер передаётся в инициализирующем сообщении)
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+# способы кодирования куска (первый байт данных куска)
+MODE_RAW = 0
+MODE_COMPRESSED = 1
+MODE_ZERO = 2
+MODES = (MODE_RAW, MODE_COMPRESSED, MODE_ZERO)
+# уровень сжатия zlib
+ZLIB_LEVEL = 6
+
+# название -> номер алгоритма, доступного в этой сборке python
+CODECS = dict([("zlib", CODEC_ZLIB)] +
+              ([("lzma", CODEC_LZMA)] if lzma is not None else []) +
+              ([("bz2", CODEC_BZ2)] if bz2 is not None else []))
+
+_ZEROS = memoryview(bytes(protocol.CHUNK_SIZE))
+# куски маленькие, поэтому lzma пишет "сырой" поток без заголовков контейнера
+_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}] if lzma is not None else None
+# ошибки распаковки повреждённых данных
+_ERRORS = (zlib.error, EOFError, OSError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+
+def codec_name(codec):
+    """
+    :type codec: int
+    :param codec: номер алгоритма
+    :return: название алгоритма
+    """
+    for name, number in CODECS.items():
+        if number == codec:
+            return name
+    return str(codec)
+
+
+def compress(codec, data):
+    """
+    Сжатие куска
+    :type codec: int
+    :type data: bytes или memoryview
+    :param codec: номер алгоритма из CODECS
+    :param data: кусок данных
+    :return: сжатые данные (bytes)
+    """
+    if codec == CODEC_ZLIB:
+        # deflate без заголовка и контрольной суммы zlib
+        compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    if codec == CODEC_BZ2:
+        return bz2.compress(data)
+    raise ValueError("Неизвестный алгоритм сжатия: {}".format(codec))
+
+
+def decompress(codec, data, size):
+    """
+    Распаковка куска
+    :type codec: int
+    :type data: bytes или memoryview
+    :type size: int
+    :param codec: номер алгоритма из CODECS
+    :param data: сжатые данные
+    :param size: размер куска в файле
+    :return: распакованный кусок (bytes)
+    :raise ValueError: данные повреждены или распаковываются не в size байт
+    """
+    try:
+        if codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            # распаковывается не больше size + 1 байт, чтобы заметить лишние данные
+            result = decompressor.decompress(data, size + 1)
+        elif codec == CODEC_LZMA:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+            result = decompressor.decompress(data, size + 1)
+        elif codec == CODEC_BZ2:
+            decompressor = bz2.BZ2Decompressor()
+            result = decompressor.decompress(data, size + 1)
+        else:
+            raise ValueError("Неизвестный алгоритм сжатия: {}".format(codec))
+    except _ERRORS as e:
+        raise ValueError("Повреждён сжатый кусок: {}".format(e)) from e
+    if len(result) != size:
+        raise ValueError("Сжатый кусок распакован в {} байт вместо {}".format(len(result), size))
+    return result
+
+
+def encode_chunk(codec, data):
+    """
+    Кодирование куска для посылки
+    :type codec: int
+    :type data: bytes или memoryview
+    :param codec: номер алгоритма из CODECS
+    :param data: кусок данных
+    :return: кортеж (способ кодирования, данные для посылки)
+    """
+    size = len(data)
+    if size and memoryview(data) == _ZEROS[:size]:
+        return MODE_ZERO, b''
+    compressed = compress(codec, data)
+    if len(compressed) < size:
+        return MODE_COMPRESSED, compressed
+    return MODE_RAW, data
+
+
+class CompressionStats:
+    """
+    Итоги сжатия файла; может быть общей для нескольких полос
+    """
+
+    def __init__(self, codec):
+        """
+        :type codec: int
+        :param codec: номер алгоритма
+        """
+        self.codec = codec
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.zero_chunks = 0
+        self.start = time.time()
+        self.elapsed = 0.
+        self.lock = threading.Lock()
+
+    def add(self, size, mode, sent_size):
+        """
+        Учёт закодированного куска
+        :type size: int
+        :type mode: int
+        :type sent_size: int
+        :param size: размер куска в файле
+        :param mode: способ кодирования
+        :param sent_size: размер закодированных данных
+        """
+        with self.lock:
+            self.raw_bytes += size
+            self.sent_bytes += sent_size + 1
+            if mode == MODE_ZERO:
+                self.zero_chunks += 1
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def ratio(self):
+        """
+        :return: степень сжатия (размер данных / размер переданного)
+        """
+        return self.raw_bytes / self.sent_bytes if self.sent_bytes else 1.
+
+    def __str__(self):
+        throughput = self.raw_bytes / self.elapsed / 1e6 if self.elapsed > 0 else 0.
+        return ("алгоритм: {}; данных: {} байт; передано: {} байт; степень сжатия: {:.2f}; " +
+                "нулевых кусков: {}; время: {:.2f} с; скорость по данным: {:.2f} МБ/с").format(
+            codec_name(self.codec), self.raw_bytes, self.sent_bytes, self.ratio(),
+            self.zero_chunks, self.elapsed, throughput)
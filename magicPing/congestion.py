@@ -0,0 +1,117 @@
+"""
+Управление перегрузкой и ограничение скорости посылки данных клиентом
+
+окно перегрузки растёт медленным стартом и аддитивно, а при потере
+уменьшается вдвое (AIMD), поэтому передача делит канал с другим трафиком
+и не упирается в ограничение частоты ICMP ответов на сервере
+(net.ipv4.icmp_ratelimit); потеря определяется по таймауту
+и по повторным накопительным подтверждениям
+
+при заданной скорости посылки пакеты дополнительно
+выравниваются во времени корзиной токенов
+"""
+import threading
+import time
+
+# начальное окно перегрузки в кусках
+INITIAL_WINDOW = 2
+# запас корзины токенов в секундах посылки на заданной скорости
+BURST_TIME = 0.05
+
+
+class TokenBucket:
+    """
+    Корзина токенов: не больше rate байт в секунду в среднем
+    и не больше запаса корзины подряд; может быть общей для нескольких передач
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :type rate: float
+        :type burst: int или None
+        :param rate: скорость в байтах в секунду
+        :param burst: ёмкость корзины в байтах (None == BURST_TIME секунд посылки)
+        :raise ValueError: скорость не положительна или бесконечна
+        """
+        self.rate = float(rate)
+        if not 0 < self.rate < float("inf"):
+            raise ValueError("Скорость посылки должна быть положительной: {}".format(rate))
+        self.capacity = burst if burst is not None else self.rate * BURST_TIME
+        self.tokens = self.capacity
+        self.time = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """
+        Ожидание, пока посылка size байт не превысит скорость
+        :type size: int
+        :param size: размер пакета в байтах
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            # токены берутся в долг, поэтому пакет больше ёмкости корзины тоже посылается
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CongestionWindow:
+    """
+    Окно перегрузки AIMD (медленный старт, аддитивный рост,
+    уменьшение вдвое при потере, до одного куска при таймауте)
+    """
+
+    def __init__(self, max_window, estimator):
+        """
+        :type max_window: int
+        :type estimator: magicPing.rtt.RttEstimator
+        :param max_window: наибольшее окно (размер окна клиента)
+        :param estimator: оценка RTT адресата; потери в пределах
+                          одного RTT считаются одним событием
+        """
+        self.max_window = max_window
+        self.estimator = estimator
+        self.window = float(min(INITIAL_WINDOW, max_window))
+        self.threshold = float(max_window)
+        self.last_decrease = 0.
+        self.losses = 0
+
+    def size(self):
+        """
+        :return: кол-во кусков, которые можно держать в пути
+        """
+        return max(1, int(self.window))
+
+    def on_ack(self, count):
+        """
+        Учёт подтверждённых кусков
+        :type count: int
+        :param count: кол-во новых подтверждённых кусков
+        """
+        if self.window < self.threshold:
+            self.window += count
+        else:
+            self.window += count / self.window
+        self.window = min(self.window, float(self.max_window))
+
+    def on_loss(self, timeout):
+        """
+        Учёт потери
+        :type timeout: bool
+        :param timeout: потеря обнаружена по таймауту (иначе по повторным подтверждениям)
+        """
+        now = time.time()
+        srtt = self.estimator.srtt if self.estimator.srtt is not None else self.estimator.timeout()
+        if now - self.last_decrease < srtt:
+            # повторные сигналы о потерях из того же окна
+            return
+        self.last_decrease = now
+        self.losses += 1
+        self.threshold = max(self.window / 2, 1.)
+        self.window = 1. if timeout else self.threshold
+
+    def __str__(self):
+        return "окно: {:.1f}; порог: {:.1f}; потерь: {}".format(self.window, self.threshold, self.losses)
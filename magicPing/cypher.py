@@ -0,0 +1,103 @@
+"""
+Шифрование кусков данных xor'ом с общим ключом сеанса
+
+каждый кусок шифруется независимо: i-й байт куска xor'ится
+с байтом key[i % len(key)], поэтому куски можно шифровать
+и расшифровывать в любом порядке
+"""
+import itertools
+import os
+import timeit
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from magicPing import protocol
+
+
+class Cypher:
+    """
+    Шифратор сеанса: поток ключа строится один раз,
+    а куски xor'ятся целиком, а не по байту
+    """
+
+    def __init__(self, key, chunk_size=protocol.CHUNK_SIZE, use_numpy=None):
+        """
+        :type key: bytes или bytearray
+        :type chunk_size: int
+        :type use_numpy: bool или None
+        :param key: общий ключ шифрования
+        :param chunk_size: максимальный размер куска
+        :param use_numpy: использовать numpy (None == если установлен)
+        """
+        if not key:
+            raise ValueError("Пустой ключ шифрования")
+        self.key = bytes(key)
+        self.chunk_size = chunk_size
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        if self.use_numpy and numpy is None:
+            raise ImportError("numpy не установлен")
+        repeats = chunk_size // len(self.key) + 1
+        keystream = (self.key * repeats)[:chunk_size]
+        if self.use_numpy:
+            self.keystream = numpy.frombuffer(keystream, dtype=numpy.uint8)
+        else:
+            self.keystream = int.from_bytes(keystream, "little")
+
+    def xor(self, data):
+        """
+        шифрование/расшифровка куска
+        :type data: bytes или memoryview
+        :param data: кусок данных, не длиннее chunk_size
+        :return: зашифрованный кусок (bytes)
+        """
+        size = len(data)
+        if size > self.chunk_size:
+            raise ValueError("Кусок длиннее потока ключа: {} > {}".format(size, self.chunk_size))
+        if self.use_numpy:
+            return numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8),
+                                     self.keystream[:size]).tobytes()
+        keystream = self.keystream
+        if size < self.chunk_size:
+            keystream &= (1 << (8 * size)) - 1
+        return (int.from_bytes(data, "little") ^ keystream).to_bytes(size, "little")
+
+
+def xor_bytewise(data, key):
+    """
+    побайтовое шифрование (исходная схема, используется для сравнения)
+    :type data: bytes или memoryview
+    :type key: bytes или bytearray
+    :param data: кусок данных
+    :param key: ключ шифрования
+    :return: зашифрованный кусок
+    """
+    return bytes([a ^ b for a, b in zip(data, itertools.cycle(key))])
+
+
+def benchmark(number=20):
+    """
+    сравнение скорости побайтового и блочного шифрования
+    :type number: int
+    :param number: кол-во повторов каждого замера
+    """
+    key = os.urandom(32)
+    data = os.urandom(protocol.CHUNK_SIZE)
+    variants = [("bytewise", lambda: xor_bytewise(data, key))]
+    int_cypher = Cypher(key, use_numpy=False)
+    variants.append(("int", lambda: int_cypher.xor(data)))
+    if numpy is not None:
+        numpy_cypher = Cypher(key, use_numpy=True)
+        variants.append(("numpy", lambda: numpy_cypher.xor(data)))
+    expected = xor_bytewise(data, key)
+    for name, function in variants:
+        assert function() == expected, name
+        seconds = min(timeit.repeat(function, number=number, repeat=3)) / number
+        print("{:10} {:10.1f} us/chunk {:10.1f} MB/s".format(
+            name, seconds * 1e6, len(data) / seconds / 1e6))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,354 @@
+"""
+Дедупликация блоков между клиентом и сервером
+
+файл делится на блоки protocol.DEDUP_BLOCK_SIZE байт по абсолютным смещениям
+(поэтому разбиение не зависит от размера куска и полос); клиент посылает
+список хешей блоков своего участка ("magic-ping-sman"), сервер ищет их
+в индексе уже принятых файлов, копирует найденные блоки в новый файл
+и отвечает, какие блоки у него есть ("magic-ping-rman");
+после этого по сети идут только куски, не покрытые найденными блоками
+
+индекс хранится в sqlite рядом с принятыми файлами (INDEX_NAME)
+и пополняется фоновым потоком после приёма каждого файла
+"""
+import bisect
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from magicPing import protocol
+
+log = logging.getLogger(__name__)
+
+# имя файла индекса в директории для входящих файлов
+INDEX_NAME = ".magic-ping-dedup.sqlite"
+# суффиксы файлов, которые не индексируются (частично принятые файлы)
+SKIPPED_SUFFIXES = (".part", ".checkpoint", ".tmp")
+# кол-во блоков, записываемых в индекс одной транзакцией
+INDEX_BATCH = 1024
+
+
+def block_hash(data):
+    """
+    :type data: bytes или memoryview
+    :param data: блок файла
+    :return: хеш блока (protocol.HASH_SIZE байт)
+    """
+    return hashlib.sha256(data).digest()[:protocol.HASH_SIZE]
+
+
+def block_span(block, file_size):
+    """
+    :type block: int
+    :type file_size: int
+    :param block: номер блока в файле
+    :param file_size: размер файла
+    :return: кортеж (смещение блока, размер блока); последний блок короче
+    """
+    offset = block * protocol.DEDUP_BLOCK_SIZE
+    return offset, min(protocol.DEDUP_BLOCK_SIZE, file_size - offset)
+
+
+def manifest_blocks(range_offset, range_size, file_size):
+    """
+    Блоки, целиком лежащие в участке файла
+    :type range_offset: int
+    :type range_size: int
+    :type file_size: int
+    :param range_offset: смещение участка
+    :param range_size: размер участка
+    :param file_size: размер файла
+    :return: range номеров блоков
+    """
+    block_size = protocol.DEDUP_BLOCK_SIZE
+    first = -(-range_offset // block_size)
+    range_end = range_offset + range_size
+    last = range_end // block_size
+    if range_end == file_size and range_end % block_size:
+        # короткий последний блок файла
+        last += 1
+    return range(first, max(first, last))
+
+
+class ChunkMap:
+    """
+    Куски участка, которые нужно передать: всё, что не покрыто
+    найденными на сервере блоками; переданные куски нумеруются подряд,
+    так что номера сообщений и подтверждения не перескакивают через пропуски
+    """
+
+    def __init__(self, range_offset, range_size, chunk_size, present_blocks, file_size):
+        """
+        :type range_offset: int
+        :type range_size: int
+        :type chunk_size: int
+        :type present_blocks: collections.Iterable
+        :type file_size: int
+        :param range_offset: смещение участка
+        :param range_size: размер участка
+        :param chunk_size: размер куска
+        :param present_blocks: номера блоков, найденных на сервере
+        :param file_size: размер файла
+        """
+        self.chunk_size = chunk_size
+        self.range_size = range_size
+        self.total = protocol.chunk_count(range_size, chunk_size)
+        range_end = range_offset + range_size
+        # непрерывные участки найденных блоков -> пропускаемые куски
+        skipped = []
+        for block in sorted(present_blocks):
+            start, size = block_span(block, file_size)
+            if skipped and skipped[-1][1] == start:
+                skipped[-1][1] = start + size
+            else:
+                skipped.append([start, start + size])
+        # начала и длины участков передаваемых кусков и порядковый номер
+        # первого куска каждого участка
+        self.starts = []
+        self.counts = []
+        self.positions = []
+        next_chunk = 0
+        count = 0
+        for start, end in skipped:
+            first = -(-(start - range_offset) // chunk_size)
+            last = self.total if end >= range_end else (end - range_offset) // chunk_size
+            if last > first:
+                self.add_run(next_chunk, first - next_chunk, count)
+                count += max(0, first - next_chunk)
+                next_chunk = last
+        self.add_run(next_chunk, self.total - next_chunk, count)
+        self.count = count + max(0, self.total - next_chunk)
+
+    def add_run(self, start, count, position):
+        if count > 0:
+            self.starts.append(start)
+            self.counts.append(count)
+            self.positions.append(position)
+
+    def chunk(self, position):
+        """
+        :type position: int
+        :param position: порядковый номер передаваемого куска
+        :return: номер куска в участке
+        """
+        run = bisect.bisect_right(self.positions, position) - 1
+        return self.starts[run] + position - self.positions[run]
+
+    def position(self, chunk):
+        """
+        :type chunk: int
+        :param chunk: номер куска в участке
+        :return: порядковый номер передаваемого куска или None,
+                 если кусок покрыт найденными блоками
+        """
+        run = bisect.bisect_right(self.starts, chunk) - 1
+        if run < 0 or chunk >= self.starts[run] + self.counts[run]:
+            return None
+        return self.positions[run] + chunk - self.starts[run]
+
+    def skipped_size(self):
+        """
+        :return: кол-во байт участка, которые не передаются
+        """
+        sent = self.count * self.chunk_size
+        if self.count and self.starts[-1] + self.counts[-1] == self.total:
+            # последний кусок участка короче
+            sent -= self.total * self.chunk_size - self.range_size
+        return self.range_size - sent
+
+
+class DedupState:
+    """
+    Состояние дедупликации одного соединения на сервере
+    """
+    __slots__ = ("present", "replies", "chunk_map")
+
+    def __init__(self):
+        # номера блоков, скопированных из других файлов
+        self.present = set()
+        # первый блок части списка -> ответ на неё (для повторных посылок)
+        self.replies = dict()
+        # ChunkMap после конца списка блоков
+        self.chunk_map = None
+
+
+class DedupIndex:
+    """
+    Индекс блоков принятых файлов: хеш -> (имя файла, смещение, размер)
+    """
+
+    def __init__(self, target_path, scan=True, enabled=True):
+        """
+        :type target_path: pathlib.Path
+        :type scan: bool
+        :type enabled: bool
+        :param target_path: директория для входящих файлов
+        :param scan: проиндексировать при запуске файлы, которых нет в индексе
+        :param enabled: вести индекс (False == индекс не открывается,
+                        дедупликация не поддерживается)
+        """
+        self.target_path = target_path
+        self.scan_on_start = scan
+        self.enabled = enabled
+        self.connection = None
+        self.lock = threading.Lock()
+        self.executor = None
+
+    @property
+    def available(self):
+        """
+        :return: True, если индекс открыт
+        """
+        return self.connection is not None
+
+    def start(self):
+        """
+        открытие индекса и запуск потока индексации
+        """
+        if not self.enabled:
+            return
+        if sqlite3 is None:
+            log.warning("sqlite3 недоступен, дедупликация отключена")
+            return
+        try:
+            connection = sqlite3.connect(str(self.target_path / INDEX_NAME), timeout=30,
+                                         check_same_thread=False)
+            connection.execute("CREATE TABLE IF NOT EXISTS blocks "
+                               "(hash BLOB PRIMARY KEY, name TEXT, offset INTEGER, size INTEGER)")
+            connection.execute("CREATE INDEX IF NOT EXISTS blocks_name ON blocks (name)")
+            connection.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+            connection.commit()
+        except sqlite3.Error as e:
+            log.warning("Индекс дедупликации не открыт, дедупликация отключена: %s", e)
+            return
+        self.connection = connection
+        # индексация одна на сервер, чтобы не соперничать с приёмом за диск
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        if self.scan_on_start:
+            self.executor.submit(self.scan)
+
+    def stop(self):
+        """
+        завершение индексации и закрытие индекса
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.connection is not None:
+            with self.lock:
+                self.connection.close()
+                self.connection = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def fetch(self, digest, size):
+        """
+        Чтение блока с хешем digest из ранее принятого файла
+        :type digest: bytes
+        :type size: int
+        :param digest: хеш блока
+        :param size: размер блока
+        :return: данные блока или None, если блока нет
+                 (или файл с ним изменился)
+        """
+        if self.connection is None:
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT name, offset, size FROM blocks WHERE hash = ?",
+                                          (digest,)).fetchone()
+        if row is None or row[2] != size:
+            return None
+        name, offset, _ = row
+        try:
+            with open(str(self.target_path / name), "rb") as file:
+                data = os.pread(file.fileno(), size, offset)
+        except OSError:
+            data = b''
+        if len(data) == size and block_hash(data) == digest:
+            return data
+        # файл удалён или изменён после индексации
+        with self.lock:
+            self.connection.execute("DELETE FROM blocks WHERE hash = ?", (digest,))
+            self.connection.commit()
+        return None
+
+    def add_file(self, path):
+        """
+        Индексация принятого файла в фоновом потоке
+        :type path: str или pathlib.Path
+        :param path: путь до файла в директории для входящих файлов
+        """
+        if self.executor is not None:
+            self.executor.submit(self.index_file, os.path.basename(str(path)))
+
+    def scan(self):
+        """
+        Индексация файлов директории, которых нет в индексе или которые изменились
+        """
+        try:
+            names = sorted(os.listdir(str(self.target_path)))
+        except OSError as e:
+            log.warning("Директория для входящих файлов не прочитана: %s", e)
+            return
+        for name in names:
+            if not name.startswith(".") and not name.endswith(SKIPPED_SUFFIXES):
+                self.index_file(name)
+
+    def index_file(self, name):
+        """
+        Запись хешей блоков файла в индекс
+        :type name: str
+        :param name: имя файла в директории для входящих файлов
+        """
+        path = str(self.target_path / name)
+        try:
+            stat = os.stat(path)
+            if not os.path.isfile(path):
+                return
+            with self.lock:
+                if self.connection is None:
+                    return
+                row = self.connection.execute("SELECT size, mtime FROM files WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+                return
+            with self.lock:
+                self.connection.execute("DELETE FROM blocks WHERE name = ?", (name,))
+            rows = []
+            with open(path, "rb") as file:
+                offset = 0
+                while True:
+                    data = file.read(protocol.DEDUP_BLOCK_SIZE)
+                    if not data:
+                        break
+                    rows.append((block_hash(data), name, offset, len(data)))
+                    offset += len(data)
+                    if len(rows) >= INDEX_BATCH:
+                        self.insert(rows)
+                        rows = []
+            self.insert(rows)
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                                        (name, stat.st_size, stat.st_mtime))
+                self.connection.commit()
+            log.debug("Файл проиндексирован: %s; блоков: %d", name, offset // protocol.DEDUP_BLOCK_SIZE)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Файл %s не проиндексирован: %s", name, e)
+
+    def insert(self, rows):
+        with self.lock:
+            if self.connection is None:
+                raise sqlite3.ProgrammingError("Индекс закрыт")
+            self.connection.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)", rows)
+            self.connection.commit()
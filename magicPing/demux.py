@@ -0,0 +1,196 @@
+"""
+Разбор пакетов сырого сокета одним потоком
+и раздача их ожидающим по (ip, id, seq_num)
+"""
+import logging
+import queue
+import socket
+import struct
+import threading
+
+from magicPing import icmp
+from magicPing import utils
+
+log = logging.getLogger(__name__)
+
+
+class Waiter:
+    """
+    Ожидающий пакетов с определённого адреса, id и (не обязательно) seq_num
+    """
+
+    def __init__(self, demultiplexer, source, icmp_id=None, seq_num=None, prefix=None, suffix=None):
+        """
+        :type demultiplexer: Demultiplexer
+        :type source: bytes
+        :type icmp_id: int или None
+        :type seq_num: int или None
+        :type prefix: bytes или None
+        :type suffix: bytes или None
+        :param demultiplexer: раздатчик, у которого зарегистрирован ожидающий
+        :param source: упакованный адрес отправителя
+        :param icmp_id: ожидаемый идентификатор (None == любой)
+        :param seq_num: ожидаемый номер сообщения (None == любой)
+        :param prefix: ожидаемое начало сообщения
+        :param suffix: ожидаемый конец сообщения
+        """
+        self.demultiplexer = demultiplexer
+        self.source = source
+        self.icmp_id = icmp_id
+        self.seq_num = seq_num
+        self.prefix = prefix
+        self.suffix = suffix
+        self.packets = queue.Queue()
+
+    def matches(self, seq_num, data):
+        """
+        проверка пакета на соответствие фильтру
+        (адрес и id уже проверены раздатчиком)
+        :type seq_num: int
+        :type data: memoryview
+        :param seq_num: номер сообщения
+        :param data: данные сообщения
+        :return: True, если пакет ожидается
+        """
+        return ((self.seq_num is None or seq_num == self.seq_num)
+                and (self.prefix is None or (len(data) >= len(self.prefix)
+                                             and self.prefix == data[:len(self.prefix)]))
+                and (self.suffix is None or (len(data) >= len(self.suffix)
+                                             and self.suffix == data[len(data) - len(self.suffix):])))
+
+    def receive(self, timeout=None):
+        """
+        Получение очередного пакета
+        :type timeout: float или None
+        :param timeout: время ожидания в секундах
+        :return: кортеж (ip, icmp id, sequence number, data)
+        """
+        try:
+            return self.packets.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout
+
+    def close(self):
+        """
+        снятие с регистрации
+        """
+        self.demultiplexer.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class Demultiplexer:
+    """
+    Раздатчик пакетов: один поток читает сырой сокет, разбирает каждый
+    пакет один раз и кладёт его в очереди подходящих ожидающих,
+    поэтому несколько передач могут пользоваться одним сокетом
+    """
+
+    def __init__(self, sock, icmp_type=0):
+        """
+        :type sock: socket.socket
+        :type icmp_type: int
+        :param sock: сырой ICMP сокет
+        :param icmp_type: тип раздаваемых сообщений (0 == ECHO REPLY)
+        """
+        self.sock = sock
+        self.icmp_type = icmp_type
+        # (упакованный адрес, id или None) -> список ожидающих
+        self.waiters = dict()
+        self.lock = threading.Lock()
+        self.runnable = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        запуск потока приёма
+        """
+        self.runnable.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        остановка потока приёма
+        """
+        self.runnable.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def subscribe(self, source_address, icmp_id=None, seq_num=None, prefix=None, suffix=None):
+        """
+        Регистрация ожидающего; регистрироваться следует до посылки запроса,
+        чтобы не пропустить ответ
+        (параметры описаны в Waiter, source_address разрешается icmp.resolve_address)
+        :return: Waiter
+        """
+        waiter = Waiter(self, icmp.resolve_address(source_address), icmp_id, seq_num, prefix, suffix)
+        with self.lock:
+            self.waiters.setdefault((waiter.source, icmp_id), []).append(waiter)
+        return waiter
+
+    def unsubscribe(self, waiter):
+        """
+        Снятие ожидающего с регистрации
+        :type waiter: Waiter
+        :param waiter: ожидающий
+        """
+        key = (waiter.source, waiter.icmp_id)
+        with self.lock:
+            waiters = self.waiters.get(key)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[key]
+
+    def run(self):
+        """
+        цикл приёма пакетов
+        """
+        log.debug("Запущен раздатчик пакетов")
+        self.sock.settimeout(0.5)
+        # один буфер на все пакеты, подошедшие пакеты копируются из него
+        buffer = bytearray(65535)
+        view = memoryview(buffer)
+        while self.runnable.is_set():
+            try:
+                msg = view[:self.sock.recv_into(buffer)]
+            except socket.timeout:
+                continue
+            except OSError:
+                if self.runnable.is_set():
+                    log.exception("Ошибка приёма пакета")
+                break
+            if len(msg) < 28:
+                continue
+            icmp_type, icmp_code, _, icmp_id, seq_num = struct.unpack_from("!BBHHH", msg, 20)
+            if icmp_type != self.icmp_type or icmp_code != 0:
+                continue
+            source = msg[12:16].tobytes()
+            with self.lock:
+                waiters = self.waiters.get((source, icmp_id), []) + self.waiters.get((source, None), [])
+            data = msg[28:]
+            waiters = [waiter for waiter in waiters if waiter.matches(seq_num, data)]
+            if not waiters:
+                continue
+            ip = socket.inet_ntoa(source)
+            if utils.checksum(msg[20:]) != 0:
+                log.debug("Пакет с неверной контрольной суммой отброшен: ip: %s; id: %d; seq_num: %d",
+                          ip, icmp_id, seq_num)
+                continue
+            data = data.tobytes()
+            for waiter in waiters:
+                waiter.packets.put((ip, icmp_id, seq_num, data))
+        log.debug("Завершён раздатчик пакетов")
@@ -4,19 +4,34 @@
 import logging
 import socket
 import struct
+import threading
 import time
 
+from magicPing import bpf
+from magicPing import utils
 
 log = logging.getLogger(__name__)
 
+# время жизни и размер кэша разрешённых адресов
+RESOLVE_TTL = 60.
+RESOLVE_CACHE_SIZE = 1024
+# адрес -> (упакованный адрес, время устаревания)
+_resolve_cache = dict()
+_resolve_lock = threading.Lock()
 
-def monitor():
+
+def monitor(magic_only=False):
     """
     Мониторинг ICMP ECHO REPLY/REQUEST пакетов
+    :type magic_only: bool
+    :param magic_only: показывать только сообщения magic-ping
+                       (остальные отсеиваются фильтром в ядре)
     """
     with socket.socket(socket.AF_INET,
                        socket.SOCK_RAW,
                        socket.IPPROTO_ICMP) as sock:
+        if magic_only and not bpf.attach_filter(sock, bpf.echo_filter([0, 8], bpf.ANY_TAGS)):
+            log.warning("Фильтр не установлен, показываются все ICMP пакеты")
         while True:
             msg = sock.recv(65535)
             ip_header = msg[:20]
@@ -74,6 +89,102 @@ def monitor():
                 print('Description length: ', len(msg[28:]))
 
 
+def resolve_address(address):
+    """
+    Разрешение адреса в 4 байта упакованного ipv4 адреса
+    с кэшированием на RESOLVE_TTL секунд
+    :type address: str или bytes
+    :param address: имя, строка с ip или уже упакованный адрес
+    :return: упакованный адрес
+    """
+    if isinstance(address, (bytes, bytearray)) and len(address) == 4:
+        return bytes(address)
+    now = time.time()
+    cached = _resolve_cache.get(address)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    try:
+        packed = socket.inet_aton(address)
+    except OSError:
+        packed = socket.inet_aton(socket.gethostbyname(address))
+    with _resolve_lock:
+        if len(_resolve_cache) >= RESOLVE_CACHE_SIZE:
+            _resolve_cache.clear()
+        _resolve_cache[address] = (packed, now + RESOLVE_TTL)
+    return packed
+
+
+def set_receive_buffer(sock, size):
+    """
+    Увеличение приёмного буфера сокета, чтобы пакеты, находящиеся в пути
+    одновременно, не отбрасывались ядром
+    :type sock: socket.socket
+    :type size: int
+    :param sock: сокет
+    :param size: желаемый размер буфера в байтах
+    """
+    try:
+        # игнорирует ограничение net.core.rmem_max, но требует CAP_NET_ADMIN
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_RCVBUFFORCE", 33), size)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    log.debug("Размер приёмного буфера: %d",
+              sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+
+def pack_echo_header(icmp_type, icmp_id, sequence_num, *parts):
+    """
+    Заголовок ICMP ECHO с контрольной суммой
+    :type icmp_type: int
+    :type icmp_id: int
+    :type sequence_num: int
+    :type parts: bytes или memoryview
+    :param icmp_type: 8 для ECHO REQUEST, 0 для ECHO REPLY
+    :param icmp_id: идентификатор
+    :param sequence_num: номер сообщения
+    :param parts: данные (одной или несколькими частями)
+    :return: 8 байт заголовка
+    """
+    icmp_code = 0
+    # noinspection SpellCheckingInspection
+    icmp_header = struct.pack('!BBHHH', icmp_type, icmp_code,
+                              0, icmp_id, sequence_num)
+    icmp_checksum = ~utils.ones_complement_sum(icmp_header, *parts) & 0xFFFF
+    return icmp_header[:2] + struct.pack('!H', icmp_checksum) + icmp_header[4:]
+
+
+def pack_echo(icmp_type, icmp_id, sequence_num, data):
+    """
+    ICMP ECHO сообщение целиком (параметры описаны в pack_echo_header)
+    :return: заголовок и данные
+    """
+    return pack_echo_header(icmp_type, icmp_id, sequence_num, data) + data
+
+
+def send_echo(sock, ip, icmp_type, icmp_id, sequence_num, *parts):
+    """
+    Посылка ICMP ECHO, данные которого состоят из нескольких частей:
+    заголовок и части передаются ядру списком (sendmsg), без склейки в один буфер
+    :type sock: socket.socket
+    :type ip: str
+    :type icmp_type: int
+    :type icmp_id: int
+    :type sequence_num: int
+    :type parts: bytes или memoryview
+    :param sock: сокет для отправки сообщения
+    :param ip: адресат
+    :param icmp_type: 8 для ECHO REQUEST, 0 для ECHO REPLY
+    :param icmp_id: идентификатор
+    :param sequence_num: номер сообщения
+    :param parts: части данных
+    """
+    header = pack_echo_header(icmp_type, icmp_id, sequence_num, *parts)
+    if hasattr(sock, "sendmsg"):
+        sock.sendmsg((header,) + parts, (), 0, (ip, 0))
+    else:
+        sock.sendto(b"".join((header,) + parts), (ip, 0))
+
+
 def send_echo_request(sock, ip, icmp_id, sequence_num, data):
     """
     Посылка ICMP ECHO REQUEST
@@ -88,13 +199,7 @@ def send_echo_request(sock, ip, icmp_id, sequence_num, data):
     :param sequence_num: номер сообщения
     :param data: данные
     """
-    icmp_type = 8
-    icmp_code = 0
-    # noinspection SpellCheckingInspection
-    icmp_header = struct.pack('!BBHHH', icmp_type, icmp_code,
-                              0, icmp_id, sequence_num)
-    msg = icmp_header + data
-    sock.sendto(msg, (ip, 0))
+    sock.sendto(pack_echo(8, icmp_id, sequence_num, data), (ip, 0))
 
 
 def send_echo_reply(sock, ip, icmp_id, sequence_num, data):
@@ -111,22 +216,16 @@ def send_echo_reply(sock, ip, icmp_id, sequence_num, data):
     :param sequence_num: номер сообщения
     :param data: данные
     """
-    icmp_type = 0
-    icmp_code = 0
-    # noinspection SpellCheckingInspection
-    icmp_header = struct.pack('!BBHHH', icmp_type, icmp_code,
-                              0, icmp_id, sequence_num)
-    msg = icmp_header + data
-    sock.sendto(msg, (ip, 0))
+    sock.sendto(pack_echo(0, icmp_id, sequence_num, data), (ip, 0))
 
 
 def receive_echo_request(sock, source_address=None, pref_id=None,
                          pref_seq_num=None, timeout=0,
-                         prefix=None, suffix=None):
+                         prefix=None, suffix=None, buffer=None):
     """
     Получение ICMP ECHO REQUEST
     :type sock: socket.socket
-    :type source_address: str или None
+    :type source_address: str, bytes или None
     :type pref_id: int или None
     :type pref_seq_num: int или None
     :type timeout: float или None
@@ -134,50 +233,27 @@ def receive_echo_request(sock, source_address=None, pref_id=None,
     :type suffix: bytes или memoryview
     :param sock: сокет для приёма сообщения
     :param source_address: ожидаемый адрес отправителя
+                           (имя, строка с ip или 4 байта упакованного адреса)
     :param pref_id: ожидаемый идетификатор отправителя
     :param pref_seq_num: ожидаемый номер сообщения
     :param timeout: время ожидания сообщения в секундах
     :param prefix: ожидаемое начало сообщения
     :param suffix: ожидаемый конец сообщения
+    :param buffer: буфер для recv_into (None == новый буфер на каждый пакет);
+                   возвращаемые данные ссылаются на него
     :return: кортеж информации о полученном сообщении
                 (ip, icmp id, sequence number, data)
     """
-    if timeout is not None:
-        start = time.time()
-    sock_timeout = timeout
-    while timeout is None or sock_timeout > 0:
-        try:
-            if sock_timeout is not None:
-                sock.settimeout(sock_timeout)
-            msg = memoryview(sock.recv(65535))
-            ip = socket.inet_ntoa(msg[12:16])
-            icmp_type, icmp_code, _, icmp_id, seq_num\
-                = struct.unpack("!BBHHH", msg[20:28].tobytes())
-            if icmp_type == 8 or icmp_code == 0:
-                data = msg[28:]
-                if ((source_address is None
-                     or socket.inet_aton(ip) == socket.inet_aton(socket.gethostbyname(source_address)))
-                    and (pref_id is None or icmp_id == pref_id)
-                    and (pref_seq_num is None or seq_num == pref_seq_num)
-                    and (prefix is None or (len(data) >= len(prefix)
-                                            and prefix == data[:len(prefix)]))
-                    and (suffix is None or (len(data) >= len(suffix)
-                                            and suffix == data[len(data) - len(suffix):]))):
-                    return ip, icmp_id, seq_num, data
-        except socket.timeout as _:
-            pass
-        if timeout is not None:
-            sock_timeout = start - time.time() + timeout
-    raise socket.timeout
+    return _receive_echo(sock, 8, source_address, pref_id, pref_seq_num, timeout, prefix, suffix, buffer)
 
 
 def receive_echo_reply(sock, source_address=None, pref_id=None,
                        pref_seq_num=None, timeout=0,
-                       prefix=None, suffix=None):
+                       prefix=None, suffix=None, buffer=None):
     """
     Получение ICMP ECHO REPLY
     :type sock: socket.socket
-    :type source_address: str
+    :type source_address: str, bytes или None
     :type pref_id: int
     :type pref_seq_num: int
     :type timeout: float
@@ -185,14 +261,33 @@ def receive_echo_reply(sock, source_address=None, pref_id=None,
     :type suffix: bytes или memoryview
     :param sock: сокет для приёма сообщения
     :param source_address: ожидаемый адрес отправителя
+                           (имя, строка с ip или 4 байта упакованного адреса)
     :param pref_id: ожидаемый идетификатор отправителя
     :param pref_seq_num: ожидаемый номер сообщения
     :param timeout: время ожидания сообщения в секундах
     :param prefix: ожидаемое начало сообщения
     :param suffix: ожидаемый конец сообщения
+    :param buffer: буфер для recv_into (None == новый буфер на каждый пакет);
+                   возвращаемые данные ссылаются на него
     :return: кортеж информации о полученном сообщении
                 (ip, icmp id, sequence number, data)
     """
+    return _receive_echo(sock, 0, source_address, pref_id, pref_seq_num, timeout, prefix, suffix, buffer)
+
+
+def _receive_echo(sock, pref_type, source_address, pref_id, pref_seq_num, timeout, prefix, suffix,
+                  buffer=None):
+    """
+    Получение ICMP ECHO REQUEST/REPLY, подходящего под фильтр
+    (параметры описаны в receive_echo_request)
+    :type pref_type: int
+    :param pref_type: ожидаемый тип сообщения: 8 или 0
+    """
+    # адрес разрешается один раз, а не для каждого пакета
+    source = resolve_address(source_address) if source_address is not None else None
+    if buffer is None:
+        buffer = bytearray(65535)
+    view = memoryview(buffer)
     if timeout is not None:
         start = time.time()
     sock_timeout = timeout
@@ -200,23 +295,46 @@ def receive_echo_reply(sock, source_address=None, pref_id=None,
         try:
             if sock_timeout is not None:
                 sock.settimeout(sock_timeout)
-            msg = memoryview(sock.recv(65535))
-            ip = socket.inet_ntoa(msg[12:16])
-            icmp_type, icmp_code, _, icmp_id, seq_num\
-                = struct.unpack("!BBHHH", msg[20:28].tobytes())
-            if icmp_type == 0 or icmp_code == 0:
-                data = msg[28:]
-                if ((source_address is None
-                     or socket.inet_aton(ip) == socket.inet_aton(socket.gethostbyname(source_address)))
-                    and (pref_id is None or icmp_id == pref_id)
-                    and (pref_seq_num is None or seq_num == pref_seq_num)
-                    and (prefix is None or (len(data) >= len(prefix)
-                                            and prefix == data[:len(prefix)]))
-                    and (suffix is None or (len(data) >= len(suffix)
-                                            and suffix == data[len(data) - len(suffix):]))):
-                    return ip, icmp_id, seq_num, data
+            packet = parse_echo(view[:sock.recv_into(buffer)], pref_type, source, pref_id,
+                                pref_seq_num, prefix, suffix)
+            if packet is not None:
+                return packet
         except socket.timeout as _:
             pass
         if timeout is not None:
             sock_timeout = start - time.time() + timeout
     raise socket.timeout
+
+
+def parse_echo(msg, pref_type, source=None, pref_id=None, pref_seq_num=None, prefix=None, suffix=None):
+    """
+    Разбор принятого пакета и проверка его на соответствие фильтру
+    (параметры фильтра описаны в receive_echo_request)
+    :type msg: memoryview
+    :type pref_type: int
+    :type source: bytes или None
+    :param msg: пакет вместе с ip заголовком
+    :param pref_type: ожидаемый тип сообщения: 8 или 0
+    :param source: ожидаемый упакованный адрес отправителя
+    :return: кортеж (ip, icmp id, sequence number, data)
+             или None, если пакет не подходит или повреждён
+    """
+    if len(msg) < 28:
+        return None
+    icmp_type, icmp_code, _, icmp_id, seq_num\
+        = struct.unpack_from("!BBHHH", msg, 20)
+    if (icmp_type == pref_type and icmp_code == 0
+            and (pref_id is None or icmp_id == pref_id)
+            and (pref_seq_num is None or seq_num == pref_seq_num)
+            and (source is None or msg[12:16] == source)):
+        data = msg[28:]
+        if ((prefix is None or (len(data) >= len(prefix)
+                                and prefix == data[:len(prefix)]))
+                and (suffix is None or (len(data) >= len(suffix)
+                                        and suffix == data[len(data) - len(suffix):]))):
+            ip = socket.inet_ntoa(msg[12:16])
+            if utils.checksum(msg[20:]) == 0:
+                return ip, icmp_id, seq_num, data
+            log.debug("Пакет с неверной контрольной суммой отброшен: ip: %s; id: %d; seq_num: %d",
+                      ip, icmp_id, seq_num)
+    return None
@@ -0,0 +1,181 @@
+"""
+Проверка целостности принятого файла без повторного чтения его целиком
+
+клиент считает хеш участка файла по мере чтения кусков, а сервер - по мере
+их записи; в конце клиент посылает свой хеш ("magic-ping-sfin"), а сервер
+отвечает результатом сравнения ("magic-ping-rfin").
+Куски пишутся в любом порядке, а хеш считается по участку подряд:
+кусок на текущей границе хешируется сразу, а записанные дальше части
+запоминаются без данных и дочитываются из файла, когда граница до них
+дойдёт (обычно из страничного кэша, а не с диска)
+"""
+import hashlib
+import heapq
+import logging
+import os
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+# алгоритмы хеша (номер передаётся в "magic-ping-sver")
+ALGORITHM_SHA256 = 1
+ALGORITHM_BLAKE2B = 2
+# размер хеша в "magic-ping-sfin"
+DIGEST_SIZE = 32
+# размер одного чтения при дочитывании из файла
+READ_SIZE = 1 << 20
+
+# название -> номер алгоритма, доступного в этой сборке python (blake2b - с python 3.6)
+ALGORITHMS = dict([("sha256", ALGORITHM_SHA256)] +
+                  ([("blake2b", ALGORITHM_BLAKE2B)] if hasattr(hashlib, "blake2b") else []))
+
+
+def algorithm_name(algorithm):
+    """
+    :type algorithm: int
+    :param algorithm: номер алгоритма
+    :return: название алгоритма
+    """
+    for name, number in ALGORITHMS.items():
+        if number == algorithm:
+            return name
+    return str(algorithm)
+
+
+def new_hash(algorithm):
+    """
+    :type algorithm: int
+    :param algorithm: номер алгоритма из ALGORITHMS
+    :return: объект hashlib с хешем DIGEST_SIZE байт
+    """
+    if algorithm == ALGORITHM_SHA256:
+        return hashlib.sha256()
+    if algorithm == ALGORITHM_BLAKE2B and ALGORITHM_BLAKE2B in ALGORITHMS.values():
+        return hashlib.blake2b(digest_size=DIGEST_SIZE)
+    raise ValueError("Неизвестный алгоритм хеша: {}".format(algorithm))
+
+
+def chunk_crc(*parts):
+    """
+    :type parts: bytes или memoryview
+    :param parts: части пакета подряд
+    :return: CRC32 частей (беззнаковое)
+    """
+    crc = 0
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+    return crc & 0xffffffff
+
+
+class StreamHash:
+    """
+    Хеш участка файла, который пишется или читается кусками в любом порядке
+    """
+
+    def __init__(self, algorithm, path, offset, size):
+        """
+        :type algorithm: int
+        :type path: str
+        :type offset: int
+        :type size: int
+        :param algorithm: номер алгоритма из ALGORITHMS
+        :param path: путь до файла, из которого дочитываются части
+        :param offset: смещение участка
+        :param size: размер участка
+        """
+        self.algorithm = algorithm
+        self.hash = new_hash(algorithm)
+        self.path = str(path)
+        self.position = offset
+        self.end = offset + size
+        # части за границей хеша, уже лежащие в файле: куча (начало, конец)
+        self.deferred = []
+        # байт дочитано из файла
+        self.reread = 0
+        self.fd = None
+        self.error = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def update(self, offset, data):
+        """
+        Учёт части участка; должна вызываться после записи части в файл
+        :type offset: int
+        :type data: bytes или memoryview
+        :param offset: смещение части в файле
+        :param data: данные части
+        """
+        end = min(offset + len(data), self.end)
+        with self.lock:
+            if self.closed:
+                return
+            # граница могла дойти до уже лежащих в файле частей (skip)
+            self.drain()
+            if offset <= self.position < end:
+                # части могут перекрываться (блоки дедупликации и куски)
+                self.hash.update(memoryview(data)[self.position - offset:end - offset])
+                self.position = end
+                self.drain()
+            elif offset > self.position and offset < end:
+                heapq.heappush(self.deferred, (offset, end))
+
+    def skip(self, offset, size):
+        """
+        Учёт части, которая уже лежит в файле и хешируется чтением из него
+        (принятое до обрыва передачи, блоки, не посылаемые при дедупликации)
+        :type offset: int
+        :type size: int
+        :param offset: смещение части
+        :param size: размер части
+        """
+        if size > 0:
+            with self.lock:
+                heapq.heappush(self.deferred, (offset, min(offset + size, self.end)))
+
+    def drain(self):
+        """
+        Дочитывание из файла частей, до которых дошла граница хеша;
+        должна вызываться с захваченным self.lock
+        """
+        while self.deferred and self.deferred[0][0] <= self.position and self.error is None:
+            _, end = heapq.heappop(self.deferred)
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                while self.position < end:
+                    data = os.pread(self.fd, min(READ_SIZE, end - self.position), self.position)
+                    if not data:
+                        raise OSError("файл короче участка")
+                    self.hash.update(data)
+                    self.position += len(data)
+                    self.reread += len(data)
+            except OSError as e:
+                self.error = e
+                log.error("Хеш файла %s не посчитан: %s", self.path, e)
+
+    def digest(self):
+        """
+        Завершение хеша
+        :return: хеш участка (DIGEST_SIZE байт) или None,
+                 если участок учтён не целиком или файл не прочитан
+        """
+        with self.lock:
+            self.drain()
+            self.release()
+            if self.error is not None or self.position < self.end:
+                return None
+            return self.hash.digest()
+
+    def close(self):
+        """
+        Отказ от хеша (соединение закрыто без проверки)
+        """
+        with self.lock:
+            self.closed = True
+            self.release()
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
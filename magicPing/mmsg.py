@@ -0,0 +1,158 @@
+"""
+Пакетный приём и посылка ICMP сообщений через recvmmsg/sendmmsg (Linux)
+
+где эти вызовы недоступны, используются обычные recv_into/sendto
+по одному пакету, поведение при этом не меняется
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import socket
+import struct
+
+log = logging.getLogger(__name__)
+
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                # адрес хранится числом: присваивание c_char * 4 обрезает байты после нулевого
+                ("sin_addr", ctypes.c_uint32),
+                ("sin_zero", ctypes.c_char * 8)]
+
+
+def _load_libc():
+    """
+    :return: libc с recvmmsg и sendmmsg или None
+    """
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "recvmmsg") or not hasattr(libc, "sendmmsg"):
+        return None
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc.recvmmsg.restype = ctypes.c_int
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    libc.sendmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load_libc()
+# True, если доступны recvmmsg/sendmmsg
+available = _libc is not None
+
+
+def receive_batch(sock, buffers, timeout=None, use_mmsg=True):
+    """
+    Приём нескольких пакетов за одно пробуждение
+    :type sock: socket.socket
+    :type buffers: list
+    :type timeout: float или None
+    :type use_mmsg: bool
+    :param sock: сырой сокет
+    :param buffers: буферы (bytearray) для пакетов, не больше одного пакета на буфер
+    :param timeout: время ожидания первого пакета в секундах
+    :param use_mmsg: использовать recvmmsg, если он доступен
+    :return: список размеров принятых пакетов, i-й пакет лежит в buffers[i]
+    """
+    if not buffers:
+        return []
+    ready, _, _ = select.select([sock], [], [], timeout)
+    if not ready:
+        return []
+    if use_mmsg and available:
+        count = len(buffers)
+        iovecs = (_IOVec * count)()
+        messages = (_MMsgHdr * count)()
+        for i, buffer in enumerate(buffers):
+            iovecs[i].iov_base = ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+            iovecs[i].iov_len = len(buffer)
+            messages[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            messages[i].msg_hdr.msg_iovlen = 1
+        received = _libc.recvmmsg(sock.fileno(), ctypes.addressof(messages), count, MSG_DONTWAIT, None)
+        if received < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        return [messages[i].msg_len for i in range(received)]
+    sizes = []
+    for buffer in buffers:
+        try:
+            sizes.append(sock.recv_into(buffer, 0, MSG_DONTWAIT))
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            break
+    return sizes
+
+
+def send_batch(sock, messages, use_mmsg=True):
+    """
+    Посылка нескольких пакетов одним вызовом
+    :type sock: socket.socket
+    :type messages: list
+    :type use_mmsg: bool
+    :param sock: сырой сокет
+    :param messages: список пар (пакет, ip адресата)
+    :param use_mmsg: использовать sendmmsg, если он доступен
+    """
+    if use_mmsg and available and len(messages) > 1:
+        count = len(messages)
+        iovecs = (_IOVec * count)()
+        addresses = (_SockAddrIn * count)()
+        headers = (_MMsgHdr * count)()
+        # ссылки на буферы должны жить до конца вызова
+        keep = []
+        for i, (data, ip) in enumerate(messages):
+            buffer = ctypes.create_string_buffer(bytes(data), len(data))
+            keep.append(buffer)
+            iovecs[i].iov_base = ctypes.addressof(buffer)
+            iovecs[i].iov_len = len(data)
+            addresses[i].sin_family = socket.AF_INET
+            addresses[i].sin_addr = struct.unpack("=I", socket.inet_aton(ip))[0]
+            headers[i].msg_hdr.msg_name = ctypes.addressof(addresses[i])
+            headers[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            headers[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            headers[i].msg_hdr.msg_iovlen = 1
+        sent = 0
+        while sent < count:
+            result = _libc.sendmmsg(sock.fileno(), ctypes.addressof(headers) + sent * ctypes.sizeof(_MMsgHdr),
+                                    count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    # остаток посылается по одному пакету с ожиданием
+                    break
+                raise OSError(err, os.strerror(err))
+            sent += result
+        messages = messages[sent:]
+    for data, ip in messages:
+        sock.sendto(data, (ip, 0))
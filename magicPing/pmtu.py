@@ -0,0 +1,163 @@
+"""
+Подбор размера куска по MTU пути до сервера (Path MTU Discovery)
+
+кусок в 65492 байта на канале с MTU 1500 делится на ~45 ip фрагментов,
+и потеря любого из них приводит к повторной посылке всего куска;
+поэтому клиент перед инициализацией посылает серверу пробы
+"magic-ping-smtu" разного размера с запрещённой фрагментацией (флаг DF)
+и выбирает наибольший кусок, который проходит целиком
+"""
+import errno
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from magicPing import bpf
+from magicPing import icmp
+from magicPing import protocol
+
+log = logging.getLogger(__name__)
+
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_MTU = getattr(socket, "IP_MTU", 14)
+
+# ip заголовок, ICMP заголовок и метка сообщения
+PACKET_OVERHEAD = 20 + 8 + 15
+# минимальный MTU, который обязан пропускать любой ipv4 путь
+MIN_MTU = 576
+# размеры пакетов, пробуемые по убыванию, если ядро не знает MTU пути
+MTU_LADDER = (65535, 9000, 4352, 1500, 1492, 1280, MIN_MTU)
+# время ожидания ответа на пробу в секундах и кол-во посылок пробы
+PROBE_TIMEOUT = 0.3
+PROBE_RETRIES = 2
+# время жизни подобранного размера куска в секундах
+PMTU_TTL = 600.
+
+# ip -> (размер куска, время устаревания)
+_chunk_sizes = dict()
+_chunk_sizes_lock = threading.Lock()
+
+
+def chunk_size_for_mtu(mtu):
+    """
+    наибольший кусок, пакет с которым не превышает mtu
+    :type mtu: int
+    :param mtu: размер ip пакета
+    :return: размер куска
+    """
+    return max(1, min(protocol.CHUNK_SIZE, mtu - PACKET_OVERHEAD))
+
+
+def probe_reply(data):
+    """
+    Ответ сервера на пробу
+    :type data: bytes или memoryview
+    :param data: данные пробы "magic-ping-smtu"
+    :return: данные ответа "magic-ping-rmtu" с размером принятой пробы
+    """
+    return b'magic-ping-rmtu' + struct.pack("!H", len(data))
+
+
+def route_mtu(sock):
+    """
+    MTU пути, известный ядру (с учётом принятых ICMP "fragmentation needed")
+    :type sock: socket.socket
+    :param sock: сокет, соединённый с адресатом
+    :return: MTU или None
+    """
+    try:
+        return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+
+
+def probe(sock, demultiplexer, ip, mtu, seq_num, timeout=PROBE_TIMEOUT):
+    """
+    Посылка пробы размером mtu с флагом DF
+    :type sock: socket.socket
+    :type demultiplexer: magicPing.demux.Demultiplexer
+    :type ip: str
+    :type mtu: int
+    :type seq_num: int
+    :type timeout: float
+    :param sock: сокет для проб, соединённый с адресатом
+    :param demultiplexer: раздатчик, принимающий ответы
+    :param ip: адресат
+    :param mtu: размер ip пакета пробы
+    :param seq_num: номер пробы
+    :param timeout: время ожидания ответа в секундах
+    :return: True, если проба дошла до сервера целиком
+    """
+    data = bytes(mtu - PACKET_OVERHEAD)
+    with demultiplexer.subscribe(ip, 0, seq_num, b'magic-ping-rmtu') as waiter:
+        for _ in range(PROBE_RETRIES):
+            try:
+                icmp.send_echo(sock, ip, 8, 0, seq_num, b'magic-ping-smtu', data)
+            except OSError as e:
+                if e.errno == errno.EMSGSIZE:
+                    # пакет больше MTU пути, известного ядру
+                    return False
+                raise
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                try:
+                    _, _, _, reply = waiter.receive(deadline - time.time())
+                except socket.timeout:
+                    break
+                if len(reply) >= 17 and struct.unpack("!H", reply[15:17])[0] == len(data) + 15:
+                    return True
+    return False
+
+
+def probe_chunk_size(demultiplexer, ip):
+    """
+    Подбор размера куска для адресата (результат кэшируется на PMTU_TTL секунд)
+    :type demultiplexer: magicPing.demux.Demultiplexer
+    :type ip: str
+    :param demultiplexer: запущенный раздатчик пакетов клиента
+    :param ip: адресат
+    :return: размер куска
+    """
+    now = time.time()
+    cached = _chunk_sizes.get(ip)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    chunk_size = protocol.CHUNK_SIZE
+    # пробы посылаются отдельным сокетом, чтобы флаг DF
+    # не влиял на посылку данных через общий сокет
+    with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as sock:
+        # ответы принимает раздатчик, этот сокет ничего не читает
+        bpf.attach_filter(sock, bpf.reject_all())
+        sock.connect((ip, 0))
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        except OSError as e:
+            log.debug("Флаг DF не установлен, MTU не подбирается: %s", e)
+            return chunk_size
+        seq_num = random.randrange(protocol.SEQ_SPACE)
+        if not probe(sock, demultiplexer, ip, MIN_MTU, seq_num):
+            # сервер не отвечает на пробы (старая версия): куски прежнего размера
+            log.debug("Сервер не ответил на пробу MTU: ip: %s", ip)
+            return chunk_size
+        chunk_size = chunk_size_for_mtu(MIN_MTU)
+        known = route_mtu(sock)
+        candidates = sorted(set(mtu for mtu in MTU_LADDER + ((known,) if known else ())
+                                if MIN_MTU < mtu <= (known or 65535)), reverse=True)
+        while candidates:
+            mtu = candidates.pop(0)
+            seq_num = (seq_num + 1) % protocol.SEQ_SPACE
+            if probe(sock, demultiplexer, ip, mtu, seq_num):
+                chunk_size = chunk_size_for_mtu(mtu)
+                break
+            known = route_mtu(sock)
+            if known is not None and MIN_MTU < known < mtu and known not in candidates:
+                # ядро узнало MTU пути из ICMP "fragmentation needed"
+                candidates = sorted(candidates + [known], reverse=True)
+    log.info("Подобран размер куска: ip: %s; размер: %d", ip, chunk_size)
+    with _chunk_sizes_lock:
+        _chunk_sizes[ip] = (chunk_size, now + PMTU_TTL)
+    return chunk_size
@@ -0,0 +1,323 @@
+"""
+Общие константы и вспомогательные функции протокола magic-ping
+(формат сообщений описан в __init__.py)
+"""
+import collections
+import struct
+
+# максимальный размер данных в одном пакете "magic-ping-send"
+CHUNK_SIZE = 65492
+# размер пространства номеров сообщений ICMP ECHO
+SEQ_SPACE = 65536
+# максимальное кол-во кусков, одновременно находящихся в пути;
+# не больше половины пространства номеров, чтобы сервер мог
+# отличить новый кусок от повторно посланного старого
+MAX_WINDOW_SIZE = SEQ_SPACE // 2
+# размер приёмного буфера сервера
+RECEIVE_BUFFER_SIZE = 256 * CHUNK_SIZE
+
+# флаги инициализирующего сообщения
+FLAG_CYPHER = 0x1
+FLAG_SACK = 0x2
+# после размера файла идут 2 байта размера куска
+FLAG_CHUNK_SIZE = 0x4
+# соединение передаёт один участок файла (полосу), после размера куска
+# идут смещение и размер участка и кол-во полос файла
+FLAG_STRIPE = 0x8
+# максимальное кол-во полос одного файла
+MAX_STRIPES = 255
+# каждый кусок "magic-ping-send" начинается с 8 байт смещения в файле,
+# так что номер куска не зависит от переполнения seq_num;
+# сервер подтверждает флаг в ответе на инициализацию
+FLAG_OFFSET = 0x10
+# размер поля смещения
+OFFSET_SIZE = 8
+# клиент просит продолжить прерванную передачу того же файла:
+# после полей полосы идут 16 байт отпечатка содержимого,
+# а сервер возвращает в ответе смещение, с которого продолжать
+FLAG_RESUME = 0x20
+# размер отпечатка содержимого
+FINGERPRINT_SIZE = 16
+# куски сжимаются (magicPing.compression): после отпечатка идёт
+# байт алгоритма сжатия, а данные каждого куска "magic-ping-send"
+# начинаются с байта способа кодирования куска
+FLAG_COMPRESS = 0x40
+# размер поля способа кодирования куска
+MODE_SIZE = 1
+# дедупликация (magicPing.dedup): до посылки данных клиент посылает
+# хеши блоков "magic-ping-sman", а сервер отвечает "magic-ping-rman",
+# какие блоки у него уже есть; используется только вместе с FLAG_OFFSET
+FLAG_DEDUP = 0x80
+# размер блока дедупликации и его хеша
+DEDUP_BLOCK_SIZE = 65536
+HASH_SIZE = 16
+# проверка целостности (magicPing.integrity) запрашивается после инициализации
+# сообщением "magic-ping-sver" (все флаги инициализации уже заняты):
+# младшие биты - алгоритм хеша участка, VERIFY_CRC - CRC32 каждого куска;
+# сервер отвечает "magic-ping-rver" с принятыми параметрами
+VERIFY_ALGORITHM_MASK = 0x0f
+VERIFY_CRC = 0x80
+# размер поля CRC32 в начале "magic-ping-send" (при VERIFY_CRC)
+CRC_SIZE = 4
+# результат сравнения хешей в "magic-ping-rfin"
+VERIFY_OK = 0
+VERIFY_MISMATCH = 1
+VERIFY_ERROR = 2
+# флаги, которые сервер подтверждает в ответе на инициализацию
+NEGOTIATED_FLAGS = FLAG_OFFSET | FLAG_RESUME | FLAG_COMPRESS | FLAG_DEDUP
+
+# разобранное инициализирующее сообщение
+InitMessage = collections.namedtuple("InitMessage", "flags size chunk_size stripe fingerprint codec filename")
+
+
+def seq_delta(seq_num, base_seq_num):
+    """
+    расстояние от base_seq_num до seq_num с учётом переполнения
+    :type seq_num: int
+    :type base_seq_num: int
+    :param seq_num: номер сообщения
+    :param base_seq_num: номер, от которого ведётся отсчёт
+    :return: расстояние в диапазоне [0, SEQ_SPACE)
+    """
+    return (seq_num - base_seq_num) % SEQ_SPACE
+
+
+def chunk_count(size, chunk_size=CHUNK_SIZE):
+    """
+    кол-во кусков, на которые разбивается файл
+    :type size: int
+    :type chunk_size: int
+    :param size: размер файла
+    :param chunk_size: размер куска
+    :return: кол-во кусков
+    """
+    return size // chunk_size + (1 if size % chunk_size else 0)
+
+
+def pack_init(flags, size, filename, chunk_size=CHUNK_SIZE, stripe=None, fingerprint=None, codec=None):
+    """
+    тело инициализирующего сообщения "magic-ping-sini";
+    флаги FLAG_CHUNK_SIZE, FLAG_STRIPE, FLAG_RESUME и FLAG_COMPRESS выставляются по параметрам
+    :type flags: int
+    :type size: int
+    :type filename: bytes
+    :type chunk_size: int
+    :type stripe: tuple или None
+    :param flags: флаги
+    :param size: размер файла
+    :param filename: имя файла в utf-8
+    :param chunk_size: размер куска
+    :param stripe: кортеж (смещение участка, размер участка, кол-во полос)
+                   или None, если файл передаётся одним соединением
+    :param fingerprint: отпечаток содержимого (FINGERPRINT_SIZE байт)
+                        или None, если продолжение передачи не нужно
+    :param codec: номер алгоритма сжатия или None, если куски не сжимаются
+    :return: байты после "magic-ping-sini"
+    """
+    fields = b''
+    if chunk_size != CHUNK_SIZE:
+        # размер по умолчанию не передаётся, чтобы не требовать нового сервера
+        flags |= FLAG_CHUNK_SIZE
+        fields += struct.pack("!H", chunk_size)
+    if stripe is not None:
+        flags |= FLAG_STRIPE
+        fields += struct.pack("!QQB", *stripe)
+    if fingerprint is not None:
+        flags |= FLAG_RESUME
+        fields += fingerprint
+    if codec is not None:
+        flags |= FLAG_COMPRESS
+        fields += struct.pack("!B", codec)
+    return struct.pack("!BQ", flags, size) + fields + filename
+
+
+def unpack_init(data):
+    """
+    разбор тела инициализирующего сообщения "magic-ping-sini"
+    :type data: bytes или memoryview
+    :param data: байты после "magic-ping-sini"
+    :return: InitMessage; stripe - кортеж (смещение участка, размер участка,
+             кол-во полос) или None, fingerprint - байты или None,
+             codec - номер алгоритма сжатия или None, filename - имя файла в utf-8
+    :raise ValueError: сообщение короче своих полей
+    """
+    try:
+        flags, size = struct.unpack("!BQ", data[:9])
+        position = 9
+        chunk_size = CHUNK_SIZE
+        if flags & FLAG_CHUNK_SIZE:
+            chunk_size, = struct.unpack("!H", data[position:position + 2])
+            position += 2
+        stripe = None
+        if flags & FLAG_STRIPE:
+            stripe = struct.unpack("!QQB", data[position:position + 17])
+            position += 17
+    except struct.error as e:
+        raise ValueError("Неверное инициализирующее сообщение") from e
+    fingerprint = None
+    if flags & FLAG_RESUME:
+        fingerprint = bytes(data[position:position + FINGERPRINT_SIZE])
+        position += FINGERPRINT_SIZE
+        if len(fingerprint) != FINGERPRINT_SIZE:
+            raise ValueError("Неверное инициализирующее сообщение")
+    codec = None
+    if flags & FLAG_COMPRESS:
+        if len(data) <= position:
+            raise ValueError("Неверное инициализирующее сообщение")
+        codec = data[position]
+        position += 1
+    return InitMessage(flags, size, chunk_size, stripe, fingerprint, codec, bytes(data[position:]))
+
+
+def pack_init_reply(error, flags=0, resume_offset=0, tail=b''):
+    """
+    тело ответа "magic-ping-rini"
+    :type error: int
+    :type flags: int
+    :type resume_offset: int
+    :type tail: bytes
+    :param error: код ошибки
+    :param flags: подтверждаемые флаги из NEGOTIATED_FLAGS
+                  (0 == байт подтверждения не добавляется)
+    :param resume_offset: смещение, с которого продолжается передача (при FLAG_RESUME)
+    :param tail: смещение полосы и имя файла
+    :return: байты после "magic-ping-rini"
+    """
+    fields = b''
+    if flags:
+        fields = struct.pack("!B", flags)
+        if flags & FLAG_RESUME:
+            fields += struct.pack("!Q", resume_offset)
+    return struct.pack("!B", error) + fields + tail
+
+
+def unpack_init_reply(data, requested_flags, tail_size):
+    """
+    разбор тела ответа "magic-ping-rini"
+    :type data: bytes или memoryview
+    :type requested_flags: int
+    :type tail_size: int
+    :param data: байты после "magic-ping-rini"
+    :param requested_flags: флаги из NEGOTIATED_FLAGS, запрошенные клиентом
+    :param tail_size: размер смещения полосы и имени файла в конце ответа
+    :return: кортеж (код ошибки, подтверждённые флаги,
+                     смещение для продолжения или None)
+    :raise ValueError: поля ответа не соответствуют подтверждённым флагам
+                       (в том числе ответ на другой файл, имя которого
+                       кончается именем этого файла)
+    """
+    if len(data) == 1 + tail_size:
+        # сервер без поддержки этих флагов (или не подтвердивший ни одного)
+        # не добавляет байт подтверждения
+        return data[0], 0, None
+    accepted_flags = data[1] if requested_flags and len(data) > 1 + tail_size else 0
+    size = 10 if accepted_flags & FLAG_RESUME else 2
+    if not accepted_flags or accepted_flags & ~requested_flags or len(data) != size + tail_size:
+        raise ValueError("Неверный ответ на инициализирующее сообщение")
+    resume_offset = None
+    if accepted_flags & FLAG_RESUME:
+        resume_offset, = struct.unpack("!Q", data[2:10])
+    return data[0], accepted_flags, resume_offset
+
+
+def pack_manifest(first_block, hashes):
+    """
+    тело части списка блоков "magic-ping-sman"
+    :type first_block: int
+    :type hashes: bytes
+    :param first_block: номер первого блока части в файле
+    :param hashes: хеши блоков подряд (пусто == конец списка)
+    :return: байты после "magic-ping-sman"
+    """
+    return struct.pack("!Q", first_block) + hashes
+
+
+def unpack_manifest(data):
+    """
+    разбор тела "magic-ping-sman"
+    :type data: bytes или memoryview
+    :param data: байты после "magic-ping-sman"
+    :return: кортеж (номер первого блока, хеши блоков в bytes)
+    :raise ValueError: размер не соответствует целому числу хешей
+    """
+    if len(data) < 8 or (len(data) - 8) % HASH_SIZE:
+        raise ValueError("Неверный список блоков")
+    return struct.unpack("!Q", data[:8])[0], bytes(data[8:])
+
+
+def pack_manifest_reply(first_block, present_offsets):
+    """
+    тело ответа "magic-ping-rman"
+    :type first_block: int
+    :type present_offsets: collections.Iterable
+    :param first_block: номер первого блока части из "magic-ping-sman"
+    :param present_offsets: номера найденных блоков относительно first_block
+    :return: байты после "magic-ping-rman"
+    """
+    bitmap = 0
+    length = 0
+    for offset in present_offsets:
+        bitmap |= 1 << offset
+        length = max(length, offset // 8 + 1)
+    return struct.pack("!Q", first_block) + bitmap.to_bytes(length, "little")
+
+
+def unpack_manifest_reply(data):
+    """
+    разбор тела ответа "magic-ping-rman"
+    :type data: bytes или memoryview
+    :param data: байты после "magic-ping-rman"
+    :return: кортеж (номер первого блока части, список номеров найденных блоков)
+    :raise ValueError: ответ короче номера блока
+    """
+    if len(data) < 8:
+        raise ValueError("Неверный ответ на список блоков")
+    first_block, = struct.unpack("!Q", data[:8])
+    bitmap = int.from_bytes(data[8:], "little")
+    present = []
+    block = first_block
+    while bitmap:
+        if bitmap & 1:
+            present.append(block)
+        bitmap >>= 1
+        block += 1
+    return first_block, present
+
+
+def pack_sack(cumulative_seq_num, received_offsets):
+    """
+    тело ответа "magic-ping-sack"
+    :type cumulative_seq_num: int
+    :type received_offsets: collections.Iterable
+    :param cumulative_seq_num: номер первого не принятого куска
+                               (все предыдущие куски приняты)
+    :param received_offsets: смещения принятых кусков относительно
+                             cumulative_seq_num + 1
+    :return: байты после "magic-ping-sack"
+    """
+    bitmap = 0
+    length = 0
+    for offset in received_offsets:
+        bitmap |= 1 << offset
+        length = max(length, offset // 8 + 1)
+    return struct.pack("!H", cumulative_seq_num) + bitmap.to_bytes(length, "little")
+
+
+def unpack_sack(data):
+    """
+    разбор тела ответа "magic-ping-sack"
+    :type data: bytes или memoryview
+    :param data: байты после "magic-ping-sack"
+    :return: кортеж (номер первого не принятого куска,
+                     список номеров выборочно подтверждённых кусков)
+    """
+    cumulative_seq_num, = struct.unpack("!H", data[:2])
+    bitmap = int.from_bytes(data[2:], "little")
+    selective = []
+    offset = 0
+    while bitmap:
+        if bitmap & 1:
+            selective.append((cumulative_seq_num + 1 + offset) % SEQ_SPACE)
+        bitmap >>= 1
+        offset += 1
+    return cumulative_seq_num, selective
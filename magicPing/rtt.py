@@ -0,0 +1,93 @@
+"""
+Оценка времени приёма-передачи (RTT) и таймаут повторной посылки (RFC 6298)
+
+оценка своя для каждого адресата и общая для всех передач к нему;
+по правилу Карна замеры берутся только по сообщениям, посланным один раз,
+а при каждой потере таймаут удваивается, пока не придёт новый замер
+"""
+import threading
+
+# начальный таймаут, пока замеров нет, в секундах
+INITIAL_TIMEOUT = 1.
+# границы таймаута в секундах; нижняя не меньше задержки подтверждений сервера
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 60.
+# коэффициенты сглаживания и запаса из RFC 6298
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+# максимальное кол-во адресатов, для которых хранится оценка
+ESTIMATORS_SIZE = 1024
+
+# ip -> RttEstimator
+_estimators = dict()
+_estimators_lock = threading.Lock()
+
+
+class RttEstimator:
+    """
+    Сглаженная оценка RTT (SRTT), её разброс (RTTVAR) и таймаут с удвоением
+    """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_TIMEOUT
+        # множитель таймаута после потерь
+        self.backoff_factor = 1
+        self.samples = 0
+        self.lock = threading.Lock()
+
+    def sample(self, rtt):
+        """
+        Учёт замера; сбрасывает удвоение таймаута
+        :type rtt: float
+        :param rtt: время от посылки до ответа в секундах
+                    (только для сообщений, посланных один раз)
+        """
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+            self.rto = min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.srtt + K * self.rttvar))
+            self.backoff_factor = 1
+            self.samples += 1
+
+    def backoff(self):
+        """
+        Удвоение таймаута после потери
+        """
+        with self.lock:
+            if self.rto * self.backoff_factor < MAX_TIMEOUT:
+                self.backoff_factor *= 2
+
+    def timeout(self):
+        """
+        :return: текущий таймаут повторной посылки в секундах
+        """
+        return min(MAX_TIMEOUT, self.rto * self.backoff_factor)
+
+    def __str__(self):
+        if self.srtt is None:
+            return "нет замеров; rto: {:.1f} мс".format(self.timeout() * 1000)
+        return "srtt: {:.2f} мс; rttvar: {:.2f} мс; rto: {:.1f} мс; замеров: {}".format(
+            self.srtt * 1000, self.rttvar * 1000, self.timeout() * 1000, self.samples)
+
+
+def estimator(ip):
+    """
+    Оценка RTT для адресата
+    :type ip: str
+    :param ip: адресат
+    :return: RttEstimator
+    """
+    with _estimators_lock:
+        result = _estimators.get(ip)
+        if result is None:
+            if len(_estimators) >= ESTIMATORS_SIZE:
+                _estimators.clear()
+            result = _estimators[ip] = RttEstimator()
+        return result
@@ -1,23 +1,47 @@
+import asyncio
+import collections
+import concurrent.futures
 import datetime
+import functools
+import itertools
 import logging
+import multiprocessing
 import socket
 import struct
 import threading
-import itertools
 import pathlib
 import sys
 import os
 import time
+import zlib
 import atexit
 import signal
 
 import math
 from diffiehellman import diffiehellman
 
+import magicPing.bpf
+import magicPing.checkpoint
+import magicPing.compression
+import magicPing.cypher
+import magicPing.dedup
 import magicPing.icmp
+import magicPing.mmsg
+import magicPing.pmtu
+import magicPing.protocol
+import magicPing.sessions
+import magicPing.utils
+import magicPing.integrity
+import magicPing.writer
 
 log = logging.getLogger(__name__)
 
+# максимальное кол-во пакетов одного соединения, обрабатываемых подряд,
+# после чего соединение уступает очередь другим
+SESSION_BATCH = 64
+# кол-во последних ответов "magic-ping-rfin", хранимых для повторных "magic-ping-sfin"
+FINALS_SIZE = 1024
+
 
 class Server:
     """
@@ -30,47 +54,83 @@ class Server:
         """
         Информация о пакете
         """
+        __slots__ = ("ip", "id", "seq_num", "data", "buffer")
 
-        def __init__(self, ip, id, seq_num, data):
+        def __init__(self, ip, id, seq_num, data, buffer=None):
             """
             :type ip: str
             :type id: int
             :type seq_num: int
             :type data: bytes или memoryview
+            :type buffer: bytearray или None
             :param ip: адрес отправителя
             :param id: идентификатор отправителя
             :param seq_num: номер пакета
             :param data: данные
+            :param buffer: буфер из пула, на который ссылается data
             """
             self.ip = ip
             self.id = id
             self.seq_num = seq_num
             self.data = data
+            self.buffer = buffer
 
     class Context:
-        def __init__(self, ip, flags, size, filename):
+        __slots__ = ("ip", "id", "flags", "size", "chunk_size", "range_offset", "range_size", "stripe_count",
+                     "fingerprint", "codec", "dedup", "received_size", "resumed_size", "filename", "seq_num",
+                     "chunk_index", "received_chunks", "pending_acks", "ack_time", "checkpoint_time",
+                     "private_key", "public_key", "cypher", "lock", "start_time", "file", "verifier", "crc")
+
+        def __init__(self, ip, flags, size, filename, chunk_size=magicPing.protocol.CHUNK_SIZE, stripe=None,
+                     fingerprint=None, codec=None, dedup=False):
             """
             Контекст соединения
             :type ip: str
             :type flags: int
             :type size: int
             :type filename: str
+            :type chunk_size: int
+            :type stripe: tuple или None
             :param ip: ip отправителя
             :param flags: флаги
             :param size: размер файла
             :param filename: имя файла
+            :param chunk_size: размер куска (все куски, кроме последнего)
+            :param stripe: кортеж (смещение участка, размер участка, кол-во полос),
+                           если соединение передаёт участок файла
+            :param fingerprint: отпечаток содержимого, если приём можно продолжить
+            :param codec: алгоритм сжатия кусков (magicPing.compression) или None
+            :param dedup: клиент посылает список блоков для дедупликации
             """
             self.ip = ip
+            self.id = None
             self.flags = flags
             self.size = size
+            self.chunk_size = chunk_size
+            self.range_offset, self.range_size, self.stripe_count = stripe or (0, size, 1)
+            self.fingerprint = fingerprint
+            self.codec = codec
+            self.dedup = magicPing.dedup.DedupState() if dedup else None
             self.received_size = 0
+            # принято предыдущими соединениями (при продолжении передачи)
+            self.resumed_size = 0
             self.filename = filename
             self.seq_num = 0
+            self.chunk_index = 0
+            self.received_chunks = set()
+            self.pending_acks = 0
+            self.ack_time = 0.
+            self.checkpoint_time = time.time()
             self.private_key = None
             self.public_key = None
+            self.cypher = None
             self.lock = threading.Lock()
             self.start_time = datetime.datetime.now().isoformat()
             self.file = None
+            # хеш участка (magicPing.integrity.StreamHash), если клиент проверяет целостность
+            self.verifier = None
+            # куски начинаются с CRC32
+            self.crc = False
 
         def __eq__(self, other):
             """
@@ -81,37 +141,133 @@ class Server:
             """
             return (self.ip == other.ip
                     and self.size == other.size
-                    and self.filename == other.filename)
+                    and self.filename == other.filename
+                    and self.range_offset == other.range_offset)
 
         def __str__(self):
             return self.ip + ":" + str(self.size) + ":" + self.filename
 
-    def __init__(self, max_size=1024 ** 3 * 10, thread_num=2, target_path=pathlib.Path(os.getcwd())):
+        def stripe_key(self):
+            """
+            :return: ключ файла, общий для всех его полос
+            """
+            return self.ip, self.size, self.filename, self.stripe_count
+
+        def resume(self, offset):
+            """
+            Продолжение приёма участка с offset: куски до него считаются принятыми
+            :type offset: int
+            :param offset: конец записанной части участка из контрольной точки
+                           (округляется вниз до границы куска)
+            """
+            if offset >= self.range_offset + self.range_size:
+                self.chunk_index = magicPing.protocol.chunk_count(self.range_size, self.chunk_size)
+                self.received_size = self.range_size
+            else:
+                self.chunk_index = (offset - self.range_offset) // self.chunk_size
+                self.received_size = self.chunk_index * self.chunk_size
+            self.seq_num = self.chunk_index % magicPing.protocol.SEQ_SPACE
+            self.resumed_size = self.received_size
+
+        def resume_offset(self):
+            """
+            :return: смещение, с которого клиент продолжает посылку
+            """
+            return self.range_offset + self.resumed_size
+
+        def is_active(self):
+            """
+            :return: True, если клиент уже посылал данные или ключи этому соединению
+            """
+            return bool(self.received_size > self.resumed_size or self.received_chunks
+                        or self.private_key is not None)
+
+    class SharedFile:
+        """
+        Файл, в который пишут несколько соединений (полосы одного файла
+        или продолжения прерванной передачи)
+        """
+        __slots__ = ("file", "path", "joined", "interrupted")
+
+        def __init__(self, file, path):
+            """
+            :type file: magicPing.writer.FileWriter
+            :type path: pathlib.Path
+            :param file: открытый файл
+            :param path: путь до принятого файла (после приёма временный файл
+                         с контрольной точкой переименовывается в него)
+            """
+            self.file = file
+            self.path = path
+            # смещения полос, соединения которых открыты или завершены
+            self.joined = set()
+            # смещения полос, соединения которых прерваны до конца приёма
+            self.interrupted = set()
+
+    def __init__(self, max_size=1024 ** 3 * 10, thread_num=2, target_path=pathlib.Path(os.getcwd()),
+                 ack_every=2, ack_delay=0.02, max_packets=1024, batch_size=32, use_filter=True,
+                 id_range=None, writer_num=2, dedup=True):
         """
         Инициализация сервера
         :type max_size: int
         :type thread_num: int
         :type target_path: pathlib.Path
+        :type ack_every: int
+        :type ack_delay: float
         :param max_size: максимальный размер принимаемого файла
         :param thread_num: кол-во потоков осуществляющих приём данных
         :param target_path: директоория для входящих файлов
+        :param ack_every: кол-во кусков, подтверждаемых одним ответом "magic-ping-sack"
+        :param ack_delay: максимальная задержка подтверждения в секундах
+        :param max_packets: максимальное кол-во принятых, но ещё не обработанных пакетов
+        :param batch_size: кол-во пакетов, принимаемых и посылаемых одним вызовом
+                           (1 == по одному пакету на вызов)
+        :param use_filter: отсеивать чужие ICMP пакеты фильтром в ядре (magicPing.bpf)
+        :param id_range: границы id соединений этого сервера включительно
+                         (None == все id; иначе инициализирующие пакеты
+                         передаются через receive_inits, см. ProcessServer)
+        :param writer_num: кол-во потоков записи в файлы (0 == запись в обработчике пакетов)
+        :param dedup: вести индекс блоков принятых файлов для дедупликации (magicPing.dedup)
         """
         log.debug("Инициализация сервера: Максимальный размер файла: %d;" +
                   " кол-во потоков: %d; директория для входящих файлов: %s",
                   max_size, thread_num, target_path)
-        self.tasks = set()
-        self.tasks_count = threading.Semaphore(0)
-        self.tasks_lock = threading.Lock()
-        self.contexts = dict()
-        self.contexts_lock = threading.Lock()
+        # ключ соединения -> очередь пакетов соединения (FIFO);
+        # очередь существует, пока соединение ждёт в self.ready или обрабатывается
+        self.queues = dict()
+        # соединения с пакетами, ещё не взятые обработчиком
+        self.ready = collections.deque()
+        self.tasks_lock = threading.Condition(threading.Lock())
+        # причина -> кол-во отброшенных пакетов
+        self.dropped = collections.Counter()
+        self.dropped_lock = threading.Lock()
+        self.buffers = magicPing.utils.BufferPool(max_packets)
+        # куски ссылаются на буферы пула, поэтому очередь записи не длиннее пула
+        self.writers = magicPing.writer.WriterPool(writer_num, max_packets)
+        self.batch_size = max(1, batch_size)
+        # ответы, накопленные обработчиком пакетов (у каждого потока свои)
+        self.local = threading.local()
+        self.id_range = id_range
+        self.contexts = magicPing.sessions.SessionTable(id_range=id_range or (1, 65535))
+        # ключ завершённого соединения -> ответ "magic-ping-rfin" (для повторных запросов)
+        self.finals = collections.OrderedDict()
+        self.finals_lock = threading.Lock()
+        # ключ файла (Context.stripe_key) -> Server.SharedFile
+        self.stripes = dict()
+        self.stripes_lock = threading.Lock()
         self.max_size = max_size
         self.runnable = threading.Event()
-        self.connects = dict()
-        self.connects_lock = threading.Lock()
         self.thread_num = thread_num
         self.sock = None
         self.target_path = target_path
+        self.ack_every = max(1, ack_every)
+        self.ack_delay = ack_delay
+        self.use_filter = use_filter
         os.makedirs(str(target_path), exist_ok=True)
+        # индекс блоков принятых файлов; уже принятые файлы при запуске
+        # индексирует только один из процессов ProcessServer
+        self.dedup = magicPing.dedup.DedupIndex(target_path, scan=id_range is None or id_range[0] <= 1,
+                                                enabled=dedup)
         log.debug("Инициализация сервера завершена")
 
     def run(self):
@@ -122,17 +278,25 @@ class Server:
             self.runnable.set()
             with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as sock:
                 self.sock = sock
+                magicPing.icmp.set_receive_buffer(sock, magicPing.protocol.RECEIVE_BUFFER_SIZE)
+                if self.use_filter:
+                    magicPing.bpf.attach_filter(sock, magicPing.bpf.echo_filter([8], magicPing.bpf.REQUEST_TAGS,
+                                                                                 id_range=self.id_range))
 
                 log.info("Сервер запущен")
-                workers = [threading.Thread(target=self.worker) for _ in range(self.thread_num)]
-                for worker in workers:
-                    worker.start()
-                self.listener()
-                for _ in workers:
-                    self.tasks_count.release()
-                for worker in workers:
-                    worker.join()
-                log.info("Сервер завершил работу")
+                with self.writers, self.dedup:
+                    workers = [threading.Thread(target=self.worker) for _ in range(self.thread_num)]
+                    if self.ack_delay > 0:
+                        workers.append(threading.Thread(target=self.ack_flusher))
+                    for worker in workers:
+                        worker.start()
+                    self.listener()
+                    with self.tasks_lock:
+                        self.tasks_lock.notify_all()
+                    for worker in workers:
+                        worker.join()
+                    self.close_sessions()
+                log.info("Сервер завершил работу; отброшено пакетов: %s", dict(self.dropped))
         finally:
             self.sock = None
 
@@ -149,144 +313,1250 @@ class Server:
         """
         self.sock.settimeout(1)
         log.info("Сервер начал прослушивание запросов")
+        buffers = []
         while self.runnable.is_set():
-            try:
-                ip, icmp_id, sequence_num, data = \
-                    magicPing.icmp.receive_echo_request(self.sock, timeout=1, prefix=b'magic-ping-s')
-                if len(data) > 15 and data[:12] == b'magic-ping-s':
-                    with self.tasks_lock:
-                        self.tasks.add(Server.Packet(ip, icmp_id, sequence_num, data))
-                    self.tasks_count.release()
-            except socket.timeout:
-                pass
+            if not buffers:
+                # если все буферы заняты, пакеты копятся в буфере сокета
+                buffer = self.buffers.acquire(timeout=1)
+                if buffer is None:
+                    continue
+                buffers.append(buffer)
+            while len(buffers) < self.batch_size:
+                buffer = self.buffers.acquire(timeout=0)
+                if buffer is None:
+                    break
+                buffers.append(buffer)
+            sizes = magicPing.mmsg.receive_batch(self.sock, buffers, 1, self.batch_size > 1)
+            received = []
+            for buffer, size in zip(buffers, sizes):
+                packet = magicPing.icmp.parse_echo(memoryview(buffer)[:size], 8, prefix=b'magic-ping-s')
+                if packet is not None and len(packet[3]) > 15 and self.owns(packet[1]):
+                    received.append(Server.Packet(*packet, buffer=buffer))
+            if received:
+                self.schedule(received)
+                used = set(id(packet.buffer) for packet in received)
+                buffers = [buffer for buffer in buffers if id(buffer) not in used]
+            # один буфер остаётся у слушателя, остальные возвращаются в пул
+            for buffer in buffers[1:]:
+                self.buffers.release(buffer)
+            del buffers[1:]
+        for buffer in buffers:
+            self.buffers.release(buffer)
         log.info("Сервер закончил прослушивание запросов")
 
-    def worker(self):
+    def owns(self, id):
         """
-        обработчик пакетов
+        Проверка принадлежности соединения этому серверу
+        (нужна, если фильтр в ядре не установлен)
+        :type id: int
+        :param id: идентификатор из пакета
+        :return: True, если пакет обрабатывается этим сервером
         """
-        log.debug("Запущен обработчик пакетов")
-        while self.tasks_count.acquire() and self.runnable.is_set():
+        return self.id_range is None or self.id_range[0] <= id <= self.id_range[1]
+
+    def receive_inits(self, connection):
+        """
+        Приём инициализирующих пакетов от координатора ProcessServer;
+        закрытие соединения или None останавливает сервер
+        :type connection: multiprocessing.connection.Connection
+        :param connection: канал от координатора
+        """
+        while True:
             try:
-                with self.tasks_lock:
-                    task = self.tasks.pop()
-                ip = task.ip
-                id = task.id
-                seq_num = task.seq_num
-                data = task.data
-                log.debug("Началась обработка пакета: ip: %s; id: %d; seq_num: %d", ip, id, seq_num)
-                if id == 0 and seq_num == 0 and len(data) > 24 and data[:15] == b'magic-ping-sini':
-                    # инициализирующий пакет
-                    bytes_filename = data[24:]
-                    filename = pathlib.Path(str(bytes_filename, "UTF-8")).name
-                    log.debug("Принят инициализирующий пакет: ip: %s; id: %s, filename:%s",
-                              ip, id, filename)
-                    context = Server.Context(ip, *struct.unpack("!BQ", data[15:24]), filename)
-                    with self.connects_lock:
-                        self.connects[ip] = id = self.connects.get(ip, 0) + 1
-                    err = 0
-                    if context.size > self.max_size:
-                        log.info("Превышен максимальный размер файла")
-                        err = 1
-                    with self.contexts_lock:
-                        if context in self.contexts.values():
-                            log.info("Такое соединение уже установлено %s", context)
-                            continue
-                        self.contexts[ip + str(id)] = context
-                    magicPing.icmp.send_echo_reply(self.sock, ip, id, 0, b'magic-ping-rini'
-                                                   + struct.pack("!B", err) + bytes_filename)
-                    if err:
-                        continue
-                    print(self.target_path)
-                    print(self.target_path)
-                    print(self.target_path / "{}:{}:{}:{}"
-                          .format(context.start_time, context.ip, id, context.filename))
-                    context.file = open(str(self.target_path / "{}:{}:{}:{}"
-                                            .format(context.start_time, context.ip, id, context.filename)), "wb")
-                    log.info("Начат приём файла: ip: %s; id: %d; filename: %s",
-                             ip, id, context.filename)
-                elif seq_num == 0 and data[:15] == b'magic-ping-skey':
-                    # пакет обмена ключами
-                    log.debug("Начат обмен ключами")
-                    with self.contexts_lock:
-                        context = self.contexts.get(ip + str(id))
-                        if context is None or context.flags & 0x1 == 0:
-                            log.debug("Пакет неопознан: ip: %s; id: %d; seq_num: %d",
-                                      ip, id, seq_num)
-                            continue
-                        elif not context.lock.acquire(False):
-                            continue
-                    if context.private_key is None:
-                        generator = diffiehellman.DiffieHellman(key_length=1024)
-                        generator.generate_public_key()
-                        context.public_key = generator.public_key
-                    magicPing.icmp \
-                        .send_echo_reply(self.sock, ip, id, 0, b'magic-ping-rkey' +
-                                          generator.public_key.to_bytes(int(math.log2(context.public_key)) + 1,
-                                                                        byteorder="big"))
-                    if context.private_key is None:
-                        generator.generate_shared_secret(int.from_bytes(data[15:], "big"))
-                        context.private_key = bytearray.fromhex(generator.shared_key)
+                message = connection.recv()
+            except (EOFError, OSError):
+                message = None
+            if message is None:
+                self.stop()
+                break
+            ip, data = message
+            self.schedule([Server.Packet(ip, 0, 0, data)])
+
+    def schedule(self, packets):
+        """
+        Постановка пакетов в очереди их соединений
+        :type packets: list
+        :param packets: принятые пакеты (Server.Packet)
+        """
+        with self.tasks_lock:
+            for packet in packets:
+                key = magicPing.sessions.session_key(packet.ip, packet.id)
+                queue = self.queues.get(key)
+                if queue is None:
+                    queue = self.queues[key] = collections.deque()
+                    self.ready.append(key)
+                queue.append(packet)
+            self.tasks_lock.notify(len(packets))
+
+    def next_session(self):
+        """
+        Получение соединения в единоличную обработку;
+        пока обработчик не вызовет release_session, другие обработчики
+        пакеты этого соединения не получат
+        :return: кортеж (ключ соединения, список его пакетов по порядку)
+                 или (None, None) при остановке сервера
+        """
+        while True:
+            with self.tasks_lock:
+                if self.ready:
+                    key = self.ready.popleft()
+                    queue = self.queues[key]
+                    tasks = [queue.popleft() for _ in range(min(len(queue), SESSION_BATCH))]
+                    return key, tasks
+                if not self.runnable.is_set():
+                    return None, None
+                if not getattr(self.local, "replies", None):
+                    self.tasks_lock.wait()
+                    continue
+            # пакетов в очереди нет: перед ожиданием посылаются накопленные ответы
+            self.flush_replies()
+
+    def release_session(self, key):
+        """
+        Возвращение соединения планировщику
+        :type key: str
+        :param key: ключ соединения из next_session
+        """
+        with self.tasks_lock:
+            if self.queues[key]:
+                # пришли новые пакеты: соединение встаёт в конец очереди
+                self.ready.append(key)
+                self.tasks_lock.notify()
+            else:
+                del self.queues[key]
+
+    def drop(self, reason, ip, id, seq_num):
+        """
+        Учёт отброшенного пакета
+        :type reason: str
+        :type ip: str
+        :type id: int
+        :type seq_num: int
+        :param reason: причина
+        :param ip: адрес отправителя
+        :param id: идентификатор
+        :param seq_num: номер пакета
+        """
+        with self.dropped_lock:
+            self.dropped[reason] += 1
+        log.debug("Пакет отброшен (%s): ip: %s; id: %d; seq_num: %d", reason, ip, id, seq_num)
+
+    def send_reply(self, ip, id, seq_num, data):
+        """
+        Посылка ECHO REPLY; в обработчике пакетов ответы копятся
+        и посылаются пачкой в flush_replies
+        :type ip: str
+        :type id: int
+        :type seq_num: int
+        :type data: bytes
+        :param ip: адресат
+        :param id: идентификатор
+        :param seq_num: номер сообщения
+        :param data: данные
+        """
+        replies = getattr(self.local, "replies", None)
+        if replies is None:
+            magicPing.icmp.send_echo_reply(self.sock, ip, id, seq_num, data)
+            return
+        replies.append((magicPing.icmp.pack_echo(0, id, seq_num, data), ip))
+        if len(replies) >= self.batch_size:
+            self.flush_replies()
+
+    def flush_replies(self):
+        """
+        Посылка ответов, накопленных обработчиком пакетов
+        """
+        replies = getattr(self.local, "replies", None)
+        if replies:
+            magicPing.mmsg.send_batch(self.sock, replies, self.batch_size > 1)
+            del replies[:]
+
+    def acknowledge(self, context, seq_num, data, immediate=False):
+        """
+        Подтверждение приёма куска данных;
+        должно вызываться с захваченным context.lock
+        :type context: Server.Context
+        :type seq_num: int
+        :type data: bytes или memoryview
+        :type immediate: bool
+        :param context: контекст соединения
+        :param seq_num: номер принятого куска
+        :param data: принятый пакет
+        :param immediate: послать подтверждение без задержки
+        """
+        if not context.flags & magicPing.protocol.FLAG_SACK:
+            self.send_reply(context.ip, context.id, seq_num, b'magic-ping-recv' + data[-1:])
+            return
+        context.pending_acks += 1
+        if (immediate or context.received_chunks
+                or context.pending_acks >= self.ack_every or self.ack_delay <= 0):
+            self.send_sack(context)
+        elif context.pending_acks == 1:
+            context.ack_time = time.time()
+
+    def send_sack(self, context):
+        """
+        Посылка накопительного и выборочного подтверждения;
+        должна вызываться с захваченным context.lock
+        :type context: Server.Context
+        :param context: контекст соединения
+        """
+        context.pending_acks = 0
+        self.send_reply(
+            context.ip, context.id, context.seq_num,
+            b'magic-ping-sack' + magicPing.protocol.pack_sack(
+                context.seq_num, (index - context.chunk_index - 1 for index in context.received_chunks)))
+
+    def flush_acks(self):
+        """
+        посылка отложенных подтверждений, ожидающих дольше self.ack_delay
+        """
+        now = time.time()
+        for context in self.contexts.values():
+            if context.pending_acks and now - context.ack_time >= self.ack_delay \
+                    and context.lock.acquire(False):
+                try:
+                    if context.pending_acks:
+                        self.send_sack(context)
+                finally:
                     context.lock.release()
-                    log.debug("Обмен ключами завершён")
-                elif data[:15] == b'magic-ping-send':
-                    # пакет с куском данных
-                    with self.contexts_lock:
-                        context = self.contexts.get(ip + str(id))
-                        if context is None or context.seq_num < seq_num:
-                            log.debug("Пакет неопознан: ip: %s; id: %d; seq_num: %d",
-                                      ip, id, seq_num)
-                            continue
-                        elif context.seq_num == (seq_num + 1) % 65536:
-                            magicPing.icmp.send_echo_reply(self.sock, ip, id, seq_num,
-                                                           b'magic-ping-recv' + data[-1:])
-                            continue
-                        else:
-                            if not context.lock.acquire(False):
-                                continue
-                    log.debug("Приём пакета: ip: %s; id: %d; seq_num: %d; filename: %s",
-                              ip, id, seq_num, context.filename)
-                    context.received_size += len(data) - 15
-                    if context.received_size > context.size:
-                        log.error("Превышен размер файла")
-                        with self.contexts_lock:
-                            del self.contexts[ip + str(id)]
-                        with self.connects_lock:
-                            self.connects[ip] -= 1
-                    magicPing.icmp.send_echo_reply(self.sock, ip, id, seq_num,
-                                                   b'magic-ping-recv' + data[-1:])
-                    if context.private_key is None:
-                        context.file.write(data[15:])
+
+    def ack_flusher(self):
+        """
+        поток посылки отложенных подтверждений
+        """
+        log.debug("Запущена посылка отложенных подтверждений")
+        while self.runnable.is_set():
+            time.sleep(self.ack_delay / 2)
+            self.flush_acks()
+        log.debug("Завершена посылка отложенных подтверждений")
+
+    def handle_init(self, ip, data):
+        """
+        Обработка инициализирующего пакета
+        :type ip: str
+        :type data: bytes или memoryview
+        :param ip: адрес отправителя
+        :param data: данные пакета
+        :return: контекст нового соединения или None
+        """
+        try:
+            init = magicPing.protocol.unpack_init(data[15:])
+        except ValueError as e:
+            log.info("%s: ip: %s", e, ip)
+            return None
+        flags, size, chunk_size, stripe = init.flags, init.size, init.chunk_size, init.stripe
+        max_chunk_size = magicPing.protocol.CHUNK_SIZE
+        if flags & magicPing.protocol.FLAG_OFFSET:
+            max_chunk_size -= magicPing.protocol.OFFSET_SIZE
+        if flags & magicPing.protocol.FLAG_COMPRESS:
+            max_chunk_size -= magicPing.protocol.MODE_SIZE
+        if not 0 < chunk_size <= max_chunk_size:
+            log.info("Неверный размер куска: %d", chunk_size)
+            return None
+        tail = init.filename
+        if stripe is not None:
+            # ответы полосам одного файла различаются смещением участка
+            tail = struct.pack("!Q", stripe[0]) + init.filename
+            if not (1 < stripe[2] <= magicPing.protocol.MAX_STRIPES
+                    and 0 < stripe[1] and stripe[0] + stripe[1] <= size):
+                log.info("Неверный участок файла: смещение: %d; размер: %d; полос: %d", *stripe)
+                return None
+        # подтверждение флагов, которые клиент может использовать только с новым сервером
+        accepted_flags = flags & magicPing.protocol.NEGOTIATED_FLAGS
+        codec = init.codec
+        if codec is not None and codec not in magicPing.compression.CODECS.values():
+            # алгоритм недоступен: клиент посылает куски без сжатия
+            log.info("Неизвестный алгоритм сжатия: %d; ip: %s", codec, ip)
+            accepted_flags &= ~magicPing.protocol.FLAG_COMPRESS
+            codec = None
+        if flags & magicPing.protocol.FLAG_DEDUP and (
+                not self.dedup.available or not flags & magicPing.protocol.FLAG_OFFSET
+                or flags & magicPing.protocol.FLAG_RESUME):
+            # без индекса или без смещений кусков клиент посылает файл целиком
+            accepted_flags &= ~magicPing.protocol.FLAG_DEDUP
+        filename = pathlib.Path(str(init.filename, "UTF-8")).name
+        log.debug("Принят инициализирующий пакет: ip: %s; filename:%s", ip, filename)
+        context = Server.Context(ip, flags, size, filename, chunk_size, stripe, init.fingerprint, codec,
+                                 bool(accepted_flags & magicPing.protocol.FLAG_DEDUP))
+        if context.size > self.max_size:
+            log.info("Превышен максимальный размер файла")
+            self.send_reply(ip, 0, 0, b'magic-ping-rini' +
+                            magicPing.protocol.pack_init_reply(1, accepted_flags, 0, tail))
+            return None
+        registered = self.contexts.add(context)
+        if registered is not context and flags & magicPing.protocol.FLAG_RESUME and registered.is_active():
+            # клиент прервал передачу и начал её заново, а старое соединение
+            # осталось в таблице: оно закрывается с сохранением контрольной точки
+            log.info("Передача начата заново, прежнее соединение закрывается: %s; id: %d",
+                     registered, registered.id)
+            if not self.abort_session(registered):
+                # прежнее соединение ещё не закрыто: клиент повторит инициализирующий пакет
+                return None
+            registered = self.contexts.add(context)
+        if registered is not context:
+            if registered.file is None:
+                # первый инициализирующий пакет ещё обрабатывается и сам получит ответ
+                return None
+            # ответ на первый инициализирующий пакет мог потеряться
+            log.info("Такое соединение уже установлено %s", registered)
+            self.send_reply(ip, registered.id, 0, b'magic-ping-rini' +
+                            magicPing.protocol.pack_init_reply(0, accepted_flags, registered.resume_offset(), tail))
+            return None
+        id = context.id
+        context.file = self.open_file(context)
+        if context.file is None:
+            self.contexts.remove(context)
+            return None
+        self.send_reply(ip, id, 0, b'magic-ping-rini' +
+                        magicPing.protocol.pack_init_reply(0, accepted_flags, context.resume_offset(), tail))
+        log.info("Начат приём файла: ip: %s; id: %d; filename: %s; размер куска: %d; участок: %d+%d",
+                 ip, id, context.filename, context.chunk_size, context.range_offset, context.range_size)
+        if context.resumed_size:
+            log.info("Приём продолжен: ip: %s; id: %d; принято ранее: %d", ip, id, context.resumed_size)
+        if context.received_size == context.range_size:
+            # участок уже принят целиком (продолжение завершённой полосы или пустой файл)
+            self.close_session(context)
+            return None
+        return context
+
+    def open_file(self, context):
+        """
+        Создание или открытие принимаемого файла;
+        полосы одного файла пишут в общий файл, созданный первой из них,
+        а при продолжении передачи файл открывается вместе с контрольной точкой
+        :type context: Server.Context
+        :param context: контекст нового соединения
+        :return: FileWriter или None, если полоса уже была принята
+        """
+        path = self.target_path / "{}:{}:{}:{}".format(context.start_time, context.ip, context.id, context.filename)
+        if context.stripe_count == 1 and context.fingerprint is None:
+            return self.writers.open(path, context.size)
+        key = context.stripe_key()
+        with self.stripes_lock:
+            shared = self.stripes.get(key)
+            if shared is None or shared.file.closed:
+                shared = self.stripes[key] = Server.SharedFile(self.create_shared_file(context, path), path)
+            elif context.range_offset in shared.joined:
+                # запоздавший повтор инициализации уже завершённой полосы
+                log.info("Полоса уже принята: %s; смещение: %d", context, context.range_offset)
+                return None
+            elif context.range_offset in shared.interrupted:
+                # продолжение прерванной полосы
+                shared.interrupted.remove(context.range_offset)
+                shared.file.share(not shared.interrupted)
+            shared.joined.add(context.range_offset)
+        if shared.file.checkpoint is not None:
+            context.resume(shared.file.checkpoint.resume_offset(
+                context.range_offset, context.range_offset + context.range_size))
+        return shared.file
+
+    def create_shared_file(self, context, path):
+        """
+        Создание файла, общего для полос; файл, приём которого можно продолжить,
+        пишется под временным именем рядом со своей контрольной точкой
+        :type context: Server.Context
+        :type path: pathlib.Path
+        :param context: контекст первого соединения
+        :param path: путь до принятого файла
+        :return: FileWriter
+        """
+        if context.fingerprint is None:
+            return self.writers.open(path, context.size, context.stripe_count)
+        path = self.target_path / "{}:{}:{}.part".format(context.ip, context.filename, context.fingerprint.hex())
+        checkpoint = magicPing.checkpoint.Checkpoint.load(path, context.size, context.fingerprint)
+        file = self.writers.open(path, context.size, context.stripe_count, truncate=not checkpoint.ranges)
+        file.checkpoint = checkpoint
+        return file
+
+    def handle_probe(self, ip, seq_num, data):
+        """
+        Ответ на пробу MTU (соединение для этого не нужно)
+        :type ip: str
+        :type seq_num: int
+        :type data: bytes или memoryview
+        :param ip: адрес отправителя
+        :param seq_num: номер пробы
+        :param data: данные пакета
+        """
+        self.send_reply(ip, 0, seq_num, magicPing.pmtu.probe_reply(data))
+
+    def handle_key(self, context, data):
+        """
+        Обработка пакета обмена ключами;
+        должна вызываться с захваченным context.lock
+        :type context: Server.Context
+        :type data: bytes или memoryview
+        :param context: контекст соединения
+        :param data: данные пакета
+        """
+        if context.flags & magicPing.protocol.FLAG_CYPHER == 0:
+            log.debug("Пакет неопознан: ip: %s; id: %d; seq_num: 0", context.ip, context.id)
+            return
+        log.debug("Начат обмен ключами")
+        if context.private_key is None:
+            generator = diffiehellman.DiffieHellman(key_length=1024)
+            generator.generate_public_key()
+            context.public_key = generator.public_key
+        self.send_reply(context.ip, context.id, 0, b'magic-ping-rkey' +
+                        context.public_key.to_bytes(int(math.log2(context.public_key)) + 1,
+                                                    byteorder="big"))
+        if context.private_key is None:
+            generator.generate_shared_secret(int.from_bytes(data[15:], "big"))
+            context.private_key = bytearray.fromhex(generator.shared_key)
+            context.cypher = magicPing.cypher.Cypher(context.private_key)
+        log.debug("Обмен ключами завершён")
+
+    def accept_chunk(self, context, seq_num, data):
+        """
+        Учёт принятого куска данных и посылка подтверждения;
+        должна вызываться с захваченным context.lock
+        :type context: Server.Context
+        :type seq_num: int
+        :type data: bytes или memoryview
+        :param context: контекст соединения
+        :param seq_num: номер куска
+        :param data: данные пакета
+        :return: кортеж (смещение в файле, данные для записи, приём завершён)
+                 или None, если записывать нечего; при сжатии данные
+                 начинаются со способа кодирования куска
+        """
+        header_size = 15
+        if context.crc:
+            # CRC32 покрывает всё, что идёт после него; повреждённый кусок
+            # не подтверждается и посылается клиентом повторно
+            header_size += magicPing.protocol.CRC_SIZE
+            if len(data) < header_size or struct.unpack("!I", data[15:header_size])[0] != \
+                    magicPing.integrity.chunk_crc(data[header_size:]):
+                self.drop("crc", context.ip, context.id, seq_num)
+                return None
+        if context.flags & magicPing.protocol.FLAG_OFFSET:
+            # номер куска определяется по смещению, а не по seq_num
+            header_size += magicPing.protocol.OFFSET_SIZE
+            if len(data) < header_size:
+                self.drop("offset", context.ip, context.id, seq_num)
+                return None
+            offset = struct.unpack("!Q", data[header_size - magicPing.protocol.OFFSET_SIZE:header_size])[0]
+            offset -= context.range_offset
+            if offset < 0 or offset % context.chunk_size:
+                self.drop("offset", context.ip, context.id, seq_num)
+                return None
+            index = position = offset // context.chunk_size
+            if context.dedup is not None:
+                if context.dedup.chunk_map is None:
+                    # данные раньше конца списка блоков не ожидаются
+                    self.drop("manifest", context.ip, context.id, seq_num)
+                    return None
+                # подтверждения ведутся по порядковым номерам передаваемых кусков
+                position = context.dedup.chunk_map.position(index)
+            delta = position - context.chunk_index if position is not None else -1
+            stale = delta < 0
+        else:
+            delta = magicPing.protocol.seq_delta(seq_num, context.seq_num)
+            index = position = context.chunk_index + delta
+            stale = delta >= magicPing.protocol.SEQ_SPACE - magicPing.protocol.MAX_WINDOW_SIZE
+        if stale or position in context.received_chunks:
+            # повторно посланный уже принятый кусок
+            self.acknowledge(context, seq_num, data, True)
+            return None
+        elif delta >= magicPing.protocol.MAX_WINDOW_SIZE:
+            self.drop("window", context.ip, context.id, seq_num)
+            return None
+        log.debug("Приём пакета: ip: %s; id: %d; seq_num: %d; filename: %s",
+                  context.ip, context.id, seq_num, context.filename)
+        chunk_size = len(data) - header_size
+        if context.codec is not None:
+            # перед данными идёт способ кодирования; сжатый и нулевой куски
+            # занимают в файле полный размер (последний - до конца участка)
+            mode = data[header_size] if chunk_size > 0 else None
+            if mode not in magicPing.compression.MODES:
+                self.drop("compression", context.ip, context.id, seq_num)
+                return None
+            chunk_size -= magicPing.protocol.MODE_SIZE
+            if mode != magicPing.compression.MODE_RAW:
+                chunk_size = max(0, min(context.chunk_size, context.range_size - index * context.chunk_size))
+        context.received_size += chunk_size
+        if (context.received_size > context.range_size
+                or chunk_size > context.chunk_size
+                or index * context.chunk_size >= context.range_size
+                or index * context.chunk_size + chunk_size > context.range_size):
+            log.error("Превышен размер файла")
+            self.close_session(context)
+            return None
+        context.received_chunks.add(position)
+        while context.chunk_index in context.received_chunks:
+            context.received_chunks.remove(context.chunk_index)
+            context.chunk_index += 1
+        context.seq_num = context.chunk_index % magicPing.protocol.SEQ_SPACE
+        completed = context.received_size == context.range_size
+        self.acknowledge(context, seq_num, data, completed)
+        return context.range_offset + index * context.chunk_size, data[header_size:], completed
+
+    def handle_manifest(self, context, data):
+        """
+        Обработка части списка блоков: найденные в индексе блоки копируются
+        в принимаемый файл, клиенту отправляется, какие блоки найдены;
+        пустая часть завершает список. Должна вызываться с захваченным context.lock
+        :type context: Server.Context
+        :type data: bytes или memoryview
+        :param context: контекст соединения
+        :param data: данные пакета
+        """
+        state = context.dedup
+        try:
+            first_block, hashes = magicPing.protocol.unpack_manifest(data[15:])
+        except ValueError:
+            state = None
+        if state is None:
+            self.drop("manifest", context.ip, context.id, 0)
+            return
+        reply = state.replies.get(first_block)
+        if reply is None and not hashes:
+            if state.chunk_map is None:
+                state.chunk_map = magicPing.dedup.ChunkMap(context.range_offset, context.range_size,
+                                                           context.chunk_size, state.present, context.size)
+                context.received_size += state.chunk_map.skipped_size()
+                log.info("Дедупликация: ip: %s; id: %d; найдено блоков: %d; не передаётся: %d байт",
+                         context.ip, context.id, len(state.present), context.received_size)
+            reply = magicPing.protocol.pack_manifest_reply(first_block, ())
+        elif reply is None and state.chunk_map is None:
+            if context.cypher is not None:
+                hashes = context.cypher.xor(hashes)
+            blocks = magicPing.dedup.manifest_blocks(context.range_offset, context.range_size, context.size)
+            found = []
+            for i in range(len(hashes) // magicPing.protocol.HASH_SIZE):
+                block = first_block + i
+                if block not in blocks:
+                    break
+                offset, size = magicPing.dedup.block_span(block, context.size)
+                block_data = self.dedup.fetch(
+                    hashes[i * magicPing.protocol.HASH_SIZE:(i + 1) * magicPing.protocol.HASH_SIZE], size)
+                if block_data is not None:
+                    context.file.write(offset, block_data, verifier=context.verifier)
+                    state.present.add(block)
+                    found.append(i)
+            reply = state.replies[first_block] = magicPing.protocol.pack_manifest_reply(first_block, found)
+        elif reply is None:
+            # часть, не посланная до конца списка, не учитывается
+            reply = magicPing.protocol.pack_manifest_reply(first_block, ())
+        self.send_reply(context.ip, context.id, 0, b'magic-ping-rman' + reply)
+        if (state.chunk_map is not None and context.received_size == context.range_size
+                and context.verifier is None):
+            # все блоки участка нашлись на сервере
+            self.close_session(context)
+
+    def handle_verify(self, context, data):
+        """
+        Обработка запроса проверки целостности: до посылки данных
+        создаётся хеш участка и включается CRC32 кусков, клиенту
+        отправляются принятые параметры. Должна вызываться с захваченным context.lock
+        :type context: Server.Context
+        :type data: bytes или memoryview
+        :param context: контекст соединения
+        :param data: данные пакета
+        """
+        if len(data) != 16:
+            self.drop("verify", context.ip, context.id, 0)
+            return
+        options = data[15]
+        started = (context.received_size > context.resumed_size or context.received_chunks
+                   or (context.dedup is not None and context.dedup.replies))
+        if not started and context.verifier is None and not context.crc:
+            algorithm = options & magicPing.protocol.VERIFY_ALGORITHM_MASK
+            if algorithm in magicPing.integrity.ALGORITHMS.values():
+                context.verifier = magicPing.integrity.StreamHash(algorithm, context.file.path,
+                                                               context.range_offset, context.range_size)
+                # принятое до обрыва передачи дочитывается из файла
+                context.verifier.skip(context.range_offset, context.resumed_size)
+            header_size = magicPing.protocol.CRC_SIZE
+            if context.flags & magicPing.protocol.FLAG_OFFSET:
+                header_size += magicPing.protocol.OFFSET_SIZE
+            if context.codec is not None:
+                header_size += magicPing.protocol.MODE_SIZE
+            # CRC32 занимает часть пакета, клиент уменьшает кусок заранее
+            context.crc = bool(options & magicPing.protocol.VERIFY_CRC
+                               and context.chunk_size + header_size <= magicPing.protocol.CHUNK_SIZE)
+        accepted = context.verifier.algorithm if context.verifier is not None else 0
+        if context.crc:
+            accepted |= magicPing.protocol.VERIFY_CRC
+        self.send_reply(context.ip, context.id, 0, b'magic-ping-rver' + struct.pack("!B", accepted))
+
+    def handle_final(self, context, data):
+        """
+        Сравнение хеша участка с хешем клиента после приёма участка целиком:
+        ожидается запись кусков соединения, клиенту отправляется результат,
+        соединение закрывается. Должна вызываться с захваченным context.lock
+        :type context: Server.Context
+        :type data: bytes или memoryview
+        :param context: контекст соединения
+        :param data: данные пакета
+        """
+        if (context.verifier is None or context.received_size != context.range_size
+                or len(data) != 15 + magicPing.integrity.DIGEST_SIZE):
+            self.drop("final", context.ip, context.id, 0)
+            return
+        digest = bytes(data[15:])
+        if context.cypher is not None:
+            digest = context.cypher.xor(digest)
+        context.file.wait()
+        expected = context.verifier.digest()
+        if expected is None or context.file.error is not None:
+            status = magicPing.protocol.VERIFY_ERROR
+            log.error("Хеш участка не посчитан: ip: %s; id: %d; filename: %s",
+                      context.ip, context.id, context.filename)
+        elif expected != digest:
+            status = magicPing.protocol.VERIFY_MISMATCH
+            log.error("Хеш участка не совпал с хешем клиента: ip: %s; id: %d; filename: %s; участок: %d+%d",
+                      context.ip, context.id, context.filename, context.range_offset, context.range_size)
+        else:
+            status = magicPing.protocol.VERIFY_OK
+            log.info("Целостность подтверждена: ip: %s; id: %d; filename: %s; алгоритм: %s; " +
+                     "дочитано из файла: %d байт", context.ip, context.id, context.filename,
+                     magicPing.integrity.algorithm_name(context.verifier.algorithm), context.verifier.reread)
+        reply = b'magic-ping-rfin' + struct.pack("!B", status)
+        with self.finals_lock:
+            self.finals[magicPing.sessions.session_key(context.ip, context.id)] = reply
+            while len(self.finals) > FINALS_SIZE:
+                self.finals.popitem(last=False)
+        # ответ не ждёт fsync большого файла при закрытии
+        self.send_reply(context.ip, context.id, 0, reply)
+        self.flush_replies()
+        self.close_session(context)
+
+    def repeat_final(self, ip, id):
+        """
+        Повторный ответ на "magic-ping-sfin" уже закрытого соединения
+        (первый ответ мог потеряться)
+        :type ip: str
+        :type id: int
+        :param ip: адрес отправителя
+        :param id: идентификатор
+        :return: True, если ответ послан
+        """
+        with self.finals_lock:
+            reply = self.finals.get(magicPing.sessions.session_key(ip, id))
+        if reply is None:
+            return False
+        self.send_reply(ip, id, 0, reply)
+        return True
+
+    def write_chunk(self, context, offset, data, buffer=None):
+        """
+        Передача куска пулу записи: кусок расшифровывается, распаковывается
+        и пишется по своему смещению в фоновом потоке
+        :type context: Server.Context
+        :type offset: int
+        :type data: bytes или memoryview
+        :type buffer: bytearray или None
+        :param context: контекст соединения
+        :param offset: смещение куска в файле
+        :param data: данные куска
+        :param buffer: буфер из пула, на который ссылается data;
+                       возвращается в пул после записи
+        """
+        on_written = None
+        if buffer is not None:
+            on_written = functools.partial(self.buffers.release, buffer)
+        cypher, decode = context.cypher, None
+        if context.codec is not None:
+            mode, data = data[0], data[magicPing.protocol.MODE_SIZE:]
+            size = min(context.chunk_size, context.range_offset + context.range_size - offset)
+            if mode == magicPing.compression.MODE_ZERO:
+                if context.file.zeroed:
+                    # файл создан заново, нули в нём уже есть
+                    if context.verifier is not None:
+                        context.verifier.update(offset, bytes(size))
+                    if on_written is not None:
+                        on_written()
+                    return
+                data, cypher = bytes(size), None
+            elif mode == magicPing.compression.MODE_COMPRESSED:
+                decode = functools.partial(magicPing.compression.decompress, context.codec, size=size)
+        context.file.write(offset, data, cypher, on_written, decode, context.verifier)
+        log.debug("Приём пакета завершён: ip: %s; id: %d; offset: %d; filename: %s",
+                  context.ip, context.id, offset, context.filename)
+
+    def close_session(self, context):
+        """
+        Завершение соединения: закрытие файла и удаление контекста
+        :type context: Server.Context
+        :param context: контекст соединения
+        """
+        completed = context.received_size == context.range_size
+        file = context.file
+        path = file.path if file is not None else None
+        resumable = file is not None and file.checkpoint is not None
+        if resumable and not completed:
+            # принятое сохраняется, чтобы клиент мог продолжить передачу
+            self.save_checkpoint(context)
+        if file is not None and not file.close(sync=completed):
+            log.error("Ошибка записи файла: ip: %s; id: %d; filename: %s",
+                      context.ip, context.id, context.filename)
+        elif completed:
+            log.info("Завершён приём файла: ip: %s; id: %d; filename: %s; участок: %d+%d",
+                     context.ip, context.id, context.filename, context.range_offset, context.range_size)
+        elif resumable:
+            log.info("Приём прерван, принятое сохранено: ip: %s; id: %d; filename: %s",
+                     context.ip, context.id, context.filename)
+        if file is not None and (context.stripe_count > 1 or resumable):
+            with self.stripes_lock:
+                shared = self.stripes.get(context.stripe_key())
+                if shared is None or shared.file is not file:
+                    shared = None
+                elif file.closed:
+                    # все соединения, пишущие в файл, завершены
+                    del self.stripes[context.stripe_key()]
+                elif resumable and not completed:
+                    shared.joined.discard(context.range_offset)
+                    shared.interrupted.add(context.range_offset)
+            if shared is not None and file.closed and resumable and file.complete and file.error is None:
+                # файл принят целиком: временное имя заменяется обычным
+                try:
+                    os.replace(file.path, str(shared.path))
+                    file.checkpoint.remove()
+                except OSError:
+                    log.exception("Ошибка переименования файла %s", file.path)
+                else:
+                    path = str(shared.path)
+        if file is not None and file.closed and file.complete and file.error is None:
+            # блоки принятого файла могут пригодиться следующим передачам
+            self.dedup.add_file(path)
+        if context.verifier is not None:
+            context.verifier.close()
+        self.contexts.remove(context)
+
+    def abort_session(self, context):
+        """
+        Закрытие соединения, прерванного клиентом
+        (вызывается не из обработчика этого соединения)
+        :type context: Server.Context
+        :param context: контекст соединения
+        :return: True, если соединение закрыто или уже удалено из таблицы
+        """
+        if not context.lock.acquire(timeout=1):
+            log.warning("Соединение занято и не закрыто: %s; id: %d", context, context.id)
+            return False
+        try:
+            if self.contexts.get(context.ip, context.id) is context:
+                self.close_session(context)
+        finally:
+            context.lock.release()
+        return True
+
+    def close_sessions(self):
+        """
+        Закрытие соединений, не завершённых к остановке сервера
+        (соединения, приём которых можно продолжить, сохраняют контрольные точки)
+        """
+        for context in self.contexts.values():
+            self.close_session(context)
+
+    def checkpoint_due(self, context):
+        """
+        :type context: Server.Context
+        :param context: контекст соединения
+        :return: True, если пора сохранить контрольную точку соединения
+        """
+        return (context.file.checkpoint is not None
+                and time.time() - context.checkpoint_time >= magicPing.checkpoint.CHECKPOINT_INTERVAL)
+
+    def save_checkpoint(self, context):
+        """
+        Сохранение контрольной точки: куски, принятые соединением подряд,
+        сбрасываются на диск и отмечаются в контрольной точке файла
+        :type context: Server.Context
+        :param context: контекст соединения
+        """
+        context.checkpoint_time = time.time()
+        written = context.range_offset + min(context.chunk_index * context.chunk_size, context.range_size)
+        if context.file.sync():
+            context.file.checkpoint.update(context.range_offset, written)
+            context.file.checkpoint.save()
+
+    def process_packet(self, task):
+        """
+        Обработка одного пакета
+        :type task: Server.Packet
+        :param task: пакет
+        """
+        ip = task.ip
+        id = task.id
+        seq_num = task.seq_num
+        data = task.data
+        try:
+            log.debug("Началась обработка пакета: ip: %s; id: %d; seq_num: %d", ip, id, seq_num)
+            if id == 0 and seq_num == 0 and len(data) > 24 and data[:15] == b'magic-ping-sini':
+                self.handle_init(ip, data)
+            elif id == 0 and data[:15] == b'magic-ping-smtu':
+                self.handle_probe(ip, seq_num, data)
+            elif ((seq_num == 0 and data[:15] == b'magic-ping-skey') or data[:15] == b'magic-ping-send'
+                  or data[:15] == b'magic-ping-sman' or data[:15] == b'magic-ping-sver'
+                  or data[:15] == b'magic-ping-sfin'):
+                context = self.contexts.get(ip, id)
+                if context is None:
+                    if data[:15] != b'magic-ping-sfin' or not self.repeat_final(ip, id):
+                        self.drop("unknown", ip, id, seq_num)
+                    return
+                # соединение обрабатывается одним потоком,
+                # блокировку может ненадолго захватить только посылка отложенных подтверждений
+                if not context.lock.acquire(timeout=1):
+                    self.drop("contention", ip, id, seq_num)
+                    return
+                try:
+                    if data[:15] == b'magic-ping-skey':
+                        self.handle_key(context, data)
+                    elif data[:15] == b'magic-ping-sman':
+                        self.handle_manifest(context, data)
+                    elif data[:15] == b'magic-ping-sver':
+                        self.handle_verify(context, data)
+                    elif data[:15] == b'magic-ping-sfin':
+                        self.handle_final(context, data)
                     else:
-                        context.file.write(bytes([a ^ b for a, b in zip(data[15:],
-                                                                        itertools.cycle(context.private_key))]))
-                    if context.received_size == context.size:
-                        log.info("Завершён приём файла: ip: %s; id: %d; filename: %s",
-                                 task.ip, task.id, context.filename)
-                        context.file.close()
-                        with self.contexts_lock:
-                            self.connects[ip] -= 1
-                            del self.contexts[ip + str(id)]
-                    context.seq_num = (context.seq_num + 1) % 65536
+                        chunk = self.accept_chunk(context, seq_num, data)
+                        if chunk is not None:
+                            # буфер вернёт в пул поток записи
+                            self.write_chunk(context, chunk[0], chunk[1], task.buffer)
+                            task.buffer = None
+                            if chunk[2]:
+                                if context.verifier is None:
+                                    self.close_session(context)
+                                # иначе соединение закроется после сравнения хешей ("magic-ping-sfin")
+                            elif self.checkpoint_due(context):
+                                self.save_checkpoint(context)
+                finally:
                     context.lock.release()
-                    log.debug("Приём пакета завершён: ip: %s; id: %d; seq_num: %d; filename: %s",
-                              ip, id, seq_num, context.filename)
-                else:
-                    log.debug("Пакет неопознан: ip: %s; id: %d; seq_num: %d",
-                              ip, id, seq_num)
-            except Exception as _:
-                log.exception("Неизвестная ошибка в обработчике пакетов")
-                pass
+            else:
+                self.drop("unknown", ip, id, seq_num)
+        except Exception as _:
+            log.exception("Неизвестная ошибка в обработчике пакетов")
+        finally:
+            if task.buffer is not None:
+                # данные пакета больше не нужны, буфер возвращается в пул
+                task.data = None
+                self.buffers.release(task.buffer)
 
+    def worker(self):
+        """
+        обработчик пакетов
+        """
+        log.debug("Запущен обработчик пакетов")
+        self.local.replies = []
+        while True:
+            key, tasks = self.next_session()
+            if key is None:
+                break
+            for task in tasks:
+                self.process_packet(task)
+            self.release_session(key)
+        self.flush_replies()
         log.debug("Завершён обработчик запросов")
 
 
+class AsyncServer(Server):
+    """
+    Сервер на asyncio: сырой сокет читается через loop.add_reader,
+    каждое соединение обрабатывается своей сопрограммой,
+    а открытие файлов, запись в них и генерация ключей выполняются в пуле из thread_num потоков;
+    файлы сохраняются так же, как в Server
+    """
+
+    # метка в очереди соединения: соединение прервано клиентом и закрывается
+    ABORT = object()
+
+    def __init__(self, *args, **kwargs):
+        """
+        Параметры совпадают с параметрами Server
+        """
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.executor = None
+        # ключ соединения -> очередь пакетов соединения
+        self.sessions = dict()
+
+    def run(self):
+        """
+        запуск сервера
+        """
+        try:
+            self.runnable.set()
+            with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as sock:
+                self.sock = sock
+                magicPing.icmp.set_receive_buffer(sock, magicPing.protocol.RECEIVE_BUFFER_SIZE)
+                if self.use_filter:
+                    magicPing.bpf.attach_filter(sock, magicPing.bpf.echo_filter([8], magicPing.bpf.REQUEST_TAGS))
+                sock.setblocking(False)
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+                self.executor = concurrent.futures.ThreadPoolExecutor(max(1, self.thread_num))
+                log.info("Сервер запущен")
+                try:
+                    with self.writers, self.dedup:
+                        self.loop.run_until_complete(self.serve())
+                        self.close_sessions()
+                finally:
+                    self.executor.shutdown()
+                    self.loop.close()
+                    self.loop = None
+                log.info("Сервер завершил работу; отброшено пакетов: %s", dict(self.dropped))
+        finally:
+            self.sock = None
+
+    async def serve(self):
+        """
+        приём пакетов до остановки сервера
+        """
+        self.loop.add_reader(self.sock.fileno(), self.on_readable)
+        log.info("Сервер начал прослушивание запросов")
+        try:
+            while self.runnable.is_set():
+                await asyncio.sleep(self.ack_delay / 2 if self.ack_delay > 0 else 1)
+                if self.ack_delay > 0:
+                    self.flush_acks()
+        finally:
+            self.loop.remove_reader(self.sock.fileno())
+            for queue in list(self.sessions.values()):
+                queue.put_nowait(None)
+            while self.sessions:
+                await asyncio.sleep(0.01)
+        log.info("Сервер закончил прослушивание запросов")
+
+    def on_readable(self):
+        """
+        чтение всех пакетов, доступных в сокете
+        """
+        buffers = []
+        while len(buffers) < self.batch_size:
+            buffer = self.buffers.acquire(timeout=0)
+            if buffer is None:
+                break
+            buffers.append(buffer)
+        if not buffers:
+            # все буферы заняты: пакет отбрасывается, клиент пошлёт его повторно
+            self.sock.recv(65535)
+            with self.dropped_lock:
+                self.dropped["buffers"] += 1
+            return
+        sizes = magicPing.mmsg.receive_batch(self.sock, buffers, 0, self.batch_size > 1)
+        for buffer, size in itertools.zip_longest(buffers, sizes):
+            packet = None
+            if size is not None:
+                packet = magicPing.icmp.parse_echo(memoryview(buffer)[:size], 8, prefix=b'magic-ping-s')
+            if packet is None or len(packet[3]) <= 15:
+                self.buffers.release(buffer)
+                continue
+            ip, id, seq_num, data = packet
+            if id == 0 and seq_num == 0 and len(data) > 24 and data[:15] == b'magic-ping-sini':
+                # создание файла и чтение контрольной точки выполняются в пуле потоков
+                future = self.loop.run_in_executor(self.executor, self.handle_init, ip, data)
+                future.add_done_callback(functools.partial(self.on_init_done, buffer))
+                continue
+            if id == 0 and data[:15] == b'magic-ping-smtu':
+                self.handle_probe(ip, seq_num, data)
+                self.buffers.release(buffer)
+                continue
+            queue = self.sessions.get(magicPing.sessions.session_key(ip, id))
+            if queue is None:
+                context = self.contexts.get(ip, id)
+                if context is not None and context.file is not None:
+                    # ответ на инициализирующий пакет послан из пула потоков
+                    # раньше, чем сопрограмма соединения запущена
+                    queue = self.start_session(context)
+            if queue is None:
+                if data[:15] != b'magic-ping-sfin' or not self.repeat_final(ip, id):
+                    self.drop("unknown", ip, id, seq_num)
+                self.buffers.release(buffer)
+                continue
+            queue.put_nowait(Server.Packet(ip, id, seq_num, data, buffer))
+
+    def on_init_done(self, buffer, future):
+        """
+        Запуск сопрограммы соединения после обработки инициализирующего пакета
+        :type buffer: bytearray
+        :type future: asyncio.Future
+        :param buffer: буфер пакета
+        :param future: результат handle_init
+        """
+        self.buffers.release(buffer)
+        try:
+            context = future.result()
+        except Exception as _:
+            log.exception("Неизвестная ошибка в обработчике пакетов")
+            return
+        if context is not None and self.contexts.get(context.ip, context.id) is context:
+            self.start_session(context)
+
+    def start_session(self, context):
+        """
+        Запуск сопрограммы соединения, если она ещё не запущена
+        :type context: Server.Context
+        :param context: контекст соединения
+        :return: очередь пакетов соединения или None, если сервер останавливается
+        """
+        key = magicPing.sessions.session_key(context.ip, context.id)
+        queue = self.sessions.get(key)
+        if queue is None and self.runnable.is_set():
+            queue = asyncio.Queue()
+            self.sessions[key] = queue
+            self.loop.create_task(self.session(context, queue))
+        return queue
+
+    def abort_session(self, context):
+        """
+        Закрытие соединения, прерванного клиентом: метка передаётся
+        в очередь соединения, и сопрограмма закрывает его после
+        уже принятых пакетов (вызывается из пула потоков)
+        :type context: Server.Context
+        :param context: контекст соединения
+        :return: False: соединение закрывается позже
+        """
+        self.loop.call_soon_threadsafe(self.queue_abort, context)
+        return False
+
+    def queue_abort(self, context):
+        """
+        Передача метки ABORT сопрограмме соединения
+        :type context: Server.Context
+        :param context: контекст соединения
+        """
+        queue = self.start_session(context)
+        if queue is not None:
+            queue.put_nowait(self.ABORT)
+
+    @staticmethod
+    def call_locked(context, handler, *args):
+        """
+        Вызов обработчика соединения с захваченным context.lock
+        (выполняется в пуле потоков)
+        :type context: Server.Context
+        :type handler: callable
+        :param context: контекст соединения
+        :param handler: обработчик, принимающий контекст и args
+        :return: результат обработчика
+        """
+        with context.lock:
+            return handler(context, *args)
+
+    async def session(self, context, queue):
+        """
+        обработка пакетов одного соединения по порядку
+        :type context: Server.Context
+        :type queue: asyncio.Queue
+        :param context: контекст соединения
+        :param queue: очередь пакетов соединения
+        """
+        key = magicPing.sessions.session_key(context.ip, context.id)
+        try:
+            while True:
+                task = await queue.get()
+                if task is None:
+                    break
+                if task is self.ABORT:
+                    if self.contexts.get(context.ip, context.id) is context:
+                        await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                        context, self.close_session)
+                    break
+                try:
+                    data = task.data
+                    # обработчики вызываются с захваченным context.lock, как в Server;
+                    # в цикле событий блокировка свободна (её держит только пул потоков,
+                    # пока сопрограмма соединения ждёт его), а посылка отложенных подтверждений
+                    # пропускает соединение, пока обработчик выполняется в пуле потоков
+                    if task.seq_num == 0 and data[:15] == b'magic-ping-skey':
+                        # генерация ключей долгая, поэтому выполняется в пуле потоков
+                        await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                        context, self.handle_key, data)
+                    elif data[:15] == b'magic-ping-sman':
+                        # поиск блоков читает ранее принятые файлы
+                        await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                        context, self.handle_manifest, data)
+                    elif data[:15] == b'magic-ping-sver':
+                        await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                        context, self.handle_verify, data)
+                    elif data[:15] == b'magic-ping-sfin':
+                        # ожидание записи, дочитывание и fsync выполняются в пуле потоков
+                        await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                        context, self.handle_final, data)
+                    elif data[:15] == b'magic-ping-send':
+                        with context.lock:
+                            chunk = self.accept_chunk(context, task.seq_num, data)
+                            if chunk is not None and self.writers.thread_num:
+                                # очередь записи не длиннее пула буферов, поэтому не блокирует цикл
+                                self.write_chunk(context, chunk[0], chunk[1], task.buffer)
+                                task.buffer = None
+                        if chunk is not None and task.buffer is not None:
+                            # без потоков записи кусок пишется в вызывающем потоке
+                            buffer, task.buffer = task.buffer, None
+                            await self.loop.run_in_executor(self.executor, self.call_locked, context,
+                                                            self.write_chunk, chunk[0], chunk[1], buffer)
+                        if chunk is not None:
+                            if chunk[2]:
+                                if context.verifier is None:
+                                    # ожидание записи и fsync выполняются в пуле потоков
+                                    await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                                    context, self.close_session)
+                                # иначе соединение закроется после сравнения хешей ("magic-ping-sfin")
+                            elif self.checkpoint_due(context):
+                                await self.loop.run_in_executor(self.executor, self.call_locked,
+                                                                context, self.save_checkpoint)
+                    else:
+                        self.drop("unknown", task.ip, task.id, task.seq_num)
+                except Exception as _:
+                    log.exception("Неизвестная ошибка в обработчике пакетов")
+                finally:
+                    task.data = None
+                    if task.buffer is not None:
+                        self.buffers.release(task.buffer)
+                if self.contexts.get(context.ip, context.id) is not context:
+                    # соединение завершено или прервано
+                    break
+        finally:
+            del self.sessions[key]
+            while not queue.empty():
+                task = queue.get_nowait()
+                if task is not None and task is not self.ABORT:
+                    self.buffers.release(task.buffer)
+
+
+def _run_shard(server_options, connection):
+    """
+    Процесс ProcessServer: Server со своим сырым сокетом и срезом id
+    :type server_options: dict
+    :type connection: multiprocessing.connection.Connection
+    :param server_options: параметры Server
+    :param connection: канал от координатора
+    """
+    # процесс останавливается координатором, а не сигналом демона
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    server = Server(**server_options)
+    threading.Thread(target=server.receive_inits, args=(connection,), daemon=True).start()
+    server.run()
+
+
+class ProcessServer:
+    """
+    Сервер из нескольких процессов, обходящий GIL:
+    каждый процесс - отдельный Server со своим сырым сокетом и своим
+    непересекающимся срезом id соединений (фильтр в ядре пропускает в сокет
+    процесса только его id), а координатор в основном процессе принимает
+    инициализирующие пакеты и раздаёт их процессам по хэшу (ip, размер, имя файла),
+    так что повторные инициализирующие пакеты и полосы одного файла
+    попадают в тот же процесс;
+    id соединению выдаёт процесс из своего среза
+    """
+
+    def __init__(self, max_size=1024 ** 3 * 10, thread_num=2, target_path=pathlib.Path(os.getcwd()),
+                 process_num=2, **server_options):
+        """
+        Инициализация сервера
+        :type process_num: int
+        :param process_num: кол-во процессов
+        (остальные параметры совпадают с параметрами Server
+        и относятся к каждому процессу)
+        """
+        self.process_num = max(1, min(process_num, 65535))
+        self.server_options = dict(server_options, max_size=max_size, thread_num=thread_num,
+                                   target_path=target_path)
+        self.runnable = threading.Event()
+        self.sock = None
+        os.makedirs(str(target_path), exist_ok=True)
+
+    def id_ranges(self):
+        """
+        :return: список непересекающихся срезов [1, 65535], по одному на процесс
+        """
+        size = 65535 // self.process_num
+        return [(1 + i * size, (i + 1) * size if i < self.process_num - 1 else 65535)
+                for i in range(self.process_num)]
+
+    def run(self):
+        """
+        запуск процессов и координатора
+        """
+        connections = []
+        processes = []
+        try:
+            self.runnable.set()
+            for id_range in self.id_ranges():
+                connection, child_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_run_shard,
+                                                  args=(dict(self.server_options, id_range=id_range),
+                                                        child_connection),
+                                                  daemon=True)
+                process.start()
+                child_connection.close()
+                connections.append(connection)
+                processes.append(process)
+            with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as sock:
+                self.sock = sock
+                if self.server_options.get("use_filter", True):
+                    magicPing.bpf.attach_filter(sock, magicPing.bpf.echo_filter(
+                        [8], [b'magic-ping-sini', b'magic-ping-smtu'], 0))
+                log.info("Сервер запущен: процессов: %d", len(processes))
+                self.coordinator(connections)
+        finally:
+            self.sock = None
+            for connection in connections:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                connection.close()
+            for process in processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+            log.info("Сервер завершил работу")
+
+    def stop(self):
+        """
+        остановка сервера
+        """
+        self.runnable.clear()
+        log.info("Сервер завершает работу")
+
+    def coordinator(self, connections):
+        """
+        приём инициализирующих пакетов и раздача их процессам;
+        на пробы MTU координатор отвечает сам
+        :type connections: list
+        :param connections: каналы к процессам
+        """
+        self.sock.settimeout(1)
+        buffer = bytearray(65535)
+        view = memoryview(buffer)
+        while self.runnable.is_set():
+            try:
+                size = self.sock.recv_into(buffer)
+            except socket.timeout:
+                continue
+            packet = magicPing.icmp.parse_echo(view[:size], 8, pref_id=0, prefix=b'magic-ping-s')
+            if packet is None:
+                continue
+            ip, _, seq_num, data = packet
+            if data[:15] == b'magic-ping-smtu':
+                magicPing.icmp.send_echo_reply(self.sock, ip, 0, seq_num, magicPing.pmtu.probe_reply(data))
+                continue
+            if seq_num != 0 or len(data) <= 24 or data[:15] != b'magic-ping-sini':
+                continue
+            try:
+                init = magicPing.protocol.unpack_init(data[15:])
+            except ValueError:
+                continue
+            # полосы одного файла и повторы инициализации попадают в один процесс
+            shard = zlib.crc32(socket.inet_aton(ip) + struct.pack("!Q", init.size) + init.filename) % len(connections)
+            try:
+                connections[shard].send((ip, data.tobytes()))
+            except OSError:
+                log.exception("Процесс %d недоступен", shard)
+
+
 class DaemonServer:
     """
     Демон Сервера
     """
     def __init__(self, max_size, thread_num, target_path, pidfile='/tmp/magic-ping-daemon.pid',
-                 stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
+                 stdin='/dev/null', stdout='/dev/null', stderr='/dev/null', server_class=Server,
+                 **server_options):
         """
         Инициализация демона сервера
         :type max_size: int или None
@@ -303,6 +1573,8 @@ class DaemonServer:
         :param stdin: стандартный поток ввода демона
         :param stdout: стандартный поток вывода демона
         :param stderr: стандартный поток ошибок демона
+        :param server_class: Server или AsyncServer
+        :param server_options: остальные параметры Server
         """
         self.stdin = stdin
         self.stdout = stdout
@@ -311,6 +1583,8 @@ class DaemonServer:
         self.max_size = max_size
         self.thread_num = thread_num
         self.target_path = target_path
+        self.server_class = server_class
+        self.server_options = server_options
         self.server = None
 
     def daemonize(self):
@@ -431,7 +1705,7 @@ class DaemonServer:
         """
         цель демона
         """
-        self.server = Server(self.max_size, self.thread_num, self.target_path)
+        self.server = self.server_class(self.max_size, self.thread_num, self.target_path, **self.server_options)
         signal.signal(signal.SIGTERM, self.signal_terminating)
         self.server.run()
         exit(0)
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""
+Таблица соединений сервера, разбитая на сегменты со своими блокировками
+"""
+import socket
+import threading
+
+# кол-во сегментов таблицы
+SHARD_COUNT = 16
+
+
+def session_key(ip, icmp_id):
+    """
+    ключ соединения
+    :type ip: str
+    :type icmp_id: int
+    :param ip: адрес отправителя
+    :param icmp_id: id соединения
+    :return: кортеж (упакованный адрес, id)
+    """
+    return socket.inet_aton(ip), icmp_id
+
+
+class _Shard:
+    """
+    Сегмент таблицы
+    """
+    __slots__ = ("lock", "items")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = dict()
+
+
+class SessionTable:
+    """
+    Таблица соединений: основной индекс по (упакованный адрес, id)
+    и вторичный индекс по (адрес, размер, имя файла, смещение полосы) для отсеивания
+    повторных инициализирующих пакетов; каждый индекс разбит на сегменты
+    по хэшу ключа, так что обработчики разных соединений
+    не ждут друг друга
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT, id_range=(1, 65535)):
+        """
+        :type shard_count: int
+        :type id_range: tuple
+        :param shard_count: кол-во сегментов
+        :param id_range: границы выдаваемых id (включительно)
+        """
+        self.id_range = id_range
+        self.sessions = [_Shard() for _ in range(shard_count)]
+        self.index = [_Shard() for _ in range(shard_count)]
+        # адрес -> последний выданный id
+        self.last_ids = [_Shard() for _ in range(shard_count)]
+
+    def _shard(self, shards, key):
+        return shards[hash(key) % len(shards)]
+
+    def get(self, ip, icmp_id):
+        """
+        Поиск соединения
+        :type ip: str
+        :type icmp_id: int
+        :param ip: адрес отправителя
+        :param icmp_id: id соединения
+        :return: контекст соединения или None
+        """
+        key = session_key(ip, icmp_id)
+        shard = self._shard(self.sessions, key)
+        with shard.lock:
+            return shard.items.get(key)
+
+    def add(self, context):
+        """
+        Регистрация нового соединения и выдача ему id (context.id)
+        :type context: magicPing.server.Server.Context
+        :param context: контекст соединения
+        :return: context или уже установленное соединение
+                 с тем же адресом, размером, именем файла и полосой
+        """
+        index_key = (context.ip, context.size, context.filename, context.range_offset)
+        index_shard = self._shard(self.index, index_key)
+        with index_shard.lock:
+            existing = index_shard.items.get(index_key)
+            if existing is not None:
+                return existing
+            context.id = self._allocate_id(context.ip)
+            key = session_key(context.ip, context.id)
+            shard = self._shard(self.sessions, key)
+            with shard.lock:
+                shard.items[key] = context
+            index_shard.items[index_key] = context
+        return context
+
+    def _allocate_id(self, ip):
+        """
+        Выдача свободного id для адреса: id растут по кругу в self.id_range
+        и пропускают занятые
+        :type ip: str
+        :param ip: адрес отправителя
+        :return: id
+        """
+        shard = self._shard(self.last_ids, ip)
+        with shard.lock:
+            low, high = self.id_range
+            icmp_id = shard.items.get(ip, high)
+            for _ in range(high - low + 1):
+                icmp_id = icmp_id + 1 if low <= icmp_id < high else low
+                if self.get(ip, icmp_id) is None:
+                    break
+            else:
+                raise OverflowError("Нет свободных id для " + ip)
+            shard.items[ip] = icmp_id
+            return icmp_id
+
+    def remove(self, context):
+        """
+        Удаление соединения
+        :type context: magicPing.server.Server.Context
+        :param context: контекст соединения
+        :return: True, если соединение было в таблице
+        """
+        key = session_key(context.ip, context.id)
+        shard = self._shard(self.sessions, key)
+        with shard.lock:
+            if shard.items.get(key) is not context:
+                return False
+            del shard.items[key]
+        index_key = (context.ip, context.size, context.filename, context.range_offset)
+        index_shard = self._shard(self.index, index_key)
+        with index_shard.lock:
+            if index_shard.items.get(index_key) is context:
+                del index_shard.items[index_key]
+        return True
+
+    def values(self):
+        """
+        :return: список всех соединений
+        """
+        result = []
+        for shard in self.sessions:
+            with shard.lock:
+                result.extend(shard.items.values())
+        return result
+
+    def __len__(self):
+        return sum(len(shard.items) for shard in self.sessions)
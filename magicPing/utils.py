@@ -1,4 +1,5 @@
 import shutil
+import threading
 
 
 def carry_around_add(a, b):
@@ -12,6 +13,39 @@ def carry_around_add(a, b):
     return (c & 0xFFFF) + (c >> 16)
 
 
+def ones_complement_sum(*parts):
+    """
+    16 битная дополняющая сумма сообщения, составленного из частей parts
+
+    используется то, что 2 ** 16 == 1 по модулю 0xFFFF: дополняющая сумма
+    16 битных слов совпадает с остатком от деления всего сообщения,
+    прочитанного как одно большое число, на 0xFFFF, поэтому сумма
+    считается одним делением, а не циклом по словам;
+    части могут иметь нечётную длину и считаться по отдельности,
+    например сумма данных считается один раз, а при изменении заголовка
+    пересчитывается только он
+    :type parts: bytes или memoryview
+    :param parts: части сообщения
+    :return: дополняющая сумма (0 только для сообщения из нулей)
+    """
+    s = 0
+    nonzero = False
+    # сдвиг части на нечётное кол-во байт от конца сообщения равносилен
+    # умножению на 256 по модулю 0xFFFF
+    odd_tail = False
+    for part in reversed(parts):
+        value = int.from_bytes(part, "big")
+        if value:
+            nonzero = True
+            s += value * 256 if odd_tail else value
+        odd_tail ^= len(part) % 2 == 1
+    if odd_tail:
+        # сообщение нечётной длины дополняется нулевым байтом
+        s *= 256
+    s %= 0xFFFF
+    return 0xFFFF if s == 0 and nonzero else s
+
+
 def checksum(msg, avoid_range=range(0)):
     """
     обратный код 16 битной дополняющей суммы елементов msg
@@ -19,21 +53,60 @@ def checksum(msg, avoid_range=range(0)):
     :param avoid_range: диапазон индексов елементов, которые не должны учавствовать в подсчёте
     :return:
     """
-    s = 0
-    for i in range(1, len(msg), 2):
-        a, b = 0, 0
-        if i - 1 not in avoid_range:
-            a = int(msg[i])
-        if i not in avoid_range:
-            b = int(msg[i - 1])
-        w = a | (b << 8)
-        s = carry_around_add(s, w)
-    if len(msg) % 2 == 1:
-        w = 0
-        if len(msg) - 1 not in avoid_range:
-            w = int(msg[len(msg) - 1]) << 8
-        s = carry_around_add(s, w)
-    return ~s & 0xFFFF
+    if len(avoid_range):
+        msg = bytearray(msg)
+        for i in avoid_range:
+            if 0 <= i < len(msg):
+                msg[i] = 0
+    return ~ones_complement_sum(msg) & 0xFFFF
+
+
+class BufferPool:
+    """
+    Ограниченный пул переиспользуемых буферов для recv_into:
+    буферы создаются по мере надобности, но не больше count штук,
+    и должны явно возвращаться в пул методом release
+    """
+
+    def __init__(self, count, size=65535):
+        """
+        :type count: int
+        :type size: int
+        :param count: максимальное кол-во буферов
+        :param size: размер буфера в байтах
+        """
+        self.count = count
+        self.size = size
+        self.allocated = 0
+        self.free = []
+        self.available = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """
+        Получение свободного буфера
+        :type timeout: float или None
+        :param timeout: время ожидания освобождения буфера в секундах
+        :return: bytearray или None, если свободный буфер не появился за timeout
+        """
+        with self.available:
+            if not self.free and self.allocated >= self.count:
+                self.available.wait_for(lambda: self.free, timeout)
+            if self.free:
+                return self.free.pop()
+            if self.allocated < self.count:
+                self.allocated += 1
+                return bytearray(self.size)
+            return None
+
+    def release(self, buffer):
+        """
+        Возвращение буфера в пул
+        :type buffer: bytearray
+        :param buffer: буфер, полученный из acquire
+        """
+        with self.available:
+            self.free.append(buffer)
+            self.available.notify()
 
 
 def print_progress_bar(iteration: int, total: int, prefix: str = '', suffix: str = '',
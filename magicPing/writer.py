@@ -0,0 +1,260 @@
+"""
+Запись принятых кусков в файлы фоновым пулом потоков
+
+файл заранее выделяется на полный размер (posix_fallocate),
+куски пишутся по своим смещениям (os.pwrite) в любом порядке,
+а fsync выполняется один раз при завершении приёма
+(и при контрольных точках, см. magicPing.checkpoint);
+файл может быть общим для нескольких соединений (полос одного файла)
+"""
+import logging
+import os
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class FileWriter:
+    """
+    Принимаемый файл: куски передаются пулу и пишутся по смещениям
+    """
+
+    def __init__(self, pool, path, size, users=1, truncate=True):
+        """
+        :type pool: WriterPool
+        :type path: pathlib.Path или str
+        :type size: int
+        :type users: int
+        :type truncate: bool
+        :param pool: пул, выполняющий запись
+        :param path: путь до файла
+        :param size: размер файла из инициализирующего сообщения
+        :param users: кол-во соединений, пишущих в файл;
+                      файл закрывается после close каждого из них
+        :param truncate: очистить существующий файл (False == продолжение приёма)
+        """
+        self.pool = pool
+        self.path = str(path)
+        self.size = size
+        self.users = users
+        # все соединения завершили приём полностью
+        self.complete = True
+        self.closed = False
+        # контрольная точка (magicPing.checkpoint.Checkpoint), если приём можно продолжить
+        self.checkpoint = None
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0), 0o644)
+        # файл создан заново и заполнен нулями: нулевые куски можно не писать
+        self.zeroed = truncate
+        # номера кусков, переданных пулу, но ещё не записанных
+        self.pending = set()
+        self.last_ticket = 0
+        self.pending_lock = threading.Condition(threading.Lock())
+        self.error = None
+        self.preallocate()
+
+    def preallocate(self):
+        """
+        выделение места под файл целиком, чтобы запись по смещениям
+        не наращивала файл по кускам и не фрагментировала его
+        """
+        if self.size <= 0:
+            return
+        try:
+            os.posix_fallocate(self.fd, 0, self.size)
+        except (AttributeError, OSError) as e:
+            # файловая система не поддерживает выделение места
+            log.debug("posix_fallocate недоступен: %s", e)
+            os.ftruncate(self.fd, self.size)
+
+    def write(self, offset, data, cypher=None, on_written=None, decode=None, verifier=None):
+        """
+        Передача куска пулу
+        :type offset: int
+        :type data: bytes или memoryview
+        :type cypher: magicPing.cypher.Cypher или None
+        :type on_written: callable или None
+        :type decode: callable или None
+        :type verifier: magicPing.integrity.StreamHash или None
+        :param offset: смещение куска в файле
+        :param data: данные куска; должны оставаться неизменными до вызова on_written
+        :param cypher: шифратор для расшифровки куска перед записью
+        :param on_written: вызывается после записи (например, возвращает буфер в пул)
+        :param decode: распаковка куска после расшифровки (данные -> данные для записи);
+                       ValueError считается ошибкой записи
+        :param verifier: хеш участка соединения, в который записанный кусок
+                         добавляется после записи
+        """
+        with self.pending_lock:
+            self.last_ticket += 1
+            ticket = self.last_ticket
+            self.pending.add(ticket)
+        self.pool.submit(self, offset, data, cypher, on_written, ticket, decode, verifier)
+
+    def write_now(self, offset, data, cypher=None, on_written=None, ticket=None, decode=None, verifier=None):
+        """
+        Запись куска в вызывающем потоке (параметры описаны в write)
+        :type ticket: int
+        :param ticket: номер куска из write
+        """
+        try:
+            if cypher is not None:
+                data = cypher.xor(data)
+            if decode is not None:
+                data = decode(data)
+            view = memoryview(data)
+            position = offset
+            while view:
+                written = os.pwrite(self.fd, view, position)
+                view = view[written:]
+                position += written
+            if verifier is not None:
+                verifier.update(offset, data)
+        except OSError as e:
+            self.error = e
+            log.exception("Ошибка записи в файл %s", self.path)
+        except ValueError as e:
+            self.error = e
+            log.error("Кусок не записан в файл %s: %s", self.path, e)
+        finally:
+            if on_written is not None:
+                on_written()
+            with self.pending_lock:
+                self.pending.discard(ticket)
+                self.pending_lock.notify_all()
+
+    def wait(self):
+        """
+        Ожидание записи кусков, переданных до вызова (без сброса на диск);
+        куски, переданные позже, не ожидаются
+        """
+        with self.pending_lock:
+            ticket = self.last_ticket
+            while self.pending and min(self.pending) <= ticket:
+                self.pending_lock.wait()
+
+    def share(self, complete=False):
+        """
+        Ещё одно соединение пишет в файл (продолжение прерванной полосы)
+        :type complete: bool
+        :param complete: прерванных соединений больше нет, отметка
+                         о незавершённом приёме снимается
+        """
+        with self.pending_lock:
+            self.users += 1
+            if complete:
+                self.complete = True
+
+    def sync(self):
+        """
+        Ожидание записи кусков, переданных до вызова, и сброс данных на диск
+        (для контрольной точки); куски, переданные позже, не ожидаются
+        :return: True, если все куски записаны без ошибок
+        """
+        self.wait()
+        try:
+            if self.error is None:
+                getattr(os, "fdatasync", os.fsync)(self.fd)
+        except OSError as e:
+            self.error = e
+            log.exception("Ошибка сброса файла %s на диск", self.path)
+        return self.error is None
+
+    def close(self, sync=True):
+        """
+        Ожидание записи всех кусков и закрытие файла
+        (если файл общий - только последним соединением)
+        :type sync: bool
+        :param sync: сбросить данные на диск (fsync)
+                     (у общего файла - если все соединения его запросили)
+        :return: True, если все куски записаны без ошибок
+        """
+        with self.pending_lock:
+            self.users -= 1
+            self.complete = self.complete and sync
+            if self.users > 0:
+                return self.error is None
+            while self.pending:
+                self.pending_lock.wait()
+            self.closed = True
+        try:
+            if self.complete and self.error is None:
+                os.fsync(self.fd)
+        except OSError as e:
+            self.error = e
+            log.exception("Ошибка сброса файла %s на диск", self.path)
+        finally:
+            os.close(self.fd)
+        return self.error is None
+
+
+class WriterPool:
+    """
+    Пул потоков записи с ограниченной очередью: если диск не успевает,
+    передающий кусок поток ждёт, а не копит данные в памяти
+    """
+
+    def __init__(self, thread_num=2, max_pending=256):
+        """
+        :type thread_num: int
+        :type max_pending: int
+        :param thread_num: кол-во потоков записи (0 == запись в вызывающем потоке)
+        :param max_pending: максимальное кол-во кусков в очереди
+        """
+        self.thread_num = max(0, thread_num)
+        self.tasks = queue.Queue(max(1, max_pending))
+        self.threads = []
+
+    def open(self, path, size, users=1, truncate=True):
+        """
+        Создание принимаемого файла
+        (параметры описаны в FileWriter)
+        :return: FileWriter
+        """
+        return FileWriter(self, path, size, users, truncate)
+
+    def submit(self, file_writer, offset, data, cypher=None, on_written=None, ticket=None, decode=None,
+               verifier=None):
+        """
+        Постановка куска в очередь записи (параметры описаны в FileWriter.write_now)
+        """
+        if not self.threads:
+            file_writer.write_now(offset, data, cypher, on_written, ticket, decode, verifier)
+        else:
+            self.tasks.put((file_writer, offset, data, cypher, on_written, ticket, decode, verifier))
+
+    def start(self):
+        """
+        запуск потоков записи
+        """
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(self.thread_num)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        запись оставшихся кусков и остановка потоков
+        """
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def run(self):
+        """
+        поток записи
+        """
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            file_writer = task[0]
+            file_writer.write_now(*task[1:])
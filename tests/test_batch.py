@@ -0,0 +1,64 @@
+"""
+Тесты посылки набора файлов magicPing.batch
+"""
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+
+from magicPing import batch
+from magicPing import server
+
+
+class ReplyGroupsTest(unittest.TestCase):
+
+    def test_suffixes(self):
+        groups = batch.reply_groups(["a.log", "ba.log", "cba.log", "b.log", "x", "\x10a.log"])
+        self.assertEqual(groups["a.log"], "a.log")
+        self.assertEqual(groups["ba.log"], "a.log")
+        self.assertEqual(groups["cba.log"], "a.log")
+        # ответ без байта подтверждения на "\x10a.log" похож на ответ на "a.log" с FLAG_OFFSET
+        self.assertEqual(groups["\x10a.log"], "a.log")
+        self.assertEqual(groups["b.log"], "b.log")
+        self.assertEqual(groups["x"], "x")
+
+    def test_empty(self):
+        self.assertEqual(batch.reply_groups([]), {})
+
+
+@unittest.skipUnless(hasattr(os, "geteuid") and os.geteuid() == 0, "нужен сырой сокет (root)")
+class SuffixNamesTest(unittest.TestCase):
+    """
+    одновременная посылка файлов, имена которых кончаются одно другим
+    """
+
+    def test_send(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = pathlib.Path(directory) / "source"
+            target = pathlib.Path(directory) / "target"
+            source.mkdir()
+            contents = dict()
+            for name in ["a.log", "b.log"] + [prefix + "a.log" for prefix in "bcdefgh"]:
+                contents[name] = os.urandom(20000 + len(name))
+                (source / name).write_bytes(contents[name])
+            receiver = server.Server(max_size=1 << 20, thread_num=2, target_path=target, dedup=False)
+            thread = threading.Thread(target=receiver.run)
+            thread.start()
+            try:
+                time.sleep(0.3)
+                # длинные имена первыми: ответы на них приходят, пока сеанс "a.log" ждёт своего
+                report = batch.BatchSender(8, timeout=10., resume=False).send(
+                    [str(source / name) for name in sorted(contents, reverse=True)], "127.0.0.1")
+            finally:
+                receiver.stop()
+                thread.join()
+            self.assertEqual(report.failed, [])
+            received = dict((path.name.split(":")[-1], path.read_bytes())
+                            for path in target.iterdir() if not path.name.startswith("."))
+            self.assertEqual(received, contents)
+
+
+if __name__ == "__main__":
+    unittest.main()
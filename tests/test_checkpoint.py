@@ -0,0 +1,76 @@
+"""
+Тесты контрольных точек magicPing.checkpoint
+"""
+import os
+import pathlib
+import tempfile
+import unittest
+
+from magicPing import checkpoint
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.directory.name) / "file.part"
+        self.path.write_bytes(b'')
+        self.fingerprint = bytes(range(16))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_and_load(self):
+        saved = checkpoint.Checkpoint(self.path, 1000, self.fingerprint)
+        saved.update(0, 300)
+        saved.update(500, 700)
+        self.assertTrue(saved.save())
+        loaded = checkpoint.Checkpoint.load(self.path, 1000, self.fingerprint)
+        self.assertEqual(loaded.ranges, {0: 300, 500: 700})
+        self.assertEqual(loaded.resume_offset(0, 500), 300)
+        self.assertEqual(loaded.resume_offset(500, 1000), 700)
+        self.assertFalse(os.path.exists(saved.path + ".tmp"))
+
+    def test_update_keeps_largest(self):
+        state = checkpoint.Checkpoint(self.path, 1000, self.fingerprint)
+        state.update(0, 300)
+        state.update(0, 200)
+        self.assertEqual(state.ranges, {0: 300})
+
+    def test_resume_offset_limited_by_end(self):
+        state = checkpoint.Checkpoint(self.path, 1000, self.fingerprint)
+        state.update(0, 900)
+        self.assertEqual(state.resume_offset(0, 500), 500)
+        self.assertEqual(state.resume_offset(950, 1000), 950)
+
+    def test_other_content(self):
+        saved = checkpoint.Checkpoint(self.path, 1000, self.fingerprint)
+        saved.update(0, 300)
+        saved.save()
+        self.assertEqual(checkpoint.Checkpoint.load(self.path, 1000, bytes(16)).ranges, {})
+        self.assertEqual(checkpoint.Checkpoint.load(self.path, 1001, self.fingerprint).ranges, {})
+
+    def test_missing_part_file(self):
+        saved = checkpoint.Checkpoint(self.path, 1000, self.fingerprint)
+        saved.update(0, 300)
+        saved.save()
+        self.path.unlink()
+        self.assertEqual(checkpoint.Checkpoint.load(self.path, 1000, self.fingerprint).ranges, {})
+
+    def test_damaged(self):
+        with open(str(self.path) + checkpoint.SUFFIX, "w") as file:
+            file.write("{")
+        with self.assertLogs(checkpoint.log, "WARNING"):
+            loaded = checkpoint.Checkpoint.load(self.path, 1000, self.fingerprint)
+        self.assertEqual(loaded.ranges, {})
+
+    def test_remove(self):
+        state = checkpoint.Checkpoint(self.path, 1000, self.fingerprint)
+        state.save()
+        state.remove()
+        self.assertFalse(os.path.exists(state.path))
+        state.remove()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+"""
+Тесты клиента magicPing.client
+"""
+import os
+import queue
+import socket
+import tempfile
+import unittest
+
+from magicPing import client
+from magicPing import protocol
+from magicPing import rtt
+
+# адрес из TEST-NET-1: пакеты в сеть не посылаются
+IP = "192.0.2.1"
+
+
+class FakeWaiter:
+    """
+    Ожидающий, которому ответы кладёт FakeServer
+    """
+
+    def __init__(self):
+        self.packets = queue.Queue()
+
+    def receive(self, timeout=None):
+        try:
+            return self.packets.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+class FakeServer:
+    """
+    Сервер с выборочными подтверждениями: теряет первую посылку кусков из lost,
+    придерживает куски из held до прихода следующего куска
+    и отвечает подтверждениями через FakeWaiter
+    """
+
+    def __init__(self, chunk_size, lost=(), held=(), stale_acks=False):
+        self.chunk_size = chunk_size
+        self.lost = set(lost)
+        self.held = set(held)
+        self.stale_acks = stale_acks
+        self.waiter = FakeWaiter()
+        self.received = dict()
+        # первый не принятый кусок и принятые после него
+        self.next_chunk = 0
+        self.ahead = set()
+        self.sent = []
+        self.pending = []
+        self.last_reply = None
+
+    def subscribe(self, *_):
+        return self.waiter
+
+    def packet(self, seq_num, data, offset):
+        chunk = offset // self.chunk_size if offset is not None else seq_num
+        self.sent.append(chunk)
+        if chunk in self.lost:
+            self.lost.discard(chunk)
+            return
+        if chunk in self.held:
+            self.held.discard(chunk)
+            self.pending.append((chunk, bytes(data)))
+            return
+        for pending_chunk, pending_data in [(chunk, bytes(data))] + self.pending:
+            self.received[pending_chunk] = pending_data
+            if pending_chunk >= self.next_chunk:
+                self.ahead.add(pending_chunk)
+            while self.next_chunk in self.ahead:
+                self.ahead.discard(self.next_chunk)
+                self.next_chunk += 1
+            reply = b'magic-ping-sack' + protocol.pack_sack(
+                self.next_chunk % protocol.SEQ_SPACE, [index - self.next_chunk - 1 for index in self.ahead])
+            if self.stale_acks and self.last_reply is not None:
+                # подтверждение, обогнанное более новым
+                self.waiter.packets.put((IP, 1, 0, reply))
+                reply, self.last_reply = self.last_reply, reply
+            else:
+                self.last_reply = reply
+            self.waiter.packets.put((IP, 1, 0, reply))
+        self.pending = []
+
+
+class ScriptedClient(client.Client):
+    """
+    Клиент, посылающий куски в FakeServer вместо сокета
+    """
+
+    def send_magic_data(self, ip, icmp_id, sequence_num, data, offset=None, mode=None):
+        self.demultiplexer.packet(sequence_num, data, offset)
+
+
+class SendMagicWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(50000)
+        file = tempfile.NamedTemporaryFile(delete=False)
+        file.write(self.data)
+        file.close()
+        self.path = file.name
+        # таймаут повторной посылки - наименьший (замер сбрасывает удвоение после потерь)
+        rtt.estimator(IP).sample(0.001)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def send(self, server, window_size=4, **options):
+        sender = ScriptedClient(timeout=5., window_size=window_size, demultiplexer=server, show_progress=False)
+        with open(self.path, "rb") as file:
+            sender.send_magic_window(IP, 1, file, len(self.data), server.chunk_size, **options)
+        self.assertEqual(b''.join(data for _, data in sorted(server.received.items())), self.data)
+        return server.sent
+
+    def test_no_loss(self):
+        sent = self.send(FakeServer(1000))
+        self.assertEqual(sent, list(range(50)))
+
+    def test_retransmit_lost(self):
+        """
+        потерянные куски посылаются повторно, остальные - один раз
+        """
+        sent = self.send(FakeServer(1000, lost=[2, 30, 49]))
+        self.assertEqual(sorted(sent), sorted(list(range(50)) + [2, 30, 49]))
+
+    def test_fast_retransmit_once(self):
+        """
+        повторы накопительного подтверждения от кусков, посланных до повторной посылки,
+        не вызывают новых повторных посылок
+        """
+        sent = self.send(FakeServer(1000, lost=[10]), window_size=32)
+        self.assertEqual(sent.count(10), 2)
+        self.assertEqual(len(sent), 51)
+
+    def test_lost_window(self):
+        """
+        потеря всего окна восстанавливается по таймауту
+        """
+        sent = self.send(FakeServer(1000, lost=range(4)), window_size=4)
+        self.assertEqual(sorted(sent), sorted(list(range(50)) + list(range(4))))
+
+    def test_out_of_order_acks(self):
+        """
+        подтверждения кусков, принятых не по порядку, и устаревшие
+        накопительные подтверждения не вызывают повторной посылки
+        """
+        sent = self.send(FakeServer(1000, held=[0, 7, 8, 20], stale_acks=True), window_size=8)
+        self.assertEqual(sorted(sent), list(range(50)))
+
+    def test_seq_num_wraparound(self):
+        """
+        номера кусков повторяются после protocol.SEQ_SPACE кусков
+        """
+        self.data = os.urandom(protocol.SEQ_SPACE + 500)
+        with open(self.path, "wb") as file:
+            file.write(self.data)
+        sent = self.send(FakeServer(1, lost=[protocol.SEQ_SPACE - 1, protocol.SEQ_SPACE + 1]),
+                         window_size=64, use_offset=True)
+        self.assertEqual(len(sent), len(self.data) + 2)
+
+    def test_range(self):
+        """
+        посылается только участок файла, начиная с first_chunk
+        """
+        server = FakeServer(1000)
+        server.received = dict((index, self.data[index * 1000:(index + 1) * 1000]) for index in range(10))
+        server.next_chunk = 10
+        sender = ScriptedClient(timeout=5., demultiplexer=server, show_progress=False)
+        with open(self.path, "rb") as file:
+            sender.send_magic_window(IP, 1, file, len(self.data), 1000, 0, 30000, True, 10)
+        self.assertEqual(server.sent, list(range(10, 30)))
+
+    def test_truncated_file(self):
+        """
+        файл, ставший короче во время передачи, прерывает посылку ошибкой
+        """
+        sender = ScriptedClient(timeout=5., demultiplexer=FakeServer(1000), show_progress=False)
+        with open(self.path, "rb") as file:
+            with self.assertRaises(OSError):
+                sender.send_magic_window(IP, 1, file, len(self.data) + 5000, 1000)
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile(delete=False)
+        file.write(os.urandom(4 << 20))
+        file.close()
+        self.path = file.name
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def fingerprint(self):
+        with open(self.path, "rb") as file:
+            return client.file_fingerprint(file, os.path.getsize(self.path))
+
+    def test_same_file(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+        self.assertEqual(len(self.fingerprint()), protocol.FINGERPRINT_SIZE)
+
+    def test_changed_between_samples(self):
+        """
+        изменение между выборочными участками замечается по времени изменения
+        """
+        before = self.fingerprint()
+        stat = os.stat(self.path)
+        with open(self.path, "r+b") as file:
+            file.seek(100000)
+            file.write(os.urandom(100000))
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertNotEqual(self.fingerprint(), before)
+
+
+class StripeRangesTest(unittest.TestCase):
+
+    def test_cover_file(self):
+        for file_size, stripes in ((0, 4), (1000, 4), (10 << 20, 4), (10 << 20, 1000)):
+            with self.subTest(file_size=file_size, stripes=stripes):
+                ranges = client.stripe_ranges(file_size, 1400, stripes)
+                self.assertLessEqual(len(ranges), min(stripes, protocol.MAX_STRIPES))
+                position = 0
+                for offset, size in ranges:
+                    self.assertEqual(offset, position)
+                    self.assertEqual(offset % 1400, 0)
+                    position += size
+                self.assertEqual(position, file_size)
+
+
+class ChunkSizeTest(unittest.TestCase):
+
+    def test_room_for_headers(self):
+        """
+        после смещения, байта способа кодирования и CRC32 в куске остаётся хотя бы байт
+        """
+        options = dict(chunk_size=1, dedup=True, compress="zlib", crc=True)
+        chunk_size = client.Client(**options).chunk_size
+        self.assertGreater(chunk_size - protocol.OFFSET_SIZE - protocol.MODE_SIZE - protocol.CRC_SIZE, 0)
+        self.assertEqual(client.Client(chunk_size=protocol.CHUNK_SIZE * 2).chunk_size, protocol.CHUNK_SIZE)
+        self.assertIsNone(client.Client().chunk_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
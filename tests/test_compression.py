@@ -0,0 +1,58 @@
+"""
+Тесты кодирования кусков magicPing.compression
+"""
+import os
+import unittest
+
+from magicPing import compression
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_modes(self):
+        text = b"magic-ping " * 500
+        for name, codec in sorted(compression.CODECS.items()):
+            with self.subTest(codec=name):
+                self.assertEqual(compression.encode_chunk(codec, bytes(4000)), (compression.MODE_ZERO, b''))
+                mode, data = compression.encode_chunk(codec, text)
+                self.assertEqual(mode, compression.MODE_COMPRESSED)
+                self.assertLess(len(data), len(text))
+                self.assertEqual(compression.decompress(codec, data, len(text)), text)
+                noise = os.urandom(4000)
+                self.assertEqual(compression.encode_chunk(codec, noise), (compression.MODE_RAW, noise))
+
+    def test_memoryview(self):
+        data = memoryview(b"abc" * 1000)[3:]
+        mode, encoded = compression.encode_chunk(compression.CODEC_ZLIB, data)
+        self.assertEqual(mode, compression.MODE_COMPRESSED)
+        self.assertEqual(compression.decompress(compression.CODEC_ZLIB, encoded, len(data)), bytes(data))
+
+    def test_empty(self):
+        self.assertEqual(compression.encode_chunk(compression.CODEC_ZLIB, b'')[0], compression.MODE_RAW)
+
+    def test_wrong_size(self):
+        for name, codec in sorted(compression.CODECS.items()):
+            with self.subTest(codec=name):
+                data = compression.compress(codec, b"x" * 1000)
+                with self.assertRaises(ValueError):
+                    compression.decompress(codec, data, 999)
+                with self.assertRaises(ValueError):
+                    compression.decompress(codec, data, 1001)
+
+    def test_corrupted(self):
+        for name, codec in sorted(compression.CODECS.items()):
+            with self.subTest(codec=name):
+                data = bytearray(compression.compress(codec, os.urandom(100) * 10))
+                data[len(data) // 2:] = bytes(len(data) - len(data) // 2)
+                with self.assertRaises(ValueError):
+                    compression.decompress(codec, bytes(data), 1000)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            compression.compress(255, b"x")
+        with self.assertRaises(ValueError):
+            compression.decompress(255, b"x", 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+"""
+Тесты ограничения скорости magicPing.congestion
+"""
+import time
+import unittest
+
+from magicPing import congestion
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_invalid_rate(self):
+        for rate in (0, -1, float("nan"), float("inf")):
+            with self.subTest(rate=rate):
+                with self.assertRaises(ValueError):
+                    congestion.TokenBucket(rate)
+
+    def test_rate(self):
+        bucket = congestion.TokenBucket(100000., burst=1000)
+        start = time.time()
+        for _ in range(20):
+            bucket.consume(1000)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+
+if __name__ == "__main__":
+    unittest.main()
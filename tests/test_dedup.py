@@ -0,0 +1,81 @@
+"""
+Тесты разбиения участка на передаваемые куски magicPing.dedup
+"""
+import random
+import unittest
+
+from magicPing import dedup
+from magicPing import protocol
+
+BLOCK = protocol.DEDUP_BLOCK_SIZE
+
+
+class ManifestBlocksTest(unittest.TestCase):
+
+    def test_whole_blocks(self):
+        self.assertEqual(dedup.manifest_blocks(0, 10 * BLOCK, 20 * BLOCK), range(0, 10))
+        self.assertEqual(dedup.manifest_blocks(BLOCK // 2, 3 * BLOCK, 20 * BLOCK), range(1, 3))
+
+    def test_short_last_block(self):
+        self.assertEqual(dedup.manifest_blocks(BLOCK, BLOCK + 10, 2 * BLOCK + 10), range(1, 3))
+        self.assertEqual(dedup.block_span(2, 2 * BLOCK + 10), (2 * BLOCK, 10))
+
+    def test_no_blocks(self):
+        self.assertEqual(len(dedup.manifest_blocks(10, 100, 20 * BLOCK)), 0)
+
+
+class ChunkMapTest(unittest.TestCase):
+
+    def check(self, range_offset, range_size, chunk_size, present, file_size):
+        chunk_map = dedup.ChunkMap(range_offset, range_size, chunk_size, present, file_size)
+        covered = set()
+        for block in present:
+            start, size = dedup.block_span(block, file_size)
+            covered.update(range(start, start + size))
+        total = protocol.chunk_count(range_size, chunk_size)
+        sent = []
+        skipped_size = 0
+        for chunk in range(total):
+            start = range_offset + chunk * chunk_size
+            end = min(start + chunk_size, range_offset + range_size)
+            position = chunk_map.position(chunk)
+            if position is None:
+                # пропускаются только куски, целиком покрытые найденными блоками
+                self.assertTrue(all(offset in covered for offset in range(start, end)), chunk)
+                skipped_size += end - start
+            else:
+                self.assertEqual(position, len(sent))
+                self.assertEqual(chunk_map.chunk(position), chunk)
+                sent.append(chunk)
+        self.assertEqual(chunk_map.count, len(sent))
+        self.assertEqual(chunk_map.skipped_size(), skipped_size)
+        return sent
+
+    def test_nothing_present(self):
+        sent = self.check(0, 5 * BLOCK, 1000, [], 5 * BLOCK)
+        self.assertEqual(sent, list(range(protocol.chunk_count(5 * BLOCK, 1000))))
+
+    def test_everything_present(self):
+        file_size = 3 * BLOCK + 123
+        self.assertEqual(self.check(0, file_size, 1400, range(4), file_size), [])
+
+    def test_aligned_chunks(self):
+        sent = self.check(0, 4 * BLOCK, BLOCK // 4, [1, 2], 4 * BLOCK)
+        self.assertEqual(sent, [0, 1, 2, 3, 12, 13, 14, 15])
+
+    def test_random(self):
+        generator = random.Random(1)
+        for _ in range(200):
+            file_size = generator.randrange(1, 12 * BLOCK)
+            range_offset = generator.randrange(file_size)
+            range_size = generator.randrange(1, file_size - range_offset + 1)
+            chunk_size = generator.choice([100, 1400, 9000, BLOCK, 65000])
+            present = [block for block in dedup.manifest_blocks(range_offset, range_size, file_size)
+                       if generator.random() < 0.5]
+            with self.subTest(file_size=file_size, range_offset=range_offset, range_size=range_size,
+                              chunk_size=chunk_size, present=present):
+                self.check(range_offset, range_size, chunk_size, present, file_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
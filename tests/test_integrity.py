@@ -0,0 +1,77 @@
+"""
+Тесты хеша участка magicPing.integrity
+"""
+import hashlib
+import os
+import random
+import tempfile
+import unittest
+import zlib
+
+from magicPing import integrity
+
+
+class StreamHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(300000)
+        file = tempfile.NamedTemporaryFile(delete=False)
+        file.write(self.data)
+        file.close()
+        self.path = file.name
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_in_order(self):
+        verifier = integrity.StreamHash(integrity.ALGORITHM_SHA256, self.path, 1000, 200000)
+        for offset in range(1000, 201000, 7000):
+            verifier.update(offset, self.data[offset:offset + 7000])
+        self.assertEqual(verifier.digest(), hashlib.sha256(self.data[1000:201000]).digest())
+        self.assertEqual(verifier.reread, 0)
+
+    def test_out_of_order(self):
+        """
+        части за границей хеша дочитываются из файла
+        """
+        generator = random.Random(2)
+        for algorithm in sorted(integrity.ALGORITHMS.values()):
+            with self.subTest(algorithm=algorithm):
+                verifier = integrity.StreamHash(algorithm, self.path, 0, len(self.data))
+                offsets = list(range(0, len(self.data), 1400))
+                generator.shuffle(offsets)
+                for offset in offsets:
+                    verifier.update(offset, self.data[offset:offset + 1400])
+                expected = integrity.new_hash(algorithm)
+                expected.update(self.data)
+                self.assertEqual(verifier.digest(), expected.digest())
+
+    def test_skip_and_overlap(self):
+        verifier = integrity.StreamHash(integrity.ALGORITHM_SHA256, self.path, 0, 100000)
+        verifier.skip(0, 30000)
+        verifier.update(20000, self.data[20000:60000])
+        verifier.update(60000, self.data[60000:120000])
+        self.assertEqual(verifier.digest(), hashlib.sha256(self.data[:100000]).digest())
+        self.assertEqual(verifier.reread, 30000)
+
+    def test_incomplete(self):
+        verifier = integrity.StreamHash(integrity.ALGORITHM_SHA256, self.path, 0, 100000)
+        verifier.update(0, self.data[:50000])
+        self.assertIsNone(verifier.digest())
+
+    def test_closed(self):
+        verifier = integrity.StreamHash(integrity.ALGORITHM_SHA256, self.path, 0, 100)
+        verifier.close()
+        verifier.update(0, self.data[:100])
+        self.assertIsNone(verifier.digest())
+
+
+class ChunkCrcTest(unittest.TestCase):
+
+    def test_parts(self):
+        self.assertEqual(integrity.chunk_crc(b'abc', memoryview(b'def')), zlib.crc32(b'abcdef'))
+        self.assertEqual(integrity.chunk_crc(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
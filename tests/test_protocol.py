@@ -0,0 +1,170 @@
+"""
+Тесты форматов сообщений magicPing.protocol
+"""
+import itertools
+import unittest
+
+from magicPing import protocol
+
+
+class SeqDeltaTest(unittest.TestCase):
+
+    def test_forward(self):
+        self.assertEqual(protocol.seq_delta(10, 3), 7)
+        self.assertEqual(protocol.seq_delta(3, 3), 0)
+
+    def test_wraparound(self):
+        self.assertEqual(protocol.seq_delta(1, protocol.SEQ_SPACE - 1), 2)
+        self.assertEqual(protocol.seq_delta(0, protocol.SEQ_SPACE - 1), 1)
+        self.assertEqual(protocol.seq_delta(protocol.SEQ_SPACE - 1, 0), protocol.SEQ_SPACE - 1)
+
+
+class ChunkCountTest(unittest.TestCase):
+
+    def test_chunk_count(self):
+        self.assertEqual(protocol.chunk_count(0, 10), 0)
+        self.assertEqual(protocol.chunk_count(10, 10), 1)
+        self.assertEqual(protocol.chunk_count(11, 10), 2)
+        self.assertEqual(protocol.chunk_count(protocol.CHUNK_SIZE * 3), 3)
+
+
+class InitTest(unittest.TestCase):
+
+    def test_round_trip_all_fields(self):
+        """
+        каждая комбинация необязательных полей разбирается в то же сообщение
+        """
+        filename = "файл.bin".encode("UTF-8")
+        options = itertools.product((protocol.CHUNK_SIZE, 1400),
+                                    (None, (1 << 40, 12345, 7)),
+                                    (None, bytes(range(protocol.FINGERPRINT_SIZE))),
+                                    (None, 1),
+                                    (0, protocol.FLAG_CYPHER, protocol.FLAG_SACK | protocol.FLAG_OFFSET,
+                                     protocol.FLAG_CYPHER | protocol.FLAG_SACK | protocol.FLAG_OFFSET |
+                                     protocol.FLAG_DEDUP))
+        for chunk_size, stripe, fingerprint, codec, flags in options:
+            with self.subTest(chunk_size=chunk_size, stripe=stripe, fingerprint=fingerprint, codec=codec,
+                              flags=flags):
+                data = protocol.pack_init(flags, 1 << 33, filename, chunk_size, stripe, fingerprint, codec)
+                init = protocol.unpack_init(memoryview(data))
+                self.assertEqual(init.size, 1 << 33)
+                self.assertEqual(init.chunk_size, chunk_size)
+                self.assertEqual(init.stripe, stripe)
+                self.assertEqual(init.fingerprint, fingerprint)
+                self.assertEqual(init.codec, codec)
+                self.assertEqual(init.filename, filename)
+                self.assertEqual(init.flags & flags, flags)
+                self.assertEqual(bool(init.flags & protocol.FLAG_CHUNK_SIZE), chunk_size != protocol.CHUNK_SIZE)
+                self.assertEqual(bool(init.flags & protocol.FLAG_STRIPE), stripe is not None)
+                self.assertEqual(bool(init.flags & protocol.FLAG_RESUME), fingerprint is not None)
+                self.assertEqual(bool(init.flags & protocol.FLAG_COMPRESS), codec is not None)
+
+    def test_every_flag_byte(self):
+        """
+        любой байт флагов с полями нужной длины разбирается
+        """
+        fields = {protocol.FLAG_CHUNK_SIZE: b'\x05\x00', protocol.FLAG_STRIPE: bytes(17),
+                  protocol.FLAG_RESUME: bytes(protocol.FINGERPRINT_SIZE), protocol.FLAG_COMPRESS: b'\x01'}
+        for flags in range(256):
+            with self.subTest(flags=flags):
+                body = b''.join(field for flag, field in sorted(fields.items()) if flags & flag)
+                init = protocol.unpack_init(bytes([flags]) + bytes(8) + body + b'name')
+                self.assertEqual(init.flags, flags)
+                self.assertEqual(init.filename, b'name')
+
+    def test_truncated(self):
+        data = protocol.pack_init(0, 100, b'', 1400, (0, 100, 2), bytes(protocol.FINGERPRINT_SIZE), 1)
+        for size in range(len(data)):
+            with self.assertRaises(ValueError):
+                protocol.unpack_init(data[:size])
+
+
+class InitReplyTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        tail = b'\x00' * 8 + b'name'
+        for flags in (protocol.FLAG_OFFSET, protocol.FLAG_RESUME, protocol.NEGOTIATED_FLAGS):
+            with self.subTest(flags=flags):
+                data = protocol.pack_init_reply(0, flags, 1 << 35, tail)
+                error, accepted, offset = protocol.unpack_init_reply(data, protocol.NEGOTIATED_FLAGS, len(tail))
+                self.assertEqual((error, accepted), (0, flags))
+                self.assertEqual(offset, 1 << 35 if flags & protocol.FLAG_RESUME else None)
+
+    def test_old_server(self):
+        """
+        сервер без поддержки флагов не добавляет байт подтверждения
+        """
+        data = protocol.pack_init_reply(1, 0, 0, b'name')
+        self.assertEqual(protocol.unpack_init_reply(data, protocol.FLAG_RESUME, 4), (1, 0, None))
+
+    def test_unrequested_flags(self):
+        data = protocol.pack_init_reply(0, protocol.FLAG_OFFSET | protocol.FLAG_DEDUP)
+        with self.assertRaises(ValueError):
+            protocol.unpack_init_reply(data, protocol.FLAG_OFFSET, 0)
+
+    def test_other_file(self):
+        """
+        ответ на "ba.log" кончается на "a.log", но не принимается ожидающим ответа на "a.log"
+        """
+        tail = b'a.log'
+        for reply_flags, requested_flags in ((0, 0), (0, protocol.FLAG_OFFSET),
+                                             (protocol.FLAG_OFFSET, protocol.FLAG_OFFSET),
+                                             (protocol.FLAG_RESUME, protocol.FLAG_RESUME | protocol.FLAG_OFFSET)):
+            for other in (b'b' + tail, b'cb' + tail, bytes(9) + tail):
+                with self.subTest(reply_flags=reply_flags, requested_flags=requested_flags, other=other):
+                    data = protocol.pack_init_reply(0, reply_flags, 0, other)
+                    self.assertEqual(bytes(data[-len(tail):]), tail)
+                    with self.assertRaises(ValueError):
+                        protocol.unpack_init_reply(data, requested_flags, len(tail))
+
+
+class SackTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = protocol.pack_sack(100, [0, 3, 17])
+        self.assertEqual(protocol.unpack_sack(data), (100, [101, 104, 118]))
+
+    def test_cumulative_only(self):
+        data = protocol.pack_sack(5, [])
+        self.assertEqual(len(data), 2)
+        self.assertEqual(protocol.unpack_sack(data), (5, []))
+
+    def test_wraparound(self):
+        """
+        выборочно подтверждённые куски за переполнением номера
+        """
+        last = protocol.SEQ_SPACE - 1
+        data = protocol.pack_sack(last - 2, [0, 2, 3, 5])
+        self.assertEqual(protocol.unpack_sack(data), (last - 2, [last - 1, 0, 1, 3]))
+        data = protocol.pack_sack(last, [0, 1])
+        self.assertEqual(protocol.unpack_sack(data), (last, [0, 1]))
+
+    def test_server_offsets(self):
+        """
+        смещения, как их считает сервер, подтверждают номера,
+        которые клиент сравнивает через seq_delta
+        """
+        base = protocol.SEQ_SPACE - 3
+        received = [base + 2, base + 4, base + 9]
+        _, selective = protocol.unpack_sack(protocol.pack_sack(base, (seq - base - 1 for seq in received)))
+        self.assertEqual([protocol.seq_delta(seq, base) for seq in selective], [2, 4, 9])
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        hashes = bytes(range(protocol.HASH_SIZE)) * 3
+        self.assertEqual(protocol.unpack_manifest(protocol.pack_manifest(1 << 20, hashes)), (1 << 20, hashes))
+
+    def test_partial_hash(self):
+        with self.assertRaises(ValueError):
+            protocol.unpack_manifest(protocol.pack_manifest(0, bytes(protocol.HASH_SIZE + 1)))
+
+    def test_reply_round_trip(self):
+        data = protocol.pack_manifest_reply(64, [0, 5, 9, 40])
+        self.assertEqual(protocol.unpack_manifest_reply(data), (64, [64, 69, 73, 104]))
+        self.assertEqual(protocol.unpack_manifest_reply(protocol.pack_manifest_reply(3, [])), (3, []))
+
+
+if __name__ == "__main__":
+    unittest.main()